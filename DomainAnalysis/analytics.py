@@ -0,0 +1,306 @@
+"""A columnar copy of the listings collection for analysis, kept as a Parquet dataset partitioned by
+postcode and the month a listing was listed.
+
+The first export appends every listing. After that each export only picks up the listings inserted into
+Mongo since the last export, tracked with a watermark of the last `_id` exported, and the listings written
+since then, tracked with a watermark of their `modified` time (see `DomainAnalysis.mongo.MODIFIED`). That
+covers refreshed details, SOI prices, description features and sold or withdrawn listings. Each partition
+a changed listing is in, or moves to, is rewritten with the listing's old row replaced. Amenity distances
+and location points aren't held in the copy, so writing them doesn't mark a listing as modified.
+
+Columns are written with a fixed schema so every file in the dataset agrees on types, and loading can skip
+the columns and partitions it doesn't need.
+"""
+import json
+import os
+import re
+import uuid
+from datetime import datetime, timedelta, timezone
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from DomainAnalysis.logger import logger
+from DomainAnalysis.descriptions import FLAGS
+from DomainAnalysis.mongo import chunked, MODIFIED
+
+WATERMARK_FILE = "_watermark.json"
+EXPORT_BATCH_SIZE = 5000
+UNKNOWN_PARTITION = "unknown"
+# Writes that started before the last export but finished after it have an earlier `modified` time than the
+# watermark, so each export looks back this far. Listings exported twice are only replaced again
+MODIFIED_OVERLAP = timedelta(minutes=5)
+
+# Listing fields in Mongo and the names they're given in the dataset
+COLUMN_NAMES = {
+    'listing_id': 'listing_id',
+    'created': 'created',
+    'dateListed': 'dateListed',
+    'dateUpdated': 'dateUpdated',
+    'saleMethod': 'saleMethod',
+    'saleMode': 'saleMode',
+    'displayPrice': 'displayPrice',
+    'minimumPrice': 'minimumPrice',
+    'maximumPrice': 'maximumPrice',
+    'inspectionsByAppointmentOnly': 'isInspectionsByAppointmentOnly',
+    'url': 'url',
+    'statementOfInformation': 'statementOfInformation',
+    'location_state': 'state',
+    'location_streetNumber': 'streetNumber',
+    'location_unitNumber': 'unitNumber',
+    'location_street': 'street',
+    'location_suburb': 'suburb',
+    'location_displayAddress': 'displayAddress',
+    'location_latitude': 'latitude',
+    'location_longitude': 'longitude',
+    'house_bathrooms': 'bathrooms',
+    'house_bedrooms': 'bedrooms',
+    'house_carspaces': 'carspaces',
+    'house_description': 'description',
+    'house_headline': 'headline',
+    'house_isNewDevelopment': 'isNewDevelopment',
+    'house_propertyType': 'propertyType',
+    'house_landAreaSqm': 'landAreaSqm',
+    'agent_advertiserType': 'advertiserType',
+    'agent_advertiserId': 'advertiserId',
+    'soi_minimumPrice': 'soi_minimumPrice',
+    'soi_maximumPrice': 'soi_maximumPrice',
+    **{f"features_{x}": f"features_{x}" for x in FLAGS},
+    'features_land_size_sqm': 'features_land_size_sqm',
+    'features_inspection_times': 'features_inspection_times',
+    'status': 'status',
+    'dateEnded': 'dateEnded',
+    'soldPrice': 'soldPrice',
+    MODIFIED: 'modified',
+}
+
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+TIMESTAMP = pa.timestamp("us", tz="UTC")
+
+SCHEMA = pa.schema([
+    ('listing_id', pa.int64()),
+    ('created', TIMESTAMP),
+    ('dateListed', TIMESTAMP),
+    ('dateUpdated', TIMESTAMP),
+    ('saleMethod', CATEGORY),
+    ('saleMode', CATEGORY),
+    ('displayPrice', pa.string()),
+    ('minimumPrice', pa.int64()),
+    ('maximumPrice', pa.int64()),
+    ('isInspectionsByAppointmentOnly', pa.bool_()),
+    ('url', pa.string()),
+    ('statementOfInformation', pa.string()),
+    ('state', CATEGORY),
+    ('streetNumber', pa.string()),
+    ('unitNumber', pa.string()),
+    ('street', pa.string()),
+    ('suburb', CATEGORY),
+    ('displayAddress', pa.string()),
+    ('latitude', pa.float64()),
+    ('longitude', pa.float64()),
+    ('bathrooms', pa.float64()),
+    ('bedrooms', pa.float64()),
+    ('carspaces', pa.float64()),
+    ('description', pa.string()),
+    ('headline', pa.string()),
+    ('isNewDevelopment', pa.bool_()),
+    ('propertyType', CATEGORY),
+    ('landAreaSqm', pa.float64()),
+    ('advertiserType', CATEGORY),
+    ('advertiserId', CATEGORY),
+    ('soi_minimumPrice', pa.int64()),
+    ('soi_maximumPrice', pa.int64()),
+    *[(f"features_{x}", pa.bool_()) for x in FLAGS],
+    ('features_land_size_sqm', pa.float64()),
+    ('features_inspection_times', pa.list_(pa.string())),
+    ('status', CATEGORY),
+    ('dateEnded', TIMESTAMP),
+    ('soldPrice', pa.int64()),
+    ('modified', TIMESTAMP),
+    ('postcode', pa.string()),
+    ('listed_month', pa.string()),
+])
+
+PARTITION_COLUMNS = ['postcode', 'listed_month']
+PARTITIONING = ds.partitioning(pa.schema([(x, pa.string()) for x in PARTITION_COLUMNS]), flavor="hive")
+
+def parse_timestamp(value):
+    """Parses the ISO 8601 timestamps Domain returns, e.g. "2021-09-27T22:29:18.3Z", as UTC datetimes.
+    Timestamps without a timezone, like `created`, are taken to be UTC.
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=value.tzinfo or timezone.utc)
+    value = value.replace("Z", "+00:00")
+    # fromisoformat needs exactly 6 digits of fractional seconds
+    value = re.sub(r"\.(\d+)", lambda m: "." + m.group(1)[:6].ljust(6, "0"), value)
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return parsed.replace(tzinfo=parsed.tzinfo or timezone.utc)
+
+def listings_to_table(documents):
+    """Converts flattened listing documents to an Arrow table with the dataset's schema
+
+    Args:
+        documents (list): Listing documents from Mongo
+
+    Returns:
+        Table: listings
+    """
+    columns = {name: [x.get(field) for x in documents] for field, name in COLUMN_NAMES.items()}
+    for name in ('created', 'dateListed', 'dateUpdated', 'dateEnded', 'modified'):
+        columns[name] = [parse_timestamp(x) for x in columns[name]]
+    columns['advertiserId'] = [None if x is None else str(x) for x in columns['advertiserId']]
+    columns['streetNumber'] = [None if x is None else str(x) for x in columns['streetNumber']]
+    columns['unitNumber'] = [None if x is None else str(x) for x in columns['unitNumber']]
+    columns['postcode'] = [str(x['location_postcode']) if x.get('location_postcode') else UNKNOWN_PARTITION
+                           for x in documents]
+    columns['listed_month'] = [x.strftime("%Y-%m") if x else UNKNOWN_PARTITION for x in columns['dateListed']]
+
+    arrays = []
+    for field in SCHEMA:
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(columns[field.name], type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(columns[field.name], type=field.type))
+    return pa.Table.from_arrays(arrays, schema=SCHEMA)
+
+def read_watermark(root):
+    """Gets the `_id` of the last listing exported to the dataset and the latest `modified` time exported
+
+    Returns:
+        tuple: ObjectId and datetime, each None if nothing has been exported or the export was made before
+            modified times were kept
+    """
+    path = os.path.join(root, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return None, None
+    with open(path) as infile:
+        watermark = json.load(infile)
+    last_modified = watermark.get('last_modified')
+    return ObjectId(watermark['last_id']), datetime.fromisoformat(last_modified) if last_modified else None
+
+def write_watermark(root, last_id, last_modified = None):
+    path = os.path.join(root, WATERMARK_FILE)
+    # Write then rename so a crash never leaves a half written watermark
+    with open(path + ".tmp", "w") as outfile:
+        json.dump({'last_id': str(last_id), 'last_modified': last_modified.isoformat() if last_modified else None,
+                   'updated': datetime.utcnow().isoformat()}, outfile)
+    os.replace(path + ".tmp", path)
+
+def latest_modified(documents, last_modified = None):
+    """Latest `modified` time of a batch of listing documents, or `last_modified` if it's later"""
+    times = [x[MODIFIED] for x in documents if x.get(MODIFIED) is not None]
+    if last_modified is not None:
+        times.append(last_modified)
+    return max(times) if times else None
+
+def open_dataset(root):
+    return ds.dataset(root, format="parquet", partitioning=PARTITIONING, schema=SCHEMA)
+
+def partition_path(root, postcode, listed_month):
+    return os.path.join(root, f"postcode={postcode}", f"listed_month={listed_month}")
+
+def replace_listings(root, table):
+    """Replaces the rows of the listings in `table` in the dataset. Each partition the listings are in, or
+    move to, is rewritten as a single file without their old rows and with their new ones.
+
+    A crash part way through can leave a listing in two files, which the next replacement of the listing fixes.
+
+    Args:
+        root (str): Directory of the dataset
+        table (Table): Listings, see `listings_to_table`
+    """
+    listing_ids = table.column('listing_id').to_pylist()
+    dataset = open_dataset(root)
+    existing = dataset.to_table(columns=PARTITION_COLUMNS, filter=ds.field('listing_id').isin(listing_ids))
+    partitions = set(zip(*(existing.column(x).to_pylist() for x in PARTITION_COLUMNS)))
+    partitions |= set(zip(*(table.column(x).to_pylist() for x in PARTITION_COLUMNS)))
+    for postcode, listed_month in sorted(partitions):
+        in_partition = (ds.field('postcode') == postcode) & (ds.field('listed_month') == listed_month)
+        kept = dataset.to_table(filter=in_partition & ~ds.field('listing_id').isin(listing_ids))
+        changed = table.filter(pc.and_(pc.equal(table.column('postcode'), postcode),
+                                       pc.equal(table.column('listed_month'), listed_month)))
+        rows = pa.concat_tables([kept, changed]).drop(PARTITION_COLUMNS)
+        directory = partition_path(root, postcode, listed_month)
+        os.makedirs(directory, exist_ok=True)
+        old_files = [x for x in os.listdir(directory) if not x.startswith(("_", "."))]
+        # Write then rename so a crash never leaves a half written file. Files starting with "_" aren't read
+        filename = f"{uuid.uuid4().hex}.parquet"
+        pq.write_table(rows, os.path.join(directory, f"_{filename}"))
+        os.replace(os.path.join(directory, f"_{filename}"), os.path.join(directory, filename))
+        for old_file in old_files:
+            os.remove(os.path.join(directory, old_file))
+
+def export_listings_to_parquet(coll, root, batch_size = EXPORT_BATCH_SIZE):
+    """Brings the Parquet dataset at `root` up to date with the listings collection. Listings inserted since
+    the last export are added and listings modified since the last export replace their old rows.
+
+    Args:
+        coll (Collection): Listings collection
+        root (str): Directory of the dataset
+        batch_size (int, optional): Listings written per batch. Defaults to EXPORT_BATCH_SIZE.
+
+    Returns:
+        int: Number of listings exported
+    """
+    os.makedirs(root, exist_ok=True)
+    last_id, last_modified = read_watermark(root)
+    if last_id is None:
+        # Nothing to replace yet, so every listing is appended, moving the watermark after every batch so a
+        # failed export picks up where it stopped
+        cursor = coll.find({}, batch_size=batch_size).sort("_id", ASCENDING)
+        exported = 0
+        for documents in chunked(cursor, batch_size):
+            pq.write_to_dataset(listings_to_table(documents), root, partition_cols=PARTITION_COLUMNS)
+            last_modified = latest_modified(documents, last_modified)
+            write_watermark(root, documents[-1]['_id'], last_modified)
+            exported += len(documents)
+        logger.info("Exported %s listings to %s", exported, root)
+        return exported
+
+    modified = ({MODIFIED: {"$gte": last_modified - MODIFIED_OVERLAP}} if last_modified
+                else {MODIFIED: {"$ne": None}})
+    cursor = coll.find({"$or": [{"_id": {"$gt": last_id}}, modified]}, batch_size=batch_size).sort("_id", ASCENDING)
+    exported = 0
+    for documents in chunked(cursor, batch_size):
+        replace_listings(root, listings_to_table(documents))
+        last_id = max(last_id, documents[-1]['_id'])
+        last_modified = latest_modified(documents, last_modified)
+        exported += len(documents)
+    # Replacing listings is safe to repeat, so a failed export starts again from the old watermark
+    write_watermark(root, last_id, last_modified)
+    logger.info("Exported %s new and modified listings to %s", exported, root)
+    return exported
+
+def load_listings(root, columns = None, postcodes = None, listed_months = None):
+    """Loads listings from the Parquet dataset as a DataFrame, only reading the columns and partitions asked for
+
+    Args:
+        root (str): Directory of the dataset
+        columns (list, optional): Columns to load. Defaults to None, every column.
+        postcodes (list, optional): Only listings in these postcodes. Defaults to None, all postcodes.
+        listed_months (list, optional): Only listings listed in these months, e.g. "2021-09". Defaults to None.
+
+    Returns:
+        DataFrame: listings
+    """
+    dataset = open_dataset(root)
+    expression = None
+    if postcodes:
+        expression = ds.field('postcode').isin([str(x) for x in postcodes])
+    if listed_months:
+        months = ds.field('listed_month').isin(list(listed_months))
+        expression = months if expression is None else expression & months
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+if __name__ == "__main__":
+    from DomainAnalysis.mongo import connect_to_mongo_db, connect_to_domain_listings
+    client = connect_to_mongo_db()
+    listing_coll = connect_to_domain_listings(client)
+    export_listings_to_parquet(listing_coll, os.environ.get("ANALYTICS_DIR", "data/listings"))
@@ -0,0 +1,229 @@
+"""Wrangles stored raw listings again and writes them to the listings collection, e.g. after fixing a
+bug in `Listing`.
+
+The raw listings are read in listing_id order from the `details` collection in Mongo, or from a local
+dump (a JSON list or NDJSON file sorted by listing id), and split into partitions. The partitions are
+wrangled across a pool of processes, so re-processing the full history scales with the number of cores,
+and each one is bulk-written as it finishes. The checkpoint file records the last listing id every
+listing up to has been written, so a backfill that is stopped can be run again with the same arguments
+and picks up after it, however many details have been stored since. Listings that couldn't be written
+are kept in the checkpoint and tried again when the backfill is resumed. Listings that can't be wrangled
+or written are reported one per line in the failures file.
+
+Usage:
+    python -m DomainAnalysis.backfill [--input dump.ndjson] [--workers 4] [--checkpoint backfill_checkpoint.json]
+"""
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from pymongo import ASCENDING
+from DomainAnalysis.logger import logger
+from DomainAnalysis.mongo import (connect_to_mongo_db, connect_to_domain_details, connect_to_domain_listings,
+                                  chunked, bulk_upsert_rows)
+from DomainAnalysis.wrangler import Listing
+
+PARTITION_SIZE = 1000
+CHECKPOINT_PATH = "backfill_checkpoint.json"
+FAILURES_PATH = "backfill_failures.ndjson"
+
+# Stages a listing can fail in
+WRANGLE = "wrangle"
+WRITE = "write"
+
+def iter_raw_listings_from_file(path):
+    """Reads raw listings from a JSON list or NDJSON file. Documents exported from the `details`
+    collection are unwrapped to the raw listing they hold.
+    """
+    with open(path) as infile:
+        if path.endswith(".json"):
+            documents = json.load(infile)
+        else:
+            documents = (json.loads(line) for line in infile if line.strip())
+        for document in documents:
+            yield document['listing'] if 'listing' in document and 'id' not in document else document
+
+def iter_raw_listings_from_mongo(details, after = None, retry = (), batch_size = PARTITION_SIZE):
+    """Reads the raw listings from the `details` collection in listing_id order
+
+    Args:
+        details (Collection): Details collection
+        after (int, optional): Only listings with a greater listing id. Defaults to None, every listing.
+        retry (iterable, optional): Listings read whatever their id, e.g. ones that failed to be written.
+        batch_size (int, optional): Listings per batch of the cursor. Defaults to PARTITION_SIZE.
+    """
+    query = {}
+    if after is not None:
+        query = {"$or": [{"listing_id": {"$gt": after}}, {"listing_id": {"$in": sorted(retry)}}]}
+    cursor = details.find(query, {"listing": 1, "_id": 0}, batch_size=batch_size).sort("listing_id", ASCENDING)
+    for document in cursor:
+        yield document['listing']
+
+def wrangle_partition(partition):
+    """Wrangles a partition of raw listings. Runs in a worker process.
+
+    Args:
+        partition (tuple): the partition number and its list of raw listings
+
+    Returns:
+        dict: the `partition` number, the flattened `rows`, the `failures` of listings that couldn't be wrangled
+            and the `listing_ids` in the partition
+    """
+    number, raw_listings = partition
+    rows = []
+    failures = []
+    for raw_listing in raw_listings:
+        try:
+            rows.append(Listing(raw_listing).as_no_nested_dicts())
+        except Exception as e:
+            listing_id = _listing_id(raw_listing)
+            failures.append({'listing_id': listing_id, 'stage': WRANGLE, 'error': f"{type(e).__name__}: {e}"})
+    return {'partition': number, 'rows': rows, 'failures': failures,
+            'listing_ids': [x for x in map(_listing_id, raw_listings) if x is not None]}
+
+def read_checkpoint(path, source):
+    """Gets how far a backfill of the same source got
+
+    Returns:
+        tuple: the last listing id every listing up to has been written, None if there's no checkpoint,
+            and the set of listing ids that failed to be written and should be tried again
+    """
+    if path is None or not os.path.exists(path):
+        return None, set()
+    with open(path) as infile:
+        checkpoint = json.load(infile)
+    if checkpoint['source'] != source:
+        raise ValueError(f"Checkpoint {path} is for a backfill of {checkpoint['source']}, "
+                         f"delete it to start a new backfill")
+    return checkpoint['last_listing_id'], set(checkpoint['retry'])
+
+def write_checkpoint(path, source, last_listing_id, retry):
+    # Write then rename so a crash never leaves a half written checkpoint
+    with open(path + ".tmp", "w") as outfile:
+        json.dump({'source': source, 'last_listing_id': last_listing_id, 'retry': sorted(retry),
+                   'updated': datetime.utcnow().isoformat()}, outfile)
+    os.replace(path + ".tmp", path)
+
+def _listing_id(raw_listing):
+    return raw_listing.get('id') if isinstance(raw_listing, dict) else None
+
+def backfill(raw_listings, coll = None, source = "", partition_size = PARTITION_SIZE, workers = None,
+             checkpoint_path = CHECKPOINT_PATH, failures_path = FAILURES_PATH):
+    """Wrangles raw listings across a process pool and upserts them into the listings collection
+
+    Args:
+        raw_listings (iterable): Raw listings, in listing_id order
+        coll (Collection, optional): Listings collection. Defaults to None, nothing is written.
+        source (str, optional): Name of where the raw listings came from, a checkpoint is only reused for the same source.
+        partition_size (int, optional): Listings per partition. Defaults to PARTITION_SIZE.
+        workers (int, optional): Number of worker processes. Defaults to the number of cores.
+        checkpoint_path (str, optional): Checkpoint file, None to not checkpoint. Defaults to CHECKPOINT_PATH.
+        failures_path (str, optional): File the failures are appended to, None to only log them. Defaults to FAILURES_PATH.
+
+    Returns:
+        dict: counts of the `partitions` processed, listings `skipped` as already done, `wrangled`,
+            `inserted`, `modified` and `failed`
+    """
+    last_listing_id, retry = read_checkpoint(checkpoint_path, source)
+    summary = {'partitions': 0, 'skipped': 0, 'wrangled': 0, 'inserted': 0, 'modified': 0, 'failed': 0}
+    if last_listing_id is not None:
+        logger.info("Resuming backfill of %s after listing %s, retrying %s listings that failed to be written",
+                    source, last_listing_id, len(retry))
+    # Partitions finish out of order, so the checkpoint only moves past a partition once every one before it is done
+    partition_ends = {}
+    finished = set()
+    next_partition = 0
+
+    def finish(result):
+        nonlocal last_listing_id, next_partition
+        failures = result['failures']
+        retry.difference_update(result['listing_ids'])
+        if coll is not None:
+            for batch in bulk_upsert_rows(coll, result['rows']):
+                summary['inserted'] += batch['inserted']
+                summary['modified'] += batch['modified']
+                failures += [dict(x, stage=WRITE) for x in batch['errors']]
+                retry.update(x['listing_id'] for x in batch['errors'])
+        if failures:
+            summary['failed'] += len(failures)
+            logger.warning("Unable to backfill %s listings in partition %s", len(failures), result['partition'])
+            if failures_path is not None:
+                with open(failures_path, "a") as outfile:
+                    for failure in failures:
+                        outfile.write(json.dumps(dict(failure, partition=result['partition']), default=str) + "\n")
+        summary['partitions'] += 1
+        summary['wrangled'] += len(result['rows'])
+        finished.add(result['partition'])
+        while next_partition in finished:
+            end = partition_ends.pop(next_partition)
+            last_listing_id = end if last_listing_id is None or end is None else max(last_listing_id, end)
+            next_partition += 1
+        if checkpoint_path is not None:
+            write_checkpoint(checkpoint_path, source, last_listing_id, retry)
+        logger.debug("Finished partition %s: %s listings", result['partition'], len(result['rows']))
+
+    def to_do(raw_listings):
+        # Listings up to the checkpoint are skipped, except those that failed to be written
+        previous = None
+        for raw_listing in raw_listings:
+            listing_id = _listing_id(raw_listing)
+            if listing_id is not None and previous is not None and listing_id < previous:
+                logger.critical("Raw listings aren't in listing_id order, listing %s follows %s", listing_id, previous)
+                raise ValueError(f"Raw listings must be in listing_id order, listing {listing_id} follows {previous}")
+            previous = listing_id if listing_id is not None else previous
+            if (last_listing_id is not None and listing_id is not None and listing_id <= last_listing_id
+                    and listing_id not in retry):
+                summary['skipped'] += 1
+                continue
+            yield raw_listing
+
+    workers = workers or os.cpu_count()
+    # Only a couple of partitions per worker are held at once so memory stays bounded
+    max_pending = 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for number, partition in enumerate(chunked(to_do(raw_listings), partition_size)):
+            ids = [x for x in map(_listing_id, partition) if x is not None]
+            partition_ends[number] = max(ids) if ids else None
+            pending.add(executor.submit(wrangle_partition, (number, partition)))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future.result())
+        for future in wait(pending).done:
+            finish(future.result())
+
+    logger.info("Backfilled %s listings in %s partitions (%s already done): %s inserted, %s modified, %s failed",
+                summary['wrangled'], summary['partitions'], summary['skipped'], summary['inserted'],
+                summary['modified'], summary['failed'])
+    return summary
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", help="JSON or NDJSON dump of raw listings. Defaults to the details collection in Mongo")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes. Defaults to the number of cores")
+    parser.add_argument("--partition-size", type=int, default=PARTITION_SIZE, help="Listings per partition")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH, help="Checkpoint file used to resume")
+    parser.add_argument("--failures", default=FAILURES_PATH, help="File listings that fail are reported to")
+    parser.add_argument("--dry-run", action="store_true", help="Wrangle the listings without writing them to Mongo")
+    args = parser.parse_args(argv)
+
+    client = None
+    if args.input is None or not args.dry_run:
+        client = connect_to_mongo_db()
+    if args.input is not None:
+        raw_listings, source = iter_raw_listings_from_file(args.input), os.path.abspath(args.input)
+    else:
+        source = "mongo:details"
+        # Only the listings after the checkpoint are read back from Mongo
+        last_listing_id, retry = read_checkpoint(None if args.dry_run else args.checkpoint, source)
+        raw_listings = iter_raw_listings_from_mongo(connect_to_domain_details(client), last_listing_id, retry)
+    if args.dry_run:
+        # A dry run writes nothing, so it mustn't mark any partitions as done
+        return backfill(raw_listings, None, source, args.partition_size, args.workers, None, args.failures)
+    return backfill(raw_listings, connect_to_domain_listings(client), source, args.partition_size, args.workers,
+                    args.checkpoint, args.failures)
+
+if __name__ == "__main__":
+    main()
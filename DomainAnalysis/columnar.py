@@ -0,0 +1,163 @@
+"""Wrangles raw Domain listings straight into columns, for re-wrangling large amounts of raw data at once.
+
+`raw_listings_to_frame` gives the same values as flattening `Listing(raw_listing)` for every listing,
+with the same column names and order as `Listing.as_no_nested_dicts`. Each field is pulled out of the
+raw listings into a column in one pass, and the address and price rules are then applied to whole
+columns rather than listing by listing. A field missing from a raw listing is null in its row,
+where `Listing` would raise.
+"""
+import datetime
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from DomainAnalysis.logger import logger
+from DomainAnalysis.mongo import chunked
+from DomainAnalysis.prices import parse_display_prices
+from DomainAnalysis.wrangler import flat_field_names
+
+DEFAULT_BATCH_SIZE = 10000
+
+# Where each column is found in a raw listing
+RAW_PATHS = {
+    'listing_id': ('id',),
+    'dateListed': ('dateListed',),
+    'dateUpdated': ('dateUpdated',),
+    'saleMethod': ('saleDetails', 'saleMethod'),
+    'saleMode': ('saleMode',),
+    'displayPrice': ('priceDetails', 'displayPrice'),
+    'inspectionsByAppointmentOnly': ('inspectionDetails', 'isByAppointmentOnly'),
+    'url': ('seoUrl',),
+    'statementOfInformation': ('statementOfInformation', 'documentationUrl'),
+    'location_state': ('addressParts', 'stateAbbreviation'),
+    'location_streetNumber': ('addressParts', 'streetNumber'),
+    'location_unitNumber': ('addressParts', 'unitNumber'),
+    'location_street': ('addressParts', 'street'),
+    'location_suburb': ('addressParts', 'suburb'),
+    'location_postcode': ('addressParts', 'postcode'),
+    'location_displayAddress': ('addressParts', 'displayAddress'),
+    'location_latitude': ('geoLocation', 'latitude'),
+    'location_longitude': ('geoLocation', 'longitude'),
+    'house_bathrooms': ('bathrooms',),
+    'house_bedrooms': ('bedrooms',),
+    'house_carspaces': ('carspaces',),
+    'house_description': ('description',),
+    'house_headline': ('headline',),
+    'house_isNewDevelopment': ('isNewDevelopment',),
+    'house_propertyType': ('propertyTypes', 0),
+    'house_landAreaSqm': ('landAreaSqm',),
+    'agent_advertiserType': ('advertiserIdentifiers', 'advertiserType'),
+    'agent_advertiserId': ('advertiserIdentifiers', 'advertiserId'),
+}
+
+# Fields only used to work out other columns
+_DISPLAY_TYPE = ('addressParts', 'displayType')
+_PRICE = ('priceDetails', 'price')
+_MINIMUM_PRICE = ('priceDetails', 'minimumPrice')
+_MAXIMUM_PRICE = ('priceDetails', 'maximumPrice')
+
+# Parts of the address only shown for a full address
+_FULL_ADDRESS_ONLY = ['location_streetNumber', 'location_unitNumber', 'location_street']
+
+INTEGER_COLUMNS = ['listing_id', 'minimumPrice', 'maximumPrice']
+FLOAT_COLUMNS = ['location_latitude', 'location_longitude', 'house_bathrooms', 'house_bedrooms',
+                 'house_carspaces', 'house_landAreaSqm']
+BOOLEAN_COLUMNS = ['inspectionsByAppointmentOnly', 'house_isNewDevelopment']
+
+def _get(raw_listing, path):
+    value = raw_listing
+    for key in path:
+        try:
+            value = value[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return value
+
+def _column(raw_listings, path, dtype = object):
+    return pd.Series([_get(x, path) for x in raw_listings], dtype=dtype)
+
+def _prices(raw_listings, displayPrice):
+    """Works out the minimum and maximum price the same way `Listing` does: the listed price if there is
+    one, otherwise the display price, unless the display price has more than one "$" in which case
+    Domain's minimum and maximum price are preferred
+    """
+    parsed = parse_display_prices(displayPrice)
+    price = _column(raw_listings, _PRICE, "Int64")
+    several_prices = displayPrice.str.count(r"\$").fillna(0).to_numpy() >= 2
+    minimum = _column(raw_listings, _MINIMUM_PRICE, "Int64")
+    maximum = _column(raw_listings, _MAXIMUM_PRICE, "Int64")
+    minimum = minimum.where(several_prices & minimum.notna().to_numpy(), parsed.minimumPrice)
+    maximum = maximum.where(several_prices & maximum.notna().to_numpy(), parsed.maximumPrice)
+    has_price = price.notna()
+    return minimum.where(~has_price, price), maximum.where(~has_price, price)
+
+def raw_listings_to_frame(raw_listings, created = None) -> pd.DataFrame:
+    """Wrangles raw listings from Domain into a DataFrame with a row per listing
+
+    Args:
+        raw_listings (list): Raw listings, as returned by `get_listing`
+        created (str, optional): Value of the `created` column. Defaults to the current UTC time.
+
+    Returns:
+        DataFrame: listings, with the columns of `Listing.as_no_nested_dicts`. Prices and the listing
+            id are nullable Int64, numbers that may be missing are floats and text is object
+    """
+    raw_listings = list(raw_listings)
+    columns = {name: _column(raw_listings, path) for name, path in RAW_PATHS.items()}
+    columns['created'] = pd.Series([created or datetime.datetime.utcnow().isoformat()] * len(raw_listings),
+                                   dtype=object)
+
+    display_type = _column(raw_listings, _DISPLAY_TYPE).to_numpy()
+    full_address = display_type == 'fullAddress'
+    known_address = full_address | (display_type == 'suburbOnly')
+    for name in RAW_PATHS:
+        if name.startswith('location_') and name not in ('location_latitude', 'location_longitude'):
+            mask = full_address if name in _FULL_ADDRESS_ONLY else known_address
+            columns[name] = columns[name].where(mask, None)
+    columns['location_state'] = columns['location_state'].str.upper().astype(object)
+
+    columns['minimumPrice'], columns['maximumPrice'] = _prices(raw_listings, columns['displayPrice'])
+
+    for name in INTEGER_COLUMNS:
+        columns[name] = columns[name].astype("Int64")
+    for name in FLOAT_COLUMNS:
+        columns[name] = columns[name].astype(float)
+    for name in BOOLEAN_COLUMNS:
+        columns[name] = columns[name].astype("boolean")
+    frame = pd.DataFrame({name: columns[name] for name in flat_field_names()})
+    # Keep the text columns as python objects, with None rather than NaN for missing values
+    for name in frame.columns:
+        if frame[name].dtype == object:
+            frame[name] = frame[name].where(frame[name].notna(), None)
+    return frame
+
+def raw_listings_to_table(raw_listings, created = None) -> pa.Table:
+    """Same as `raw_listings_to_frame`, but as an Arrow table"""
+    return pa.Table.from_pandas(raw_listings_to_frame(raw_listings, created), preserve_index=False)
+
+def iter_raw_listing_frames(raw_listings, batch_size = DEFAULT_BATCH_SIZE, created = None):
+    """Wrangles a stream of raw listings a batch at a time, so memory stays bounded
+
+    Args:
+        raw_listings (iterable): Raw listings, e.g. a Mongo cursor
+        batch_size (int, optional): Max rows per DataFrame. Defaults to DEFAULT_BATCH_SIZE.
+        created (str, optional): Value of the `created` column. Defaults to the current UTC time.
+
+    Yields:
+        DataFrame: listings, see `raw_listings_to_frame`
+    """
+    created = created or datetime.datetime.utcnow().isoformat()
+    total = 0
+    for batch in chunked(raw_listings, batch_size):
+        total += len(batch)
+        yield raw_listings_to_frame(batch, created)
+    logger.debug("Wrangled %s raw listings", total)
+
+def frame_to_records(frame: pd.DataFrame) -> list:
+    """Converts a frame of listings to flattened listing dicts ready for Mongo, with None for nulls"""
+    values = frame.astype(object).where(frame.notna(), None)
+    records = values.to_dict("records")
+    for record in records:
+        for k, v in record.items():
+            if isinstance(v, np.generic):
+                record[k] = v.item()
+    return records
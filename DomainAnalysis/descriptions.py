@@ -0,0 +1,182 @@
+"""Features of a listing found in the free text of its headline and description, e.g. whether it has a pool,
+needs renovating, the land size and the inspection times the agent has written in.
+
+Every feature is a named group of one combined, precompiled pattern, so each description is scanned once
+however many features there are. Features are stored on the listing with a hash of the text they were
+found in, and are only found again when the text, or the features looked for (`FEATURES_VERSION`), change.
+
+Usage:
+    python -m DomainAnalysis.descriptions [--workers 4]
+"""
+import argparse
+import hashlib
+import re
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from pymongo import UpdateOne
+from DomainAnalysis.logger import logger
+from DomainAnalysis.mongo import chunked, BULK_WRITE_BATCH_SIZE, MODIFIED
+
+# Bump whenever the features or their patterns change so stored features are found again
+FEATURES_VERSION = 1
+
+# Features that are either mentioned or not
+FLAGS = {
+    'pool': r"\bpool\b(?!\s+table)",
+    'spa': r"\bspa\b",
+    'solar': r"\bsolar\b",
+    'renovated': r"\b(?:renovated|refurbished|remodell?ed)\b",
+    'needs_renovation': r"\brenovator'?s?\s+(?:delight|dream)|\boriginal\s+condition\b|\brenovate\s+or\s+rebuild\b"
+                        r"|\bpotential\s+to\s+renovate\b|\bin\s+need\s+of\s+(?:some\s+)?(?:renovation|updating)\b"
+                        r"|\bdeceased\s+estate\b",
+    'water_views': r"\b(?:ocean|sea|bay|water|beach|river)\s+views?\b",
+    'air_conditioning': r"\bair[\s-]?con(?:ditioning|ditioner)?\b|\bsplit[\s-]system\b|\brefrigerated\s+cooling\b"
+                        r"|\bevaporative\s+cooling\b",
+    'study': r"\bstudy\b",
+    'by_appointment': r"\bby\s+(?:private\s+)?appointment\b|\bprivate\s+(?:inspections?|appointment)\b"
+                      r"|\bbook\s+an?\s+(?:appointment|inspection)\b",
+}
+
+_TIME = r"\d{1,2}(?:[:.]\d{2})?\s*[ap]\.?m\.?"
+_AREA = r"\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?"
+
+# Features that carry a value, their groups are named after the feature
+VALUES = {
+    'land_size': rf"(?P<land_size_value>{_AREA})\s*(?P<land_size_unit>m2|m²|sq\.?\s?m(?:etres|eters)?|square\s+met(?:re|er)s"
+                 rf"|acres?|hectares?|ha)\b",
+    'inspection_time': rf"(?P<inspection_start>{_TIME})\s*(?:-|–|to)\s*(?P<inspection_end>{_TIME})",
+}
+
+_FEATURES = re.compile("|".join(f"(?P<{name}>{pattern})" for name, pattern in {**FLAGS, **VALUES}.items()),
+                       re.IGNORECASE)
+
+SQM_PER_UNIT = {'acre': 4046.8564224, 'acres': 4046.8564224, 'hectare': 10_000, 'hectares': 10_000, 'ha': 10_000}
+
+FEATURE_NAMES = list(FLAGS) + ['land_size_sqm', 'inspection_times']
+
+def _to_24_hour(time):
+    """Converts a time such as "11:00AM" or "1 pm" to "11:00" or "13:00" """
+    time = time.lower().replace(".", ":").replace(" ", "")
+    hours, _, minutes = time.rstrip("apm:").partition(":")
+    hours = int(hours) % 12 + (12 if "p" in time else 0)
+    return f"{hours:02d}:{minutes or '00'}"
+
+def extract_description_features(text) -> dict:
+    """Finds the features mentioned in the text of a listing
+
+    Args:
+        text (str): headline and description of the listing
+
+    Returns:
+        dict: a bool for each of FLAGS, the largest land size mentioned in `land_size_sqm` (None if there's none)
+            and each distinct `inspection_times` range, e.g. "11:00-12:30"
+    """
+    features = dict.fromkeys(FLAGS, False)
+    land_sizes = []
+    inspection_times = []
+    for match in _FEATURES.finditer(text or ""):
+        name = match.lastgroup
+        if name == 'land_size':
+            value = float(match.group('land_size_value').replace(",", ""))
+            unit = match.group('land_size_unit').lower()
+            land_sizes.append(value * SQM_PER_UNIT.get(unit, 1))
+        elif name == 'inspection_time':
+            times = f"{_to_24_hour(match.group('inspection_start'))}-{_to_24_hour(match.group('inspection_end'))}"
+            if times not in inspection_times:
+                inspection_times.append(times)
+        else:
+            features[name] = True
+    features['land_size_sqm'] = max(land_sizes) if land_sizes else None
+    features['inspection_times'] = inspection_times
+    return features
+
+def listing_text(headline, description):
+    return f"{headline or ''}\n{description or ''}"
+
+def text_hash(text):
+    """Hash of the text features are found in, which changes with FEATURES_VERSION too"""
+    return hashlib.sha1(f"{FEATURES_VERSION}\n{text}".encode()).hexdigest()
+
+def extract_many(texts, workers = 1, chunksize = 500):
+    """Finds the features of many texts, across a pool of processes when `workers` is more than 1.
+    Each distinct text is only looked at once.
+
+    Args:
+        texts (list): Texts of the listings
+        workers (int, optional): Number of worker processes, None for the number of cores. Defaults to 1.
+        chunksize (int, optional): Texts sent to a worker at a time. Defaults to 500.
+
+    Returns:
+        list: features of each text, see `extract_description_features`
+    """
+    texts = list(texts)
+    distinct = list(dict.fromkeys(texts))
+    if workers == 1 or len(distinct) < chunksize:
+        found = [extract_description_features(x) for x in distinct]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            found = list(executor.map(extract_description_features, distinct, chunksize=chunksize))
+    by_text = dict(zip(distinct, found))
+    return [by_text[x] for x in texts]
+
+def add_description_features(frame, workers = 1, headline = "house_headline", description = "house_description"):
+    """Adds a `features_<name>` column for each feature to a frame of listings
+
+    Args:
+        frame (DataFrame): Listings, e.g. from `raw_listings_to_frame`
+        workers (int, optional): Number of worker processes, see `extract_many`. Defaults to 1.
+        headline (str, optional): Headline column. Defaults to "house_headline".
+        description (str, optional): Description column. Defaults to "house_description".
+
+    Returns:
+        DataFrame: a copy of `frame` with the feature columns
+    """
+    texts = [listing_text(h, d) for h, d in zip(frame[headline], frame[description])]
+    features = pd.DataFrame(extract_many(texts, workers), columns=FEATURE_NAMES, index=frame.index)
+    return pd.concat([frame, features.add_prefix("features_")], axis=1)
+
+def update_description_features(coll, listing_ids = None, workers = 1, batch_size = BULK_WRITE_BATCH_SIZE * 10):
+    """Finds the features of stored listings whose text has changed since their features were last found
+
+    Args:
+        coll (Collection): Listings collection
+        listing_ids (list, optional): Only these listings. Defaults to None, every listing.
+        workers (int, optional): Number of worker processes, see `extract_many`. Defaults to 1.
+        batch_size (int, optional): Listings read from Mongo at a time. Defaults to 5000.
+
+    Returns:
+        int: Number of listings updated
+    """
+    project = {"listing_id": 1, "house_headline": 1, "house_description": 1, "features_hash": 1, "_id": 0}
+    if listing_ids is None:
+        documents = coll.find({}, project, batch_size=batch_size)
+    else:
+        documents = (x for chunk in chunked(listing_ids) for x in coll.find({"listing_id": {"$in": chunk}}, project))
+    updated = 0
+    for batch in chunked(documents, batch_size):
+        texts = {x['listing_id']: listing_text(x.get('house_headline'), x.get('house_description')) for x in batch}
+        stored_hashes = {x['listing_id']: x.get('features_hash') for x in batch}
+        stale = [k for k, text in texts.items() if text_hash(text) != stored_hashes[k]]
+        if not stale:
+            continue
+        found = extract_many([texts[x] for x in stale], workers)
+        operations = []
+        for listing_id, features in zip(stale, found):
+            row = {f"features_{k}": v for k, v in features.items()}
+            row['features_hash'] = text_hash(texts[listing_id])
+            operations.append(UpdateOne({"listing_id": listing_id}, {"$set": row, "$currentDate": {MODIFIED: True}}))
+        for chunk in chunked(operations, BULK_WRITE_BATCH_SIZE):
+            coll.bulk_write(chunk, ordered=False)
+        updated += len(operations)
+    logger.info("Found description features of %s listings", updated)
+    return updated
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes. Defaults to the number of cores")
+    args = parser.parse_args(argv)
+    from DomainAnalysis.mongo import connect_to_mongo_db, connect_to_domain_listings
+    return update_description_features(connect_to_domain_listings(connect_to_mongo_db()), workers=args.workers)
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,170 @@
 import requests
-from DomainAnalysis.logger import logger
+from requests.adapters import HTTPAdapter
+from DomainAnalysis.logger import logger, SAMPLED
+from DomainAnalysis.metrics import metrics
+from DomainAnalysis.quota import RequestBudget, get_budget, SEARCH, DETAIL
 import json
 import os
+import random
+import threading
+import time
 from math import ceil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 load_dotenv()
 
+DOMAIN_API_URL = "https://api.domain.com.au/v1"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def parse_retry_after(retry_after):
+    """Converts a `Retry-After` header into the number of seconds to wait.
+    The header can either be a number of seconds or a HTTP date.
+
+    Args:
+        retry_after (str): Value of the `Retry-After` header
+
+    Returns:
+        float: seconds to wait, None if the header is missing or can't be read
+    """
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+class DomainClient():
+    """Client for the Domain API that keeps a pooled, keep-alive session so connections are reused
+    between requests. Requests that fail with a 429 or 5xx are retried with jittered exponential backoff,
+    waiting for `Retry-After` instead when Domain provides it.
+    
+    Args:
+        key (str): Authentication key
+        base_url (str, optional): Root of the Domain API. Defaults to DOMAIN_API_URL.
+        pool_size (int, optional): Max number of connections kept open to Domain. Defaults to 10.
+        max_retries (int, optional): Number of times a failed request is retried. Defaults to 5.
+        backoff_factor (float, optional): Seconds the backoff starts from, doubling each retry. Defaults to 0.5.
+        max_backoff (float, optional): Longest wait between retries. A `Retry-After` longer than this
+            is not waited on and the response is returned as is. Defaults to 60.
+        timeout (float, optional): Seconds to wait on Domain before giving up on a request. Defaults to 30.
+        budget (RequestBudget, optional): Daily request budget every request is spent from, retries included.
+            Defaults to None, no budget.
+    """
+    def __init__(self, key: str, base_url: str = DOMAIN_API_URL, pool_size: int = 10, max_retries: int = 5,
+                 backoff_factor: float = 0.5, max_backoff: float = 60, timeout: float = 30,
+                 budget: RequestBudget = None) -> None:
+        self.base_url = base_url
+        self.budget = budget
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        
+        self.session = requests.Session()
+        self.session.headers.update({"X-Api-Key": key})
+        # Retries are handled in `request` so the pool itself never retries
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        
+    def backoff(self, attempt: int) -> float:
+        """Full jitter exponential backoff: a random wait between 0 and `backoff_factor * 2^attempt`"""
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+        
+    def request(self, method: str, path: str, kind: str = DETAIL, **kwargs):
+        """Makes a request to Domain, retrying rate limited and server errors.
+
+        Args:
+            method (str): HTTP method
+            path (str): path of the endpoint after the `base_url`, e.g. "/listings/123"
+            kind (str, optional): Which part of the budget the request is spent from. Defaults to DETAIL.
+
+        Raises:
+            QuotaExceeded: the budget can't afford another request
+
+        Returns:
+            Response: the last response from Domain
+        """
+        url = f"{self.base_url}{path}"
+        for attempt in range(self.max_retries + 1):
+            if self.budget is not None:
+                self.budget.acquire(kind)
+            if attempt > 0:
+                metrics.inc("domain_retries_total", kind=kind)
+            try:
+                with metrics.timer("domain_request_seconds", kind=kind):
+                    res = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.inc("domain_requests_total", kind=kind, status=type(e).__name__)
+                if attempt == self.max_retries:
+                    logger.critical("Request to Domain failed after %s attempts. URL: %s, Error: %s",
+                                    attempt + 1, url, e)
+                    raise
+                wait = self.backoff(attempt)
+                logger.warning("Request to Domain failed (%s). Retrying in %.2fs. URL: %s", e, wait, url)
+            else:
+                metrics.inc("domain_requests_total", kind=kind, status=res.status_code)
+                metrics.inc("domain_response_bytes_total", int(res.headers.get('Content-Length', 0)), kind=kind)
+                if res.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                    return res
+                retry_after = parse_retry_after(res.headers.get('Retry-After'))
+                if retry_after is not None and retry_after > self.max_backoff:
+                    logger.warning("Domain asked to retry after %.0fs, longer than allowed. URL: %s", retry_after, url)
+                    return res
+                wait = retry_after if retry_after is not None else self.backoff(attempt)
+                logger.warning("Domain responded %s. Retrying in %.2fs. URL: %s", res.status_code, wait, url)
+            time.sleep(wait)
+            
+    def search(self, data: dict):
+        """Posts a search query built with `build_query`"""
+        logger.debug("Making request to Domain. URL: %s/listings/residential/_search, Params: %s", self.base_url, data)
+        return self.request("POST", "/listings/residential/_search", kind=SEARCH, data=json.dumps(data),
+                            headers={"Content-Type": "application/json"})
+    
+    def get_listing(self, listing_id: int):
+        """Gets the full details of a listing"""
+        logger.debug("Making request to Domain for specific listing. URL: %s/listings/%s, listing_id: %s",
+                     self.base_url, listing_id, listing_id, extra=SAMPLED)
+        return self.request("GET", f"/listings/{listing_id}", kind=DETAIL)
+    
+    def close(self):
+        self.session.close()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(key: str, base_url: str = DOMAIN_API_URL) -> DomainClient:
+    """Gets the shared DomainClient for a key, creating it on first use.
+    Sharing the client means every call in the process reuses the same pool of open connections
+    and spends from the same daily request budget.
+
+    Args:
+        key (str): Authentication key
+        base_url (str, optional): Root of the Domain API. Defaults to DOMAIN_API_URL.
+
+    Returns:
+        DomainClient: client for the key
+    """
+    with _clients_lock:
+        if (key, base_url) not in _clients:
+            _clients[(key, base_url)] = DomainClient(key, base_url, budget=get_budget())
+        return _clients[(key, base_url)]
+
 def build_location_parameter(postcodes):
     locations = [{"postCode": postcode, "includeSurroundingSuburbs": False} for postcode in postcodes]
     return locations
@@ -45,45 +204,125 @@ def need_to_run_again(x_total_count, x_pagination_page_number, page_size):
     pages = ceil(x_total_count/page_size)
     return False if x_pagination_page_number == pages else True
 
-def get_listings_in_postcode(key: str, postcodes: list, page_size: int = 200, page_number = 1):
-    """Get the current listings by postcode from Domain
+def merge_search_pages(pages):
+    """Merges pages of search results into a single list of listings.
+    Pages are merged in the order given and any listing already seen on an earlier page
+    is dropped, as Domain can shuffle a listing across a page boundary between requests.
 
     Args:
-        key (str): Authentication key
-        postcode (str): Postcode you want to search in
-        pagesize (int): Max number of listings to return. 200 is the limit given by domain
+        pages (list): list of pages, each being the list of results returned by the search endpoint
 
     Returns:
         list: list of dicts for each listing
     """
-    data = build_query(postcodes, "Sale", page_size, page_number)
-    url = "https://api.domain.com.au/v1/listings/residential/_search"
-    do_another_search = True
+    seen_ids = set()
     listings = []
-    
-    while do_another_search:
-        # Make request
-        logger.debug(f"Making request to Domain. URL: {url}, Params: {data}")
-        res = requests.post(url, headers={"X-Api-Key": key}, data=json.dumps(data))
-        res_json = res.json()
-        # If a dict is returned the query likely failed
-        if type(res_json) is dict:
-            return res_json
-        else:
-            listings += res_json
-        # work out if another query is required
-        x_total_count = int(res.headers['X-Total-Count'])
-        x_pagination_page_number = int(res.headers['X-Pagination-PageNumber'])
-        do_another_search = need_to_run_again(x_total_count, x_pagination_page_number, page_size)
-        if do_another_search:
-            data['pageNumber'] += 1
-        
+    for page in pages:
+        for result in page:
+            listing_id = result['listing']['id'] if 'listing' in result else None
+            if listing_id is not None:
+                if listing_id in seen_ids:
+                    continue
+                seen_ids.add(listing_id)
+            listings.append(result)
     return listings
 
-def get_listing(key: str, listing_id: int):
-    url = f"https://api.domain.com.au/v1/listings/{listing_id}"
-    logger.debug(f"Making request to Domain for specific listing. URL: {url}, listing_id: {listing_id}")
-    res = requests.get(url, headers={"X-Api-Key": key})
+def search_page(client: DomainClient, data: dict):
+    """Posts a single page of a search to Domain
+
+    Args:
+        client (DomainClient): Client to make the request with
+        data (dict): Request body built with `build_query`
+
+    Returns:
+        Response: the response from Domain
+    """
+    return client.search(data)
+
+def iter_search_pages(client: DomainClient, postcodes: list, page_size: int = 200, page_number = 1,
+                      max_workers: int = 4):
+    """Yields the pages of a search in page order as they arrive from Domain.
+    The first page is requested on its own to learn the total number of listings from `X-Total-Count`,
+    then up to `max_workers` of the following pages are requested ahead of the page being yielded.
+
+    Args:
+        client (DomainClient): Client to make the requests with
+        postcodes (list): Postcodes you want to search in
+        page_size (int): Max number of listings to return per page. 200 is the limit given by domain
+        page_number (int): Page to start the search from. Defaults to 1.
+        max_workers (int): Max number of pages to request at once. Defaults to 4.
+
+    Yields:
+        list: the results on each page. If a request fails the dict Domain responded with is yielded instead
+            and no more pages follow
+    """
+    res = search_page(client, build_query(postcodes, "Sale", page_size, page_number))
+    res_json = res.json()
+    yield res_json
+    # If a dict is returned the query likely failed
+    if type(res_json) is dict:
+        return
+
+    # work out if more pages are required
+    x_total_count = int(res.headers['X-Total-Count'])
+    x_pagination_page_number = int(res.headers['X-Pagination-PageNumber'])
+    if not need_to_run_again(x_total_count, x_pagination_page_number, page_size):
+        return
+    remaining_pages = iter(range(x_pagination_page_number + 1, ceil(x_total_count/page_size) + 1))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def request(page):
+            return executor.submit(search_page, client, build_query(postcodes, "Sale", page_size, page))
+        # Only `max_workers` pages are waiting at once, so pages aren't held in memory faster than they're used
+        pending = deque(request(page) for page in islice(remaining_pages, max_workers))
+        while pending:
+            res_json = pending.popleft().result().json()
+            next_page = next(remaining_pages, None)
+            if next_page is not None:
+                pending.append(request(next_page))
+            yield res_json
+            if type(res_json) is dict:
+                return
+
+def get_listings_in_postcode(key: str, postcodes: list, page_size: int = 200, page_number = 1,
+                             max_workers: int = 4, base_url: str = DOMAIN_API_URL, client: DomainClient = None):
+    """Get the current listings by postcode from Domain.
+    The first page is requested on its own to learn the total number of listings from `X-Total-Count`,
+    the remaining pages are then requested concurrently and merged back together in page order.
+
+    Args:
+        key (str): Authentication key
+        postcodes (list): Postcodes you want to search in
+        page_size (int): Max number of listings to return per page. 200 is the limit given by domain
+        page_number (int): Page to start the search from. Defaults to 1.
+        max_workers (int): Max number of pages to request at once. Defaults to 4.
+        base_url (str, optional): Root of the Domain API. Defaults to DOMAIN_API_URL.
+        client (DomainClient, optional): Client to make the requests with. Defaults to the shared client for the key.
+
+    Returns:
+        list: list of dicts for each listing
+    """
+    client = client or get_client(key, base_url)
+    pages = []
+    for page in iter_search_pages(client, postcodes, page_size, page_number, max_workers):
+        if type(page) is dict:
+            return page
+        pages.append(page)
+    return merge_search_pages(pages)
+
+def get_listing(key: str, listing_id: int, base_url: str = DOMAIN_API_URL, client: DomainClient = None):
+    """Get the full details of a listing from Domain
+
+    Args:
+        key (str): Authentication key
+        listing_id (int): Id of the listing
+        base_url (str, optional): Root of the Domain API. Defaults to DOMAIN_API_URL.
+        client (DomainClient, optional): Client to make the request with. Defaults to the shared client for the key.
+
+    Returns:
+        dict: the raw listing
+    """
+    client = client or get_client(key, base_url)
+    res = client.get_listing(listing_id)
     return res.json()
     
 
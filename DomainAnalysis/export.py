@@ -0,0 +1,104 @@
+"""Streams the listings collection out of Mongo in fixed size chunks, so analysis can run in bounded
+memory however large the collection grows. Only the fields asked for are sent by Mongo.
+"""
+from datetime import date, datetime
+import pandas as pd
+import pyarrow as pa
+from DomainAnalysis.logger import logger
+
+DEFAULT_BATCH_SIZE = 5000
+
+def _as_iso(value):
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%dT%H:%M:%S")
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+def build_listings_filter(postcodes = None, listed_from = None, listed_before = None):
+    """Builds the Mongo query for the listings to export
+
+    Args:
+        postcodes (list, optional): Only listings in these postcodes. Defaults to None, all postcodes.
+        listed_from (date, optional): Only listings listed on or after this date. Defaults to None.
+        listed_before (date, optional): Only listings listed before this date. Defaults to None.
+
+    Returns:
+        dict: Mongo query
+    """
+    query = {}
+    if postcodes:
+        query['location_postcode'] = {"$in": [str(x) for x in postcodes]}
+    # dateListed is stored as an ISO 8601 string, so it sorts and compares as a date would
+    date_listed = {}
+    if listed_from is not None:
+        date_listed["$gte"] = _as_iso(listed_from)
+    if listed_before is not None:
+        date_listed["$lt"] = _as_iso(listed_before)
+    if date_listed:
+        query['dateListed'] = date_listed
+    return query
+
+def iter_listing_documents(coll, fields = None, batch_size = DEFAULT_BATCH_SIZE, query = None):
+    """Streams listing documents from Mongo in lists of at most `batch_size`
+
+    Args:
+        coll (Collection): Listings collection
+        fields (list, optional): Fields to return. Defaults to None, every field except `_id`.
+        batch_size (int, optional): Number of documents per chunk and per cursor batch. Defaults to DEFAULT_BATCH_SIZE.
+        query (dict, optional): Mongo query, see `build_listings_filter`. Defaults to None, every listing.
+
+    Yields:
+        list: documents
+    """
+    projection = {"_id": 0}
+    if fields is not None:
+        projection = {field: 1 for field in fields}
+        projection.setdefault("_id", 0)
+    cursor = coll.find(query or {}, projection, batch_size=batch_size)
+    chunk = []
+    total = 0
+    for document in cursor:
+        if '_id' in document:
+            document['_id'] = str(document['_id'])
+        chunk.append(document)
+        if len(chunk) == batch_size:
+            total += len(chunk)
+            yield chunk
+            chunk = []
+    if chunk:
+        total += len(chunk)
+        yield chunk
+    logger.debug("Exported %s listings from %s", total, coll.name)
+
+def iter_listing_frames(coll, fields = None, batch_size = DEFAULT_BATCH_SIZE, postcodes = None,
+                        listed_from = None, listed_before = None):
+    """Streams listings from Mongo as DataFrame chunks
+
+    Args:
+        coll (Collection): Listings collection
+        fields (list, optional): Columns to return. Defaults to None, every field except `_id`.
+        batch_size (int, optional): Max rows per DataFrame. Defaults to DEFAULT_BATCH_SIZE.
+        postcodes (list, optional): Only listings in these postcodes. Defaults to None, all postcodes.
+        listed_from (date, optional): Only listings listed on or after this date. Defaults to None.
+        listed_before (date, optional): Only listings listed before this date. Defaults to None.
+
+    Yields:
+        DataFrame: listings, with a column for each field in `fields` when given
+    """
+    query = build_listings_filter(postcodes, listed_from, listed_before)
+    for chunk in iter_listing_documents(coll, fields, batch_size, query):
+        yield pd.DataFrame.from_records(chunk, columns=fields)
+
+def iter_listing_record_batches(coll, fields = None, batch_size = DEFAULT_BATCH_SIZE, postcodes = None,
+                                listed_from = None, listed_before = None):
+    """Streams listings from Mongo as Arrow record batches. Arguments are the same as `iter_listing_frames`
+
+    Yields:
+        RecordBatch: listings
+    """
+    query = build_listings_filter(postcodes, listed_from, listed_before)
+    for chunk in iter_listing_documents(coll, fields, batch_size, query):
+        columns = fields or list(dict.fromkeys(k for document in chunk for k in document))
+        table = pa.Table.from_pydict({k: [document.get(k) for document in chunk] for k in columns})
+        yield from table.to_batches()
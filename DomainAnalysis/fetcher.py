@@ -0,0 +1,103 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from DomainAnalysis.domain_api import DomainClient
+from DomainAnalysis.logger import logger
+from DomainAnalysis.metrics import metrics
+from DomainAnalysis.prices import price_cache
+from DomainAnalysis.quota import QuotaExceeded
+from DomainAnalysis.wrangler import Listing
+
+REQUEST = "request"
+QUOTA = "quota"
+WRANGLE = "wrangle"
+
+def get_raw_listing(client: DomainClient, listing_id):
+    """Gets the raw details of a listing, raising a ValueError if Domain doesn't respond with them"""
+    res = client.get_listing(listing_id)
+    if res.status_code != 200:
+        raise ValueError(f"Domain responded {res.status_code}: {res.text[:200]}")
+    return res.json()
+
+async def _fetch_all(client: DomainClient, listing_ids: list, concurrency: int):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    raw_listings = {}
+    errors = {}
+
+    async def fetch(executor, listing_id):
+        async with semaphore:
+            try:
+                raw_listings[listing_id] = await loop.run_in_executor(executor, get_raw_listing, client, listing_id)
+            except QuotaExceeded as e:
+                errors[listing_id] = {'stage': QUOTA, 'error': str(e)}
+            except Exception as e:
+                errors[listing_id] = {'stage': REQUEST, 'error': str(e)}
+
+    # requests is blocking so each fetch runs on a thread, the semaphore bounds how many are in flight
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        await asyncio.gather(*[fetch(executor, listing_id) for listing_id in listing_ids])
+    return raw_listings, errors
+
+def fetch_listing_details(client: DomainClient, listing_ids: list, concurrency: int = 8):
+    """Gets the raw details of many listings from Domain at once
+
+    Args:
+        client (DomainClient): Client to make the requests with
+        listing_ids (list): Ids of the listings to get
+        concurrency (int, optional): Max number of requests in flight. Defaults to 8.
+
+    Returns:
+        tuple: dict of raw listings by listing_id, and a dict of errors by listing_id.
+            Each error has the `stage` it failed in and the `error` message.
+    """
+    listing_ids = list(dict.fromkeys(listing_ids))
+    if not listing_ids:
+        return {}, {}
+    return asyncio.run(_fetch_all(client, listing_ids, concurrency))
+
+def fetch_listings(client: DomainClient, listing_ids: list, concurrency: int = 8):
+    """Gets the details of many listings from Domain at once and wrangles them into Listings
+
+    Args:
+        client (DomainClient): Client to make the requests with
+        listing_ids (list): Ids of the listings to get
+        concurrency (int, optional): Max number of requests in flight. Defaults to 8.
+
+    Returns:
+        tuple: list of Listings in the order of `listing_ids`, and a dict of errors by listing_id.
+            Each error has the `stage` it failed in and the `error` message.
+    """
+    listing_ids = list(dict.fromkeys(listing_ids))
+    raw_listings, errors = fetch_listing_details(client, listing_ids, concurrency)
+    return wrangle_listings(listing_ids, raw_listings, errors)
+
+def wrangle_listings(listing_ids: list, raw_listings: dict, errors: dict = None):
+    """Wrangles raw listings into Listings, recording any that fail alongside the errors from fetching them
+
+    Args:
+        listing_ids (list): Ids of the listings, in the order the Listings should be returned
+        raw_listings (dict): Raw listings by listing_id, from `fetch_listing_details`
+        errors (dict, optional): Errors by listing_id from `fetch_listing_details`. Defaults to None.
+
+    Returns:
+        tuple: list of Listings, and a dict of errors by listing_id, see `fetch_listings`
+    """
+    errors = dict(errors or {})
+    listings = []
+    for listing_id in listing_ids:
+        if listing_id not in raw_listings:
+            continue
+        try:
+            with metrics.timer("wrangle_seconds"):
+                listings.append(Listing(raw_listings[listing_id]))
+        except Exception as e:
+            errors[listing_id] = {'stage': WRANGLE, 'error': str(e)}
+    metrics.inc("listings_wrangled_total", len(listings), outcome="succeeded")
+    metrics.inc("listings_wrangled_total", sum(x['stage'] == WRANGLE for x in errors.values()), outcome="failed")
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Display price cache: %s", price_cache.info())
+    if errors:
+        logger.warning("Unable to get %s of %s listings", len(errors), len(listing_ids))
+    return listings, errors
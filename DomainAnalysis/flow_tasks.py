@@ -0,0 +1,76 @@
+"""Prefect tasks shared by the flows in `flows/`. Each flow file builds and runs its flow when it's run,
+so the tasks more than one flow needs live here to be imported by all of them.
+"""
+from prefect import task
+from DomainAnalysis.domain_api import get_client
+from DomainAnalysis.journal import get_journal, ENDED
+from DomainAnalysis.logger import logger
+from DomainAnalysis.metrics import time_flow_stage, write_run_metrics
+from DomainAnalysis.mongo import (connect_to_mongo_db, connect_to_domain_snapshots, connect_to_domain_runs,
+                                  connect_to_domain_listings, connect_to_domain_details,
+                                  ensure_listing_indexes, ensure_geo_index)
+from DomainAnalysis.quota import get_budget
+from DomainAnalysis.sold import detect_ended_listings
+from DomainAnalysis.snapshots import ensure_snapshot_indexes, ensure_detail_indexes
+
+@task(state_handlers=[time_flow_stage])
+def connect_to_mongo(db_user, db_password):
+    """Connects to domain analysis mongo db and makes sure the indexes the flows rely on exist
+
+    Args:
+        db_user (str): username
+        db_password (str): MongoDB password
+
+    Returns:
+        client: MongoDB database
+    """
+    client = connect_to_mongo_db(db_user, db_password)
+    ensure_listing_indexes(connect_to_domain_listings(client))
+    ensure_geo_index(connect_to_domain_listings(client))
+    ensure_snapshot_indexes(connect_to_domain_snapshots(client), connect_to_domain_runs(client))
+    ensure_detail_indexes(connect_to_domain_details(client))
+    return client
+
+@task(state_handlers=[time_flow_stage])
+def start_or_resume_run():
+    """Resumes the last run if it died part way through, otherwise starts a new run, see `DomainAnalysis.journal`.
+    Listings a run too old to resume planned to fetch but didn't are deferred to this run.
+    """
+    run_id, unfetched = get_journal().start_run()
+    if unfetched:
+        get_budget().defer(unfetched)
+    return run_id
+
+@task(state_handlers=[time_flow_stage])
+def check_for_ended_listings(client, domain_key, run_id):
+    """Checks whether the listings that left today's search were sold or withdrawn, with whatever
+    request budget is left after getting the details of new and updated listings. The result is kept
+    in the run journal so a run that's retried doesn't spend its budget checking them again.
+    """
+    journal = get_journal()
+    if journal.is_complete(run_id, ENDED):
+        return journal.stage_result(run_id, ENDED)
+    summary = detect_ended_listings(connect_to_domain_listings(client), connect_to_domain_runs(client),
+                                    get_client(domain_key), run_id, get_budget())
+    journal.complete_stage(run_id, ENDED, summary)
+    return summary
+
+@task(state_handlers=[time_flow_stage])
+def report_request_budget():
+    metrics = get_budget().metrics()
+    logger.info("Domain request budget: %s of %s used today (%s search, %s detail), %s remaining, %s listings deferred",
+                metrics['used'], metrics['daily_limit'], metrics['used_search'], metrics['used_detail'],
+                metrics['remaining'], metrics['deferred'])
+    return metrics
+
+@task
+def report_metrics(run_id):
+    """Writes the timings and counts of everything the run did, see `DomainAnalysis.metrics`"""
+    path = write_run_metrics(run_id)
+    logger.info("Wrote the metrics of run %s to %s", run_id, path)
+    return path
+
+@task(state_handlers=[time_flow_stage])
+def finish_run(run_id):
+    """Marks the run finished in the journal so the next run starts afresh"""
+    get_journal().finish_run(run_id)
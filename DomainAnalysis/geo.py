@@ -0,0 +1,205 @@
+"""Distance from listings to the nearest amenity, e.g. the beach or a supermarket.
+
+Each set of amenity points is loaded from a local file into a KD-tree of points on the unit sphere.
+The straight line (chord) distance between two points on the sphere only grows as the great circle
+distance grows, so the nearest point by chord is the nearest point by great circle distance, and the
+chord converts exactly to the haversine distance. The distances for a whole batch of listings are
+found in one query of the tree.
+
+Run as a batch command to store the distance from every stored listing to each kind of amenity in a
+directory of amenity files (`AMENITY_DIR`, defaults to "amenities") as `distance_to_<name>_km`. Rerun it
+when the amenity files change or after new listings are stored.
+
+Usage:
+    python -m DomainAnalysis.geo [--amenity-dir amenities] [--batch-size 500]
+"""
+import argparse
+import csv
+import json
+import os
+import numpy as np
+import pandas as pd
+from pymongo import UpdateOne
+from scipy.spatial import cKDTree
+from DomainAnalysis.logger import logger
+from DomainAnalysis.mongo import (EARTH_RADIUS_KM, BULK_WRITE_BATCH_SIZE, chunked, connect_to_mongo_db,
+                                  connect_to_domain_listings)
+
+AMENITY_FILE_TYPES = (".csv", ".geojson")
+
+def to_unit_vectors(latitudes, longitudes):
+    """Converts latitudes and longitudes in degrees to an (n, 3) array of points on the unit sphere"""
+    latitudes = np.radians(np.asarray(latitudes, dtype=float))
+    longitudes = np.radians(np.asarray(longitudes, dtype=float))
+    cos_latitudes = np.cos(latitudes)
+    return np.column_stack([cos_latitudes * np.cos(longitudes), cos_latitudes * np.sin(longitudes), np.sin(latitudes)])
+
+def chord_to_km(chord):
+    """Converts the chord between points on the unit sphere to the great circle distance in km"""
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))
+
+def km_to_chord(km):
+    return 2 * np.sin(np.asarray(km) / (2 * EARTH_RADIUS_KM))
+
+def _points_from_geojson(geojson):
+    """Gets every coordinate in a GeoJSON object as (latitude, longitude). Lines, e.g. a coastline,
+    give the points along them so they should be sampled densely enough for the accuracy needed.
+    """
+    if geojson['type'] == 'FeatureCollection':
+        for feature in geojson['features']:
+            yield from _points_from_geojson(feature)
+    elif geojson['type'] == 'Feature':
+        yield from _points_from_geojson(geojson['geometry'])
+    elif geojson['type'] == 'GeometryCollection':
+        for geometry in geojson['geometries']:
+            yield from _points_from_geojson(geometry)
+    else:
+        coordinates = np.asarray(geojson['coordinates'], dtype=float).reshape(-1, 2)
+        for longitude, latitude in coordinates:
+            yield latitude, longitude
+
+class AmenityIndex():
+    """Spatial index of a set of amenity points for finding the nearest amenity to many locations at once
+
+    Args:
+        latitudes (array): Latitude of each amenity in degrees
+        longitudes (array): Longitude of each amenity in degrees
+        names (list, optional): Name of each amenity. Defaults to None.
+    """
+    def __init__(self, latitudes, longitudes, names = None) -> None:
+        self.latitudes = np.asarray(latitudes, dtype=float)
+        self.longitudes = np.asarray(longitudes, dtype=float)
+        if len(self.latitudes) == 0:
+            raise ValueError("An amenity index needs at least one point")
+        self.names = list(names) if names is not None else None
+        self.tree = cKDTree(to_unit_vectors(self.latitudes, self.longitudes))
+
+    @classmethod
+    def from_file(cls, path):
+        """Loads amenities from a CSV with `latitude`, `longitude` and optionally `name` columns,
+        or from a GeoJSON file
+        """
+        if path.endswith(".geojson"):
+            with open(path) as infile:
+                points = np.array(list(_points_from_geojson(json.load(infile))), dtype=float).reshape(-1, 2)
+            return cls(points[:, 0], points[:, 1])
+        with open(path, newline="") as infile:
+            rows = list(csv.DictReader(infile))
+        names = [x['name'] for x in rows] if rows and 'name' in rows[0] else None
+        return cls([x['latitude'] for x in rows], [x['longitude'] for x in rows], names)
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    def nearest(self, latitudes, longitudes):
+        """Finds the nearest amenity to each location
+
+        Args:
+            latitudes (array): Latitudes in degrees, NaN where a location is unknown
+            longitudes (array): Longitudes in degrees, NaN where a location is unknown
+
+        Returns:
+            tuple: array of distances in km and array of the index of the nearest amenity.
+                Unknown locations have a NaN distance and an index of -1
+        """
+        points = to_unit_vectors(latitudes, longitudes)
+        known = ~np.isnan(points).any(axis=1)
+        distances = np.full(len(points), np.nan)
+        indices = np.full(len(points), -1, dtype=np.int64)
+        if known.any():
+            chords, nearest = self.tree.query(points[known])
+            distances[known] = chord_to_km(chords)
+            indices[known] = nearest
+        return distances, indices
+
+    def count_within(self, latitudes, longitudes, km):
+        """Counts the amenities within `km` of each location, 0 where a location is unknown"""
+        points = to_unit_vectors(latitudes, longitudes)
+        known = ~np.isnan(points).any(axis=1)
+        counts = np.zeros(len(points), dtype=np.int64)
+        if known.any():
+            counts[known] = [len(x) for x in self.tree.query_ball_point(points[known], float(km_to_chord(km)))]
+        return counts
+
+def load_amenity_indexes(directory):
+    """Loads every amenity file in a directory, named after the file, e.g. `supermarket.csv` is `supermarket`
+
+    Returns:
+        dict: AmenityIndex by name
+    """
+    indexes = {}
+    for filename in sorted(os.listdir(directory)):
+        name, extension = os.path.splitext(filename)
+        if extension in AMENITY_FILE_TYPES:
+            indexes[name] = AmenityIndex.from_file(os.path.join(directory, filename))
+            logger.debug("Loaded %s %s amenities from %s", len(indexes[name]), name, filename)
+    return indexes
+
+def amenity_distances(latitudes, longitudes, indexes):
+    """Distance from each location to the nearest of each kind of amenity
+
+    Args:
+        latitudes (array): Latitudes in degrees
+        longitudes (array): Longitudes in degrees
+        indexes (dict): AmenityIndex by name, see `load_amenity_indexes`
+
+    Returns:
+        DataFrame: a `distance_to_<name>_km` column for each amenity index
+    """
+    return pd.DataFrame({f"distance_to_{name}_km": index.nearest(latitudes, longitudes)[0]
+                         for name, index in indexes.items()})
+
+def add_amenity_distances(frame, indexes, latitude = "location_latitude", longitude = "location_longitude"):
+    """Adds the distance to the nearest of each kind of amenity to a frame of listings
+
+    Args:
+        frame (DataFrame): Listings, e.g. from `raw_listings_to_frame` or `load_listings`
+        indexes (dict): AmenityIndex by name, see `load_amenity_indexes`
+        latitude (str, optional): Latitude column. Defaults to "location_latitude".
+        longitude (str, optional): Longitude column. Defaults to "location_longitude".
+
+    Returns:
+        DataFrame: a copy of `frame` with a `distance_to_<name>_km` column for each amenity index
+    """
+    distances = amenity_distances(frame[latitude].astype(float).to_numpy(),
+                                  frame[longitude].astype(float).to_numpy(), indexes)
+    distances.index = frame.index
+    return pd.concat([frame, distances], axis=1)
+
+def store_amenity_distances(coll, indexes, batch_size = BULK_WRITE_BATCH_SIZE):
+    """Stores the distance to the nearest of each kind of amenity on every stored listing with coordinates
+
+    Args:
+        coll (Collection): Listings collection
+        indexes (dict): AmenityIndex by name, see `load_amenity_indexes`
+        batch_size (int, optional): Number of listings per bulk_write. Defaults to BULK_WRITE_BATCH_SIZE.
+
+    Returns:
+        int: Number of listings updated
+    """
+    query = {"location_latitude": {"$ne": None}, "location_longitude": {"$ne": None}}
+    project = {"location_latitude": 1, "location_longitude": 1}
+    updated = 0
+    for batch in chunked(coll.find(query, project), batch_size):
+        frame = add_amenity_distances(pd.DataFrame(batch), indexes)
+        columns = [f"distance_to_{name}_km" for name in indexes]
+        operations = [UpdateOne({"_id": x['_id']}, {"$set": {k: float(x[k]) for k in columns}})
+                      for x in frame[['_id'] + columns].to_dict("records")]
+        updated += coll.bulk_write(operations, ordered=False).modified_count
+    logger.info("Stored the distance to %s amenities on %s listings", ", ".join(indexes), updated)
+    return updated
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--amenity-dir", default=os.environ.get("AMENITY_DIR", "amenities"),
+                        help="Directory of amenity files, see `load_amenity_indexes`")
+    parser.add_argument("--batch-size", type=int, default=BULK_WRITE_BATCH_SIZE, help="Listings per bulk_write")
+    args = parser.parse_args(argv)
+    indexes = load_amenity_indexes(args.amenity_dir)
+    if not indexes:
+        logger.critical("No amenity files found in %s", args.amenity_dir)
+        raise ValueError(f"No amenity files found in {args.amenity_dir}")
+    return store_amenity_distances(connect_to_domain_listings(connect_to_mongo_db()), indexes, args.batch_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Journal of the stages each run has completed and the listings it has fetched, kept in a SQLite file so
+a run that dies part way through is resumed by the next run rather than started again.
+
+A run is started with `RunJournal.start_run`, which hands back the unfinished run if there is one. The
+search results are read back from the snapshot store once they've been stored (see
+`DomainAnalysis.snapshots.read_run_listings`), the detail requests planned by the run are reused rather than
+planned again, and each listing is recorded as its raw details are stored so its details are read back from
+the `details` collection instead of being requested again. A resumed run makes no request Domain has
+already answered.
+
+An unfinished run older than `max_age` is abandoned rather than resumed, as its search is out of date. The
+listings it planned to fetch but didn't are handed back to be deferred to the next run.
+
+The streaming and sharded flows resume runs the same way but journal their stream as a whole, as SEARCHED and
+DETAILED once it's finished, since it searches and fetches at once. A stream that died part way is streamed
+again under the same run id. Its stored snapshots are kept and the listings it stored are no longer new, so
+only the listings it didn't get to are requested.
+
+Set `RUN_JOURNAL_DB` (defaults to run_journal.db) in the environment.
+"""
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from DomainAnalysis.fetcher import fetch_listing_details
+from DomainAnalysis.logger import logger
+from DomainAnalysis.mongo import chunked
+from DomainAnalysis.quota import immediate_transaction
+from DomainAnalysis.snapshots import new_run_id, read_raw_details, store_raw_details
+
+# Stages of the flow recorded in the journal
+SEARCHED = "searched"
+PLANNED = "planned"
+DETAILED = "detailed"
+ENDED = "ended"
+
+RUNNING = "running"
+FINISHED = "finished"
+ABANDONED = "abandoned"
+
+# Listings fetched between each checkpoint
+CHECKPOINT_SIZE = 50
+
+class RunJournal():
+    """Records the stages each run has completed and the listings it has fetched
+
+    Args:
+        path (str, optional): SQLite file to keep the journal in. Defaults to "run_journal.db".
+        max_age (timedelta, optional): Unfinished runs older than this are abandoned rather than resumed.
+            Defaults to 12 hours.
+    """
+    def __init__(self, path: str = "run_journal.db", max_age: timedelta = timedelta(hours=12)) -> None:
+        self.path = path
+        self.max_age = max_age
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, started TEXT, status TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS stages "
+                         "(run_id TEXT, stage TEXT, completed TEXT, result TEXT, PRIMARY KEY (run_id, stage))")
+            conn.execute("CREATE TABLE IF NOT EXISTS fetched (run_id TEXT, listing_id INTEGER, PRIMARY KEY (run_id, listing_id))")
+
+    def _connect(self):
+        return immediate_transaction(self.path)
+
+    def start_run(self):
+        """Resumes the unfinished run, or starts a new one if there isn't one
+
+        Returns:
+            tuple: the run id, and the listing ids planned but not fetched by any run abandoned
+                for being older than `max_age`, which should be deferred to the next run
+        """
+        now = datetime.now(timezone.utc)
+        unfetched = []
+        with self._connect() as conn:
+            unfinished = conn.execute("SELECT run_id, started FROM runs WHERE status = ? ORDER BY run_id",
+                                      (RUNNING,)).fetchall()
+            for run_id, started in unfinished:
+                if now - datetime.fromisoformat(started) <= self.max_age:
+                    logger.info("Resuming run %s, started %s", run_id, started)
+                    return run_id, unfetched
+                run_unfetched = self._unfetched(conn, run_id)
+                unfetched += run_unfetched
+                conn.execute("UPDATE runs SET status = ? WHERE run_id = ?", (ABANDONED, run_id))
+                logger.warning("Abandoning run %s, started %s, %s planned listings weren't fetched",
+                               run_id, started, len(run_unfetched))
+            run_id = new_run_id()
+            conn.execute("INSERT INTO runs (run_id, started, status) VALUES (?, ?, ?)", (run_id, now.isoformat(), RUNNING))
+        return run_id, unfetched
+
+    def _unfetched(self, conn, run_id):
+        row = conn.execute("SELECT result FROM stages WHERE run_id = ? AND stage = ?", (run_id, PLANNED)).fetchone()
+        fetched = {x[0] for x in conn.execute("SELECT listing_id FROM fetched WHERE run_id = ?", (run_id,))}
+        return [x for x in json.loads(row[0]) if x not in fetched] if row else []
+
+    def finish_run(self, run_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute("UPDATE runs SET status = ? WHERE run_id = ?", (FINISHED, run_id))
+
+    def status(self, run_id: str) -> str:
+        """RUNNING, FINISHED or ABANDONED, None if the run isn't in the journal"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT status FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        return row[0] if row else None
+
+    def complete_stage(self, run_id: str, stage: str, result = None) -> None:
+        """Records that a stage of a run has completed, along with its result if it's needed to resume
+
+        Args:
+            run_id (str): Id of the run
+            stage (str): Name of the stage, e.g. SEARCHED
+            result (optional): JSON serialisable result of the stage. Defaults to None.
+        """
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO stages (run_id, stage, completed, result) VALUES (?, ?, ?, ?)",
+                         (run_id, stage, datetime.now(timezone.utc).isoformat(), json.dumps(result)))
+
+    def is_complete(self, run_id: str, stage: str) -> bool:
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM stages WHERE run_id = ? AND stage = ?", (run_id, stage)).fetchone() is not None
+
+    def stage_result(self, run_id: str, stage: str):
+        """Result a stage of a run completed with, None if it hasn't completed"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT result FROM stages WHERE run_id = ? AND stage = ?", (run_id, stage)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def record_fetched(self, run_id: str, listing_ids: list) -> None:
+        """Records listings whose raw details have been stored by a run"""
+        with self._connect() as conn:
+            conn.executemany("INSERT OR IGNORE INTO fetched (run_id, listing_id) VALUES (?, ?)",
+                             [(run_id, listing_id) for listing_id in listing_ids])
+
+    def fetched(self, run_id: str) -> set:
+        """Listings whose raw details have been stored by a run"""
+        with self._connect() as conn:
+            return {x[0] for x in conn.execute("SELECT listing_id FROM fetched WHERE run_id = ?", (run_id,))}
+
+def get_journal() -> RunJournal:
+    """Gets the run journal kept at `RUN_JOURNAL_DB`, or "run_journal.db" if that isn't set"""
+    return RunJournal(os.environ.get("RUN_JOURNAL_DB", "run_journal.db"))
+
+def fetch_journaled_details(journal: RunJournal, run_id: str, client, details, listing_ids: list,
+                            concurrency: int = 8, checkpoint_size: int = CHECKPOINT_SIZE):
+    """Gets the raw details of listings for a run, storing them and recording them in the journal every
+    `checkpoint_size` listings. Listings the run has already fetched are read from the details collection
+    rather than requested again.
+
+    Args:
+        journal (RunJournal): Journal of the run
+        run_id (str): Id of the run
+        client (DomainClient): Client to make the requests with
+        details (Collection): Details collection
+        listing_ids (list): Ids of the listings to get
+        concurrency (int, optional): Max number of requests in flight. Defaults to 8.
+        checkpoint_size (int, optional): Listings fetched between each checkpoint. Defaults to CHECKPOINT_SIZE.
+
+    Returns:
+        tuple: dict of raw listings by listing_id, and a dict of errors by listing_id, see `fetch_listing_details`
+    """
+    listing_ids = list(dict.fromkeys(listing_ids))
+    fetched = journal.fetched(run_id)
+    raw_listings = read_raw_details(details, [x for x in listing_ids if x in fetched])
+    to_fetch = [x for x in listing_ids if x not in raw_listings]
+    if raw_listings:
+        logger.info("Resuming run %s: %s listings already fetched, %s to go", run_id, len(raw_listings), len(to_fetch))
+    errors = {}
+    for chunk in chunked(to_fetch, checkpoint_size):
+        chunk_listings, chunk_errors = fetch_listing_details(client, chunk, concurrency)
+        store_raw_details(details, chunk_listings)
+        journal.record_fetched(run_id, list(chunk_listings))
+        raw_listings.update(chunk_listings)
+        errors.update(chunk_errors)
+    return raw_listings, errors
@@ -1,23 +1,186 @@
+"""The package's logger.
+
+Records are put on a queue by the thread that logs them and written out by a background thread,
+so logging never waits on the disk or console. The log file has one JSON object per line, with any
+`extra` fields a record was logged with, and the console gets readable lines.
+
+Messages take %-style arguments, e.g. `logger.debug("Got listing %s", listing_id)`, so they're only
+formatted when the record is actually written. Messages logged once per listing at debug level pass
+`extra=SAMPLED`, and only one in every `LOG_SAMPLE_EVERY` of each such message is written.
+
+Set `LOG_LEVEL` for the console (defaults to INFO), `LOG_FILE` for the log file (defaults to scraper.log)
+and `LOG_SAMPLE_EVERY` (defaults to 100) in the environment.
+"""
+import atexit
+import copy
+import json
 import logging
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing.util import Finalize, register_after_fork
+
+LOGGER_NAME = __name__
+TEXT_FORMAT = "%(asctime)s [%(levelname)s]: %(message)s"
+SAMPLE_EVERY = 100
+# Pass as `extra` to sample a message, e.g. `logger.debug("Got listing %s", listing_id, extra=SAMPLED)`
+SAMPLED = {"sampled": True}
+
+# Attributes every record has, anything else on a record was passed in `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listeners = {}
+_lock = threading.Lock()
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single line JSON object"""
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'function': record.funcName,
+            'line': record.lineno,
+            'process': record.process,
+            'thread': record.threadName
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in _RECORD_ATTRIBUTES})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Keeps one in every `every` records of each sampled message at or below `level`.
+    Records are sampled when they're logged with `extra=SAMPLED`, everything else is kept.
+
+    Args:
+        every (int, optional): Keep one in this many of each message. Defaults to SAMPLE_EVERY.
+        level (int, optional): Only sample records at or below this level. Defaults to DEBUG.
+    """
+    def __init__(self, every: int = SAMPLE_EVERY, level: int = logging.DEBUG) -> None:
+        super().__init__()
+        self.every = every
+        self.level = level
+        self._counts = {}
+        self._lock = threading.Lock()
 
-from requests.api import get
+    def filter(self, record):
+        if self.every <= 1 or record.levelno > self.level or not getattr(record, "sampled", False):
+            return True
+        # Counted per message template so a rare message isn't drowned out by a common one
+        with self._lock:
+            count = self._counts.get(record.msg, 0)
+            self._counts[record.msg] = count + 1
+        return count % self.every == 0
 
-def get_logger(filepath = "scraper.log", filepath_level = logging.INFO, console_level = logging.DEBUG):
-    mylogs = logging.getLogger(__name__)
-    mylogs.setLevel(logging.DEBUG)
+class LazyQueueHandler(QueueHandler):
+    """Puts records on the queue with their message formatted, as the arguments may change before the
+    listener gets to them, but leaves the rest of the formatting to the listener's thread
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
 
-    file = logging.FileHandler(filepath)
-    fileformat = logging.Formatter("%(asctime)s [%(levelname)s]: %(message)s")
-    file.setLevel(filepath_level)
-    file.setFormatter(fileformat)
+def _level(name, default):
+    level = logging.getLevelName(str(os.environ.get(name, default)).upper())
+    return level if isinstance(level, int) else logging.getLevelName(default)
 
-    stream = logging.StreamHandler()
-    streamformat = logging.Formatter("%(asctime)s [%(levelname)s]: %(message)s")
-    stream.setLevel(console_level)
-    stream.setFormatter(streamformat)
+def get_logger(filepath = None, filepath_level = logging.INFO, console_level = None, sample_every = None,
+               name = LOGGER_NAME):
+    """Gets the logger, setting it up the first time it's asked for. Later calls return the same
+    logger as is, whatever they're passed, including after `stop_logging`.
 
-    mylogs.addHandler(file)
-    mylogs.addHandler(stream)
+    Args:
+        filepath (str, optional): File to write JSON lines to. Defaults to `LOG_FILE` or "scraper.log".
+        filepath_level (int, optional): Lowest level written to the file. Defaults to INFO.
+        console_level (int, optional): Lowest level written to the console. Defaults to `LOG_LEVEL` or INFO.
+        sample_every (int, optional): Keep one in this many of each sampled message. Defaults to `LOG_SAMPLE_EVERY` or 100.
+        name (str, optional): Name of the logger. Defaults to LOGGER_NAME.
+
+    Returns:
+        Logger: the logger
+    """
+    mylogs = logging.getLogger(name)
+    with _lock:
+        if name in _listeners or mylogs.handlers:
+            return mylogs
+        filepath = filepath or os.environ.get("LOG_FILE", "scraper.log")
+        console_level = console_level if console_level is not None else _level("LOG_LEVEL", "INFO")
+        sample_every = sample_every or int(os.environ.get("LOG_SAMPLE_EVERY", SAMPLE_EVERY))
+        # Records below both handlers' levels aren't even created
+        mylogs.setLevel(min(filepath_level, console_level))
+
+        file = logging.FileHandler(filepath)
+        file.setLevel(filepath_level)
+        file.setFormatter(JsonFormatter())
+
+        stream = logging.StreamHandler()
+        stream.setLevel(console_level)
+        stream.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+        # Sampled records are dropped before they're queued
+        mylogs.addFilter(SamplingFilter(sample_every))
+        records = queue.Queue()
+        listener = QueueListener(records, file, stream, respect_handler_level=True)
+        listener.start()
+        _listeners[name] = listener
+        mylogs.addHandler(LazyQueueHandler(records))
     return mylogs
 
-logger = get_logger()
\ No newline at end of file
+def stop_logging(name = LOGGER_NAME):
+    """Writes out every queued record and stops the background thread of a logger. Anything logged
+    afterwards, e.g. while the interpreter shuts down, is written by the handlers straight away.
+    """
+    with _lock:
+        listener = _listeners.pop(name, None)
+        if listener is None:
+            return
+        mylogs = logging.getLogger(name)
+        for output in listener.handlers:
+            mylogs.addHandler(output)
+        for handler in [x for x in mylogs.handlers if isinstance(x, LazyQueueHandler)]:
+            mylogs.removeHandler(handler)
+        listener.stop()
+
+def _restart_logging_after_fork():
+    """The listener's thread doesn't survive a fork, so a child process starts a listener of its own on a
+    new queue, leaving any records the parent had queued to the parent
+    """
+    global _lock
+    # Another thread may have held the lock when the process forked
+    _lock = threading.Lock()
+    for name, listener in list(_listeners.items()):
+        records = queue.Queue()
+        for handler in logging.getLogger(name).handlers:
+            if isinstance(handler, LazyQueueHandler):
+                handler.queue = records
+        _listeners[name] = QueueListener(records, *listener.handlers,
+                                         respect_handler_level=listener.respect_handler_level)
+        _listeners[name].start()
+
+def _stop_logging_at_worker_exit(_):
+    # Workers started by multiprocessing exit without running atexit, but do run its finalizers
+    Finalize(None, _stop_all_logging, exitpriority=0)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_logging_after_fork)
+
+@atexit.register
+def _stop_all_logging():
+    for name in list(_listeners):
+        stop_logging(name)
+
+logger = get_logger()
+register_after_fork(logger, _stop_logging_at_worker_exit)
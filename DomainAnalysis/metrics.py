@@ -0,0 +1,226 @@
+"""Counters and timing histograms of where a run spends its time, e.g. every request to Domain,
+every command sent to Mongo and every listing wrangled.
+
+Metrics are kept in memory by the shared `metrics` registry, named and labelled the way Prometheus
+names them, e.g. `domain_request_seconds{kind="detail"}`. At the end of a run they're written as a
+JSON summary with the latency percentiles of each histogram, which can be compared between runs,
+and optionally as a Prometheus text file for the node exporter's textfile collector.
+
+Every observation of a histogram is kept until `reset` so percentiles are exact, a run makes tens of
+thousands of observations at most.
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_right
+from contextlib import contextmanager
+from functools import wraps
+from pymongo import monitoring
+
+# Upper bounds in seconds of the buckets of histograms in the Prometheus output
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PERCENTILES = (50, 90, 99)
+METRICS_DIR = "metrics"
+
+def percentile(values, q):
+    """Percentile of sorted values, interpolating between the closest two
+
+    Args:
+        values (list): sorted values
+        q (float): percentile between 0 and 100
+
+    Returns:
+        float: the percentile, None if there are no values
+    """
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(key, extra = ()):
+    labels = list(key) + list(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+class Metrics():
+    """Thread safe registry of counters and histograms
+
+    Args:
+        buckets (tuple, optional): Upper bounds of histogram buckets in the Prometheus output. Defaults to DEFAULT_BUCKETS.
+    """
+    def __init__(self, buckets = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Adds to a counter"""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Records an observation in a histogram"""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._histograms.setdefault(key, []).append(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observes the seconds taken by the body of a `with` block, whether it succeeds or not"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name: str, **labels):
+        """Decorator observing the seconds taken by every call of a function"""
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def counter(self, name: str, **labels) -> float:
+        """Current value of a counter, 0 if it's never been added to"""
+        with self._lock:
+            return self._counters.get((name, _label_key(labels)), 0)
+
+    def values(self, name: str, **labels) -> list:
+        """Observations of a histogram"""
+        with self._lock:
+            return list(self._histograms.get((name, _label_key(labels)), []))
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def summary(self) -> dict:
+        """Summary of every metric, ready to be dumped as JSON
+
+        Returns:
+            dict: `counters` and `histograms`, each a list of dicts with the `name` and `labels` of the metric.
+                Counters have their `value`, histograms their `count`, `sum`, `min`, `max` and p50/p90/p99
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: sorted(v) for k, v in self._histograms.items()}
+        summary = {'counters': [], 'histograms': []}
+        for (name, key), value in sorted(counters.items()):
+            summary['counters'].append({'name': name, 'labels': dict(key), 'value': value})
+        for (name, key), values in sorted(histograms.items()):
+            histogram = {'name': name, 'labels': dict(key), 'count': len(values), 'sum': sum(values),
+                         'min': values[0] if values else None, 'max': values[-1] if values else None}
+            histogram.update({f"p{q}": percentile(values, q) for q in PERCENTILES})
+            summary['histograms'].append(histogram)
+        return summary
+
+    def to_prometheus(self) -> str:
+        """Every metric in the Prometheus text exposition format"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: sorted(v) for k, v in self._histograms.items()}
+        lines = []
+        typed = set()
+        for (name, key), value in sorted(counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_format_labels(key)} {value}")
+        for (name, key), values in sorted(histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound in self.buckets:
+                # Buckets are cumulative, counting every value less than or equal to their bound
+                lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {bisect_right(values, bound)}")
+            lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {len(values)}")
+            lines.append(f"{name}_sum{_format_labels(key)} {sum(values)}")
+            lines.append(f"{name}_count{_format_labels(key)} {len(values)}")
+        return "\n".join(lines) + "\n"
+
+    def write_summary(self, path: str, **extra) -> str:
+        """Writes the JSON summary to a file, along with any `extra` fields such as the run id
+
+        Returns:
+            str: the path written to
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as outfile:
+            json.dump(dict(extra, **self.summary()), outfile, indent=2, default=str)
+        return path
+
+    def write_prometheus(self, path: str) -> str:
+        """Writes the Prometheus text to a file, replacing it in one step so a scrape never sees half a file
+
+        Returns:
+            str: the path written to
+        """
+        with open(path + ".tmp", "w") as outfile:
+            outfile.write(self.to_prometheus())
+        os.replace(path + ".tmp", path)
+        return path
+
+metrics = Metrics()
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Records the time taken by, and the number of, every command sent to Mongo, i.e. every round trip.
+    Pass to the client with `MongoClient(..., event_listeners=[MongoCommandMetrics()])`.
+
+    Args:
+        registry (Metrics, optional): Registry to record to. Defaults to the shared `metrics`.
+    """
+    def __init__(self, registry: Metrics = None) -> None:
+        self.registry = registry or metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.registry.observe("mongo_command_seconds", event.duration_micros / 1e6, command=event.command_name)
+        self.registry.inc("mongo_commands_total", command=event.command_name, outcome="succeeded")
+
+    def failed(self, event):
+        self.registry.observe("mongo_command_seconds", event.duration_micros / 1e6, command=event.command_name)
+        self.registry.inc("mongo_commands_total", command=event.command_name, outcome="failed")
+
+def time_flow_stage(task, old_state, new_state):
+    """Prefect state handler observing the seconds each task of the flow takes in `flow_stage_seconds`"""
+    if new_state.is_running():
+        task._metrics_started = time.perf_counter()
+    elif new_state.is_finished() and getattr(task, "_metrics_started", None) is not None:
+        metrics.observe("flow_stage_seconds", time.perf_counter() - task._metrics_started, stage=task.name)
+        task._metrics_started = None
+    return new_state
+
+def write_run_metrics(run_id: str, directory: str = None, prometheus_path: str = None) -> str:
+    """Writes the metrics of a run to `<directory>/run_<run_id>.json`, and to a Prometheus text file when
+    `prometheus_path` or the `METRICS_PROMETHEUS_FILE` environment variable is set
+
+    Args:
+        run_id (str): Id of the run
+        directory (str, optional): Directory of the JSON summaries. Defaults to `METRICS_DIR` from the environment, or "metrics".
+        prometheus_path (str, optional): Prometheus text file. Defaults to `METRICS_PROMETHEUS_FILE` from the environment.
+
+    Returns:
+        str: path of the JSON summary
+    """
+    directory = directory or os.environ.get("METRICS_DIR", METRICS_DIR)
+    prometheus_path = prometheus_path or os.environ.get("METRICS_PROMETHEUS_FILE")
+    if prometheus_path:
+        metrics.write_prometheus(prometheus_path)
+    return metrics.write_summary(os.path.join(directory, f"run_{run_id}.json"), run_id=run_id)
@@ -0,0 +1,209 @@
+"""Extracts the minimum and maximum price from the free text display price of a listing.
+
+Agents write the display price however they like, e.g. "$950,000 - $1,050,000", "$1,300,000 to $1,400,000",
+"2.4M - 2.6M", "830K-890K", "AUCTION: EPR $1,400,000 - $1,450,000" or "Contact Agent". Every price in the
+string is found in a single pass of one precompiled pattern. Rather than raising, each parse returns a
+status saying what was found.
+"""
+import os
+import re
+import threading
+from collections import namedtuple, OrderedDict
+import numpy as np
+import pandas as pd
+
+# Parse statuses
+PRICE_RANGE = 0
+PRICE_SINGLE = 1
+NO_PRICE = 2
+EMPTY = 3
+
+STATUS_NAMES = {
+    PRICE_RANGE: "range",
+    PRICE_SINGLE: "single",
+    NO_PRICE: "no_price",
+    EMPTY: "empty",
+}
+
+# Numbers outside this range are dates, times, bedroom counts, phone numbers, etc rather than prices
+MIN_PRICE = 10_000
+MAX_PRICE = 100_000_000
+
+# Number of distinct display prices remembered by the cache
+DEFAULT_CACHE_SIZE = 4096
+
+ParsedPrice = namedtuple("ParsedPrice", ["minimum", "maximum", "status"])
+
+# Stray whitespace before a thousands group, e.g. "950 ,000". A comma followed by a space is punctuation
+# between a price and whatever follows it, e.g. "$650,000, 4 bedrooms", so it's left alone
+_SPACED_COMMA = re.compile(r"\s+,(?=\d{3}\b)")
+_PRICE = re.compile(r"""
+    (?<![\w.,])                                  # not part of another word or number
+    \$?\s?
+    (?P<whole>[1-9]\d{0,2}(?:,\d{3})+|[1-9]\d*)  # digits, optionally in groups of three
+    (?:\.(?P<fraction>\d+))?
+    \s?(?:(?P<thousands>k)|(?P<millions>m(?:il(?:lion)?)?))?\b
+""", re.IGNORECASE | re.VERBOSE)
+
+_RANGE_SEPARATOR = re.compile(r"\s*(?:-|–|to)\s*", re.IGNORECASE)
+
+def _multiplier(match):
+    if match.group("millions"):
+        return 1_000_000
+    if match.group("thousands"):
+        return 1_000
+    return None
+
+def _value(match, multiplier):
+    whole = match.group("whole").replace(",", "")
+    if multiplier is None:
+        return int(whole)
+    return int(round(float(f"{whole}.{match.group('fraction') or 0}") * multiplier))
+
+def parse_display_price(displayPrice) -> ParsedPrice:
+    """Gets the minimum and maximum price described in a display price.
+    The first price found is the minimum and the second is the maximum, if only one price is found
+    it's both the minimum and maximum.
+
+    Args:
+        displayPrice (str): display price of the listing
+
+    Returns:
+        ParsedPrice: `minimum`, `maximum` and the parse `status`. The prices are None when the status
+            is NO_PRICE or EMPTY
+    """
+    if not isinstance(displayPrice, str) or not displayPrice.strip():
+        return ParsedPrice(None, None, EMPTY)
+
+    text = _SPACED_COMMA.sub(",", displayPrice) if " ," in displayPrice else displayPrice
+    prices = []
+    previous = None
+    for match in _PRICE.finditer(text):
+        multiplier = _multiplier(match)
+        # In "1.1 - 1.2M" the suffix of the second price also applies to the first
+        if (multiplier and previous is not None and _multiplier(previous) is None and not prices
+                and _RANGE_SEPARATOR.fullmatch(text, previous.end(), match.start())):
+            value = _value(previous, multiplier)
+            if MIN_PRICE <= value <= MAX_PRICE:
+                prices.append(value)
+        previous = match
+        value = _value(match, multiplier)
+        if MIN_PRICE <= value <= MAX_PRICE:
+            prices.append(value)
+        if len(prices) >= 2:
+            break
+
+    if not prices:
+        return ParsedPrice(None, None, NO_PRICE)
+    if len(prices) == 1:
+        return ParsedPrice(prices[0], prices[0], PRICE_SINGLE)
+    return ParsedPrice(prices[0], prices[1], PRICE_RANGE)
+
+def normalise_display_price(displayPrice):
+    """Collapses whitespace and case so display prices that only differ by them share a cache entry"""
+    return " ".join(displayPrice.split()).lower()
+
+class PriceCache():
+    """Least recently used cache of parsed display prices. Display prices repeat heavily across listings
+    and runs ("Contact Agent", "Auction", the same agency ranges), so most are only ever parsed once.
+    Display prices that have no price are cached as well.
+
+    Args:
+        maxsize (int, optional): Max number of distinct display prices kept. Defaults to DEFAULT_CACHE_SIZE.
+    """
+    def __init__(self, maxsize: int = DEFAULT_CACHE_SIZE) -> None:
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, displayPrice):
+        """Parses a display price, using the cached result when there is one
+
+        Args:
+            displayPrice (str): display price of the listing
+
+        Returns:
+            tuple: the ParsedPrice, and whether it came from the cache
+        """
+        if not isinstance(displayPrice, str):
+            return parse_display_price(displayPrice), False
+        key = normalise_display_price(displayPrice)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key], True
+        parsed = parse_display_price(key)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = parsed
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+        return parsed, False
+
+    def get(self, displayPrice) -> ParsedPrice:
+        """Same as `parse_display_price`, but cached"""
+        return self.lookup(displayPrice)[0]
+
+    def resize(self, maxsize: int) -> None:
+        """Changes the size of the cache, evicting the least recently used entries if it shrinks"""
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Empties the cache and resets the counters"""
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self) -> dict:
+        """Hit and miss counters, for sizing the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._cache),
+                'maxsize': self.maxsize,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+# The cache shared by everything parsing display prices in this process
+price_cache = PriceCache(int(os.environ.get("PRICE_CACHE_SIZE", DEFAULT_CACHE_SIZE)))
+
+def cached_parse_display_price(displayPrice) -> ParsedPrice:
+    """Same as `parse_display_price`, but cached in `price_cache`"""
+    return price_cache.get(displayPrice)
+
+def parse_display_prices(displayPrices) -> pd.DataFrame:
+    """Parses a whole column of display prices at once. Display prices repeat heavily, so each
+    distinct display price is only parsed once and the results are spread back over the rows with numpy.
+
+    Args:
+        displayPrices (Series, ndarray or list): display prices
+
+    Returns:
+        DataFrame: `minimumPrice` and `maximumPrice` (nullable Int64) and `priceStatus` (int8),
+            with the same index as `displayPrices` when it's a Series
+    """
+    index = displayPrices.index if isinstance(displayPrices, pd.Series) else None
+    values = pd.Series(displayPrices, dtype=object)
+    # Missing values parse the same as an empty string, so nothing needs to be treated as NA
+    codes, uniques = pd.factorize(values.where(values.notna(), ""))
+    parsed = [parse_display_price(x) for x in uniques]
+    minimums = np.array([np.nan if x.minimum is None else x.minimum for x in parsed], dtype=float)
+    maximums = np.array([np.nan if x.maximum is None else x.maximum for x in parsed], dtype=float)
+    statuses = np.array([x.status for x in parsed], dtype=np.int8)
+    return pd.DataFrame({
+        'minimumPrice': pd.array(minimums[codes], dtype="Int64"),
+        'maximumPrice': pd.array(maximums[codes], dtype="Int64"),
+        'priceStatus': statuses[codes],
+    }, index=index)
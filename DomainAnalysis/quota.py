@@ -0,0 +1,229 @@
+import os
+import sqlite3
+from math import ceil
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from DomainAnalysis.logger import logger
+
+DAILY_REQUEST_LIMIT = 500
+SEARCH = "search"
+DETAIL = "detail"
+
+class QuotaExceeded(Exception):
+    pass
+
+@contextmanager
+def immediate_transaction(path: str, timeout: float = 30):
+    """Opens a SQLite file and holds its write lock for the whole `with` block, committing at the end so
+    each change survives the process dying straight after it. The transaction is rolled back if the block
+    raises, but not if the lock couldn't be taken, so the error that stopped it is the one raised.
+
+    Args:
+        path (str): SQLite file
+        timeout (float, optional): Seconds to wait for another connection to release the lock. Defaults to 30.
+    """
+    conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+class RequestBudget():
+    """Keeps count of the requests made to Domain each day in a SQLite file so the count survives
+    between runs and is shared by every process making requests.
+
+    Search pages always have priority. Detail requests can only spend what is left after
+    `search_reserve` requests have been held back for the day's searches, any detail requests that
+    can't be afforded are deferred to a queue that the next run picks up first.
+
+    Args:
+        path (str, optional): SQLite file to keep the counts in. Defaults to "domain_quota.db".
+        daily_limit (int, optional): Requests allowed per day. Defaults to DAILY_REQUEST_LIMIT.
+        search_reserve (int, optional): Requests held back for searches each day. Defaults to 25.
+        tz (timezone, optional): Timezone the daily limit resets in. Defaults to UTC.
+    """
+    def __init__(self, path: str = "domain_quota.db", daily_limit: int = DAILY_REQUEST_LIMIT,
+                 search_reserve: int = 25, tz: timezone = timezone.utc) -> None:
+        self.path = path
+        self.daily_limit = daily_limit
+        self.search_reserve = search_reserve
+        self.tz = tz
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS usage (day TEXT, kind TEXT, count INTEGER, PRIMARY KEY (day, kind))")
+            conn.execute("CREATE TABLE IF NOT EXISTS deferred (listing_id INTEGER PRIMARY KEY, deferred_at TEXT)")
+
+    def _connect(self):
+        # A connection per operation keeps the budget safe to share across threads and processes
+        return immediate_transaction(self.path)
+
+    def today(self) -> str:
+        return datetime.now(self.tz).date().isoformat()
+
+    def _used(self, conn, day):
+        counts = dict(conn.execute("SELECT kind, count FROM usage WHERE day = ?", (day,)).fetchall())
+        return counts.get(SEARCH, 0), counts.get(DETAIL, 0)
+
+    def _available(self, conn, kind, day):
+        used_search, used_detail = self._used(conn, day)
+        remaining = self.daily_limit - used_search - used_detail
+        if kind == SEARCH:
+            return max(0, remaining)
+        # Details can't spend the part of the reserve searches haven't used yet
+        held_for_search = max(0, self.search_reserve - used_search)
+        return max(0, remaining - held_for_search)
+
+    def available(self, kind: str = DETAIL) -> int:
+        """Number of requests of a kind that can still be made today"""
+        with self._connect() as conn:
+            return self._available(conn, kind, self.today())
+
+    def try_acquire(self, kind: str, n: int = 1) -> bool:
+        """Spends `n` requests of a kind if the budget can afford them
+
+        Args:
+            kind (str): SEARCH or DETAIL
+            n (int, optional): Number of requests. Defaults to 1.
+
+        Returns:
+            bool: True if the requests were spent, False if there isn't enough budget left
+        """
+        day = self.today()
+        with self._connect() as conn:
+            if self._available(conn, kind, day) < n:
+                return False
+            self._spend(conn, kind, day, n)
+        return True
+
+    def _spend(self, conn, kind, day, n):
+        conn.execute("INSERT INTO usage (day, kind, count) VALUES (?, ?, ?) "
+                     "ON CONFLICT (day, kind) DO UPDATE SET count = count + excluded.count", (day, kind, n))
+
+    def acquire(self, kind: str, n: int = 1) -> None:
+        """Spends `n` requests of a kind, raising QuotaExceeded if the budget can't afford them"""
+        if not self.try_acquire(kind, n):
+            logger.warning("Daily Domain request budget exhausted for %s requests", kind)
+            raise QuotaExceeded(f"Daily Domain request budget exhausted for {kind} requests")
+
+    def defer(self, listing_ids: list) -> None:
+        """Adds listing ids to the queue of detail requests for the next run"""
+        now = datetime.now(timezone.utc).isoformat()
+        with self._connect() as conn:
+            conn.executemany("INSERT OR IGNORE INTO deferred (listing_id, deferred_at) VALUES (?, ?)",
+                             [(listing_id, now) for listing_id in listing_ids])
+
+    def deferred(self) -> list:
+        """Listing ids waiting on a detail request, oldest first"""
+        with self._connect() as conn:
+            return [x[0] for x in conn.execute("SELECT listing_id FROM deferred ORDER BY deferred_at, listing_id")]
+
+    def plan_details(self, listing_ids: list, include_deferred: bool = True, limit: int = None) -> list:
+        """Decides which detail requests to make this run. Listings deferred by earlier runs go first,
+        followed by `listing_ids`. Those that fit in today's budget are returned and removed from the queue,
+        the rest are deferred to the next run.
+
+        The requests aren't spent here, they're spent as each request is made. The queue is read and
+        updated in one transaction, so processes planning at the same time never take the same listing.
+        A run that plans more than once, e.g. a page at a time, takes the deferred listings with its first
+        plan and passes how many requests it has left as `limit`, as the requests it planned earlier may not
+        have been spent yet.
+
+        Args:
+            listing_ids (list): listing ids needing a detail request
+            include_deferred (bool, optional): Put the listings deferred by earlier runs first. Defaults to True.
+            limit (int, optional): Max number of listings to plan. Defaults to None, whatever the budget affords.
+
+        Returns:
+            list: listing ids to request details for now
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        with self._connect() as conn:
+            deferred = []
+            if include_deferred:
+                deferred = [x[0] for x in conn.execute("SELECT listing_id FROM deferred ORDER BY deferred_at, listing_id")]
+            queue = list(dict.fromkeys(deferred + list(listing_ids)))
+            affordable = self._available(conn, DETAIL, self.today())
+            if limit is not None:
+                affordable = max(0, min(affordable, limit))
+            to_fetch, to_defer = queue[:affordable], queue[affordable:]
+            conn.executemany("DELETE FROM deferred WHERE listing_id = ?", [(x,) for x in to_fetch])
+            conn.executemany("INSERT OR IGNORE INTO deferred (listing_id, deferred_at) VALUES (?, ?)",
+                             [(listing_id, now) for listing_id in to_defer])
+        if to_defer:
+            logger.info("Deferring %s listing detail requests to the next run, %s will be requested now", len(to_defer), len(to_fetch))
+        return to_fetch
+
+    def metrics(self) -> dict:
+        """Summary of today's usage of the budget"""
+        day = self.today()
+        with self._connect() as conn:
+            used_search, used_detail = self._used(conn, day)
+            deferred = conn.execute("SELECT COUNT(*) FROM deferred").fetchone()[0]
+        return {
+            'day': day,
+            'daily_limit': self.daily_limit,
+            'used': used_search + used_detail,
+            'used_search': used_search,
+            'used_detail': used_detail,
+            'remaining': max(0, self.daily_limit - used_search - used_detail),
+            'deferred': deferred
+        }
+
+class ShardBudget(RequestBudget):
+    """A shard's share of the daily request budget, for runs split across workers by `DomainAnalysis.sharding`.
+
+    Every shard counts its requests in the same SQLite file, so together they still keep to the daily limit,
+    but each shard can only spend `share` of it. Each shard holds back the same share of the search reserve
+    for its own searches, and deferred listings are shared by every shard.
+
+    Args:
+        path (str, optional): SQLite file to keep the counts in. Defaults to "domain_quota.db".
+        daily_limit (int, optional): Requests allowed per day across every shard. Defaults to DAILY_REQUEST_LIMIT.
+        search_reserve (int, optional): Requests held back for searches each day across every shard. Defaults to 25.
+        tz (timezone, optional): Timezone the daily limit resets in. Defaults to UTC.
+        shard (str, optional): Name of the shard. Defaults to "0".
+        share (float, optional): Fraction of the daily limit the shard can spend. Defaults to 1.
+    """
+    def __init__(self, path: str = "domain_quota.db", daily_limit: int = DAILY_REQUEST_LIMIT,
+                 search_reserve: int = 25, tz: timezone = timezone.utc, shard: str = "0", share: float = 1.0) -> None:
+        super().__init__(path, daily_limit, search_reserve, tz)
+        self.shard = str(shard)
+        self.share = share
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS shard_usage "
+                         "(day TEXT, shard TEXT, kind TEXT, count INTEGER, PRIMARY KEY (day, shard, kind))")
+
+    @property
+    def shard_limit(self) -> int:
+        return int(self.daily_limit * self.share)
+
+    def _available(self, conn, kind, day):
+        counts = dict(conn.execute("SELECT kind, count FROM shard_usage WHERE day = ? AND shard = ?",
+                                   (day, self.shard)).fetchall())
+        used_search, used_detail = counts.get(SEARCH, 0), counts.get(DETAIL, 0)
+        remaining = self.shard_limit - used_search - used_detail
+        if kind == DETAIL:
+            remaining -= max(0, ceil(self.search_reserve * self.share) - used_search)
+        return max(0, min(remaining, super()._available(conn, kind, day)))
+
+    def _spend(self, conn, kind, day, n):
+        super()._spend(conn, kind, day, n)
+        conn.execute("INSERT INTO shard_usage (day, shard, kind, count) VALUES (?, ?, ?, ?) "
+                     "ON CONFLICT (day, shard, kind) DO UPDATE SET count = count + excluded.count",
+                     (day, self.shard, kind, n))
+
+def get_budget() -> RequestBudget:
+    """Gets the request budget kept at `DOMAIN_QUOTA_DB`, or "domain_quota.db" if that isn't set"""
+    return RequestBudget(os.environ.get("DOMAIN_QUOTA_DB", "domain_quota.db"),
+                         int(os.environ.get("DOMAIN_DAILY_REQUEST_LIMIT", DAILY_REQUEST_LIMIT)))
+
+def get_shard_budget(shard: str, share: float) -> ShardBudget:
+    """Gets a shard's share of the request budget kept at `DOMAIN_QUOTA_DB`, see `get_budget`"""
+    return ShardBudget(os.environ.get("DOMAIN_QUOTA_DB", "domain_quota.db"),
+                       int(os.environ.get("DOMAIN_DAILY_REQUEST_LIMIT", DAILY_REQUEST_LIMIT)), shard=shard, share=share)
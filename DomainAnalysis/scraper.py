@@ -14,7 +14,7 @@ def get_domain_listings_in_postcode(postcode: int):
     # get new listings
     key = get_api_key()
     listings = get_listings_in_postcode(key, 3195)
-    logger.info(f"{len(listings)} listings returned from domain API")
+    logger.info("%s listings returned from domain API", len(listings))
 
     # prepare data for upload
     listings_to_insert = {
@@ -25,7 +25,7 @@ def get_domain_listings_in_postcode(postcode: int):
     # Insert data
     objectId = insert_into_collection(collection, listings_to_insert)
     if objectId:
-        logger.info(f"Successfully inserted today's listings into database")
+        logger.info("Successfully inserted today's listings into database")
 
 if __name__ == "__main__":
     # connect to db
@@ -36,7 +36,7 @@ if __name__ == "__main__":
     # get new listings
     key = get_api_key()
     listings = get_listings_in_postcode(key, 3195)
-    logger.info(f"{len(listings)} listings returned from domain API")
+    logger.info("%s listings returned from domain API", len(listings))
 
     # prepare data for upload
     listings_to_insert = {
@@ -47,4 +47,4 @@ if __name__ == "__main__":
     # Insert data
     objectId = insert_into_collection(collection, listings_to_insert)
     if objectId:
-        logger.info(f"Successfully inserted today's listings into database")
+        logger.info("Successfully inserted today's listings into database")
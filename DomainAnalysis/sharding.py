@@ -0,0 +1,182 @@
+"""Splits a run across workers by postcode.
+
+The postcodes are sharded into groups with about as many listings each, going by how many listings each
+postcode has had before. Postcodes are taken from the most listings to the least and each is given to the
+shard with the fewest listings so far (longest processing time first). Postcodes never seen before are
+counted as an average postcode.
+
+Each shard runs the streaming pipeline (`DomainAnalysis.streaming`) in its own process, with its own
+connections to Domain and Mongo and its own share of the daily request budget, in proportion to its
+listings (see `DomainAnalysis.quota.ShardBudget`). The shards store their listings and snapshots as they
+go, under the same run id. A listing on a postcode boundary can come back in more than one shard's
+search, so the shards' listings are merged into a single run manifest with each listing once.
+
+Usage:
+    python -m DomainAnalysis.sharding 3228 3227 3226 3230 [--workers 4] [--concurrency 8] [--no-refresh]
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from DomainAnalysis.domain_api import DomainClient, DOMAIN_API_URL
+from DomainAnalysis.logger import logger
+from DomainAnalysis.mongo import connect_to_mongo_db, connect_to_domain_listings, connect_to_domain_runs
+from DomainAnalysis.quota import get_shard_budget
+from DomainAnalysis.snapshots import new_run_id, previous_hashes, store_run_manifest
+from DomainAnalysis.streaming import stream_listings
+
+# Counts added up from each shard's summary
+SUMMED = ('fetched', 'inserted', 'refreshed', 'features', 'deferred', 'failed')
+
+def postcode_counts(coll, postcodes):
+    """Counts the stored listings in each postcode
+
+    Args:
+        coll (Collection): Listings collection
+        postcodes (list): Postcodes to count
+
+    Returns:
+        dict: number of listings by postcode, postcodes without any listings are left out
+    """
+    pipeline = [
+        {"$match": {"location_postcode": {"$in": [str(x) for x in postcodes]}}},
+        {"$group": {"_id": "$location_postcode", "count": {"$sum": 1}}}
+    ]
+    return {str(x['_id']): x['count'] for x in coll.aggregate(pipeline)}
+
+def shard_postcodes(postcodes, counts, shards):
+    """Splits postcodes into groups with about as many listings each
+
+    Args:
+        postcodes (list): Postcodes to split
+        counts (dict): Listings by postcode, see `postcode_counts`
+        shards (int): Max number of groups
+
+    Returns:
+        list: a dict per group with its `postcodes` and their `weight`, the number of listings expected.
+            Empty groups are left out
+    """
+    postcodes = list(dict.fromkeys(str(x) for x in postcodes))
+    known = [counts[x] for x in postcodes if counts.get(x)]
+    default = sum(known) / len(known) if known else 1
+    weights = {x: counts.get(x) or default for x in postcodes}
+    groups = [{'postcodes': [], 'weight': 0} for _ in range(max(1, min(shards, len(postcodes))))]
+    for postcode in sorted(postcodes, key=lambda x: weights[x], reverse=True):
+        group = min(groups, key=lambda x: x['weight'])
+        group['postcodes'].append(postcode)
+        group['weight'] += weights[postcode]
+    return [x for x in groups if x['postcodes']]
+
+def plan_shards(coll, postcodes, workers):
+    """Shards the postcodes of a run and works out each shard's share of the request budget
+
+    Args:
+        coll (Collection): Listings collection
+        postcodes (list): Postcodes to search in
+        workers (int): Number of workers the run is split across
+
+    Returns:
+        list: a dict per shard with its name (`shard`), `postcodes`, `weight` and `share` of the budget
+    """
+    shards = shard_postcodes(postcodes, postcode_counts(coll, postcodes), workers)
+    total = sum(x['weight'] for x in shards)
+    for number, shard in enumerate(shards):
+        shard['shard'] = str(number)
+        shard['share'] = shard['weight'] / total
+        logger.info("Shard %s: %s postcodes (%s), %.0f listings expected, %.0f%% of the request budget",
+                    number, len(shard['postcodes']), ", ".join(shard['postcodes']), shard['weight'], shard['share'] * 100)
+    return shards
+
+def run_shard(shard, run_id, domain_key, connect = connect_to_mongo_db, base_url = DOMAIN_API_URL,
+              refresh_updated = True, concurrency = 8):
+    """Runs the streaming pipeline for one shard, leaving the run's manifest to `merge_shards`
+
+    Args:
+        shard (dict): Shard from `plan_shards`
+        run_id (str): Id of the run every shard is part of
+        domain_key (str): Domain API key
+        connect (callable, optional): Connects to Mongo, called in the worker. Defaults to connect_to_mongo_db.
+        base_url (str, optional): Root of the Domain API. Defaults to DOMAIN_API_URL.
+        refresh_updated (bool, optional): Also fetch stored listings updated on Domain. Defaults to True.
+        concurrency (int, optional): Max number of detail requests in flight. Defaults to 8.
+
+    Returns:
+        dict: the shard's summary from `stream_listings`, with the content `hashes` of its listings
+    """
+    budget = get_shard_budget(shard['shard'], shard['share'])
+    with DomainClient(domain_key, base_url, pool_size=concurrency, budget=budget) as domain_client:
+        summary = stream_listings(connect(), domain_client, shard['postcodes'], run_id, budget,
+                                  refresh_updated=refresh_updated, concurrency=concurrency, store_manifest=False)
+    summary['shard'] = shard['shard']
+    return summary
+
+def merge_shards(runs, run_id, summaries):
+    """Stores the manifest of a run from the listings of each of its shards, each listing once
+
+    Args:
+        runs (Collection): Runs collection
+        run_id (str): Id of the run
+        summaries (list): Summary of each shard, from `run_shard`
+
+    Returns:
+        dict: the run's summary, the counts in each shard's summary added up, with the listings
+            `searched` and `changed` since the previous run counted once, and the number of `duplicates`
+    """
+    hashes = {}
+    for summary in summaries:
+        for listing_id, content_hash in summary['hashes'].items():
+            hashes.setdefault(listing_id, content_hash)
+    previous = previous_hashes(runs, run_id)
+    changed = sum(previous.get(listing_id) != content_hash for listing_id, content_hash in hashes.items())
+    store_run_manifest(runs, run_id, hashes, changed, min(x['created'] for x in summaries))
+
+    merged = {key: sum(x[key] for x in summaries) for key in SUMMED}
+    merged.update({
+        'run_id': run_id,
+        'shards': len(summaries),
+        'searched': len(hashes),
+        'changed': changed,
+        'duplicates': sum(len(x['hashes']) for x in summaries) - len(hashes)
+    })
+    if merged['duplicates']:
+        logger.info("%s listings were found by more than one shard", merged['duplicates'])
+    return merged
+
+def scrape_sharded(postcodes, domain_key, workers = 4, connect = connect_to_mongo_db, run_id = None,
+                   refresh_updated = True, concurrency = 8):
+    """Searches Domain for today's listings and stores them, split across worker processes by postcode
+
+    Args:
+        postcodes (list): Postcodes to search in
+        domain_key (str): Domain API key
+        workers (int, optional): Number of worker processes. Defaults to 4.
+        connect (callable, optional): Connects to Mongo, called in each worker. Defaults to connect_to_mongo_db.
+        run_id (str, optional): Id of the run. Defaults to None, a new run id.
+        refresh_updated (bool, optional): Also fetch stored listings updated on Domain. Defaults to True.
+        concurrency (int, optional): Max number of detail requests in flight in each worker. Defaults to 8.
+
+    Returns:
+        dict: the run's summary, see `merge_shards`
+    """
+    client = connect()
+    run_id = run_id or new_run_id()
+    shards = plan_shards(connect_to_domain_listings(client), postcodes, workers)
+    shard = partial(run_shard, run_id=run_id, domain_key=domain_key, connect=connect,
+                    refresh_updated=refresh_updated, concurrency=concurrency)
+    with ProcessPoolExecutor(max_workers=len(shards)) as executor:
+        summaries = list(executor.map(shard, shards))
+    return merge_shards(connect_to_domain_runs(client), run_id, summaries)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("postcodes", nargs="+", help="Postcodes to search in")
+    parser.add_argument("--workers", type=int, default=4, help="Worker processes the postcodes are split across")
+    parser.add_argument("--concurrency", type=int, default=8, help="Detail requests in flight in each worker")
+    parser.add_argument("--no-refresh", dest="refresh_updated", action="store_false",
+                        help="Don't fetch stored listings updated on Domain")
+    args = parser.parse_args(argv)
+    return scrape_sharded(args.postcodes, os.environ.get('DOMAIN_API_KEY'), args.workers,
+                          refresh_updated=args.refresh_updated, concurrency=args.concurrency)
+
+if __name__ == "__main__":
+    main()
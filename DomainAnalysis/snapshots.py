@@ -0,0 +1,240 @@
+"""Raw search results stored as one document per listing per run.
+
+Each run records a manifest in the `runs` collection with the id and content hash of every listing
+in that day's search. A listing's raw search result is only stored in the `snapshots` collection
+when its content hash differs from the previous run, so an unchanged listing costs nothing but its
+manifest entry. The snapshots tagged with a run are exactly the listings that were new or changed in it.
+
+The raw details of each listing are kept in the `details` collection, the latest payload per listing,
+so the listings can be wrangled again without asking Domain for them.
+"""
+import hashlib
+import json
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+from DomainAnalysis.logger import logger
+from DomainAnalysis.mongo import chunked, BULK_WRITE_BATCH_SIZE
+
+# Mongo's error code for a write that breaks a unique index
+DUPLICATE_KEY = 11000
+
+def new_run_id():
+    """Run ids are UTC timestamps so they sort in the order the runs happened"""
+    return datetime.utcnow().strftime("%Y%m%dT%H%M%S%fZ")
+
+def content_hash(result):
+    """Hash of a raw search result that doesn't depend on the order of its keys"""
+    payload = json.dumps(result, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+def ensure_snapshot_indexes(snapshots, runs):
+    """Creates the indexes the snapshot store relies on. Safe to call on every run.
+
+    Args:
+        snapshots (Collection): Snapshots collection
+        runs (Collection): Runs collection
+    """
+    snapshots.create_index([("run_id", ASCENDING), ("listing_id", ASCENDING)], unique=True, name="run_listing")
+    snapshots.create_index([("listing_id", ASCENDING), ("content_hash", ASCENDING)], name="listing_content")
+    runs.create_index([("run_id", ASCENDING)], unique=True, name="run_id")
+
+def get_run(runs, run_id = None):
+    """Gets the manifest of a run, or the latest run if no run_id is given
+
+    Args:
+        runs (Collection): Runs collection
+        run_id (str, optional): Id of the run. Defaults to None.
+
+    Returns:
+        dict: the run's manifest, None if there isn't one
+    """
+    if run_id is not None:
+        return runs.find_one({"run_id": run_id})
+    return runs.find_one(sort=[("run_id", DESCENDING)])
+
+def get_previous_run(runs, run_id):
+    """Gets the manifest of the run before `run_id`"""
+    return runs.find_one({"run_id": {"$lt": run_id}}, sort=[("run_id", DESCENDING)])
+
+def store_snapshot(snapshots, runs, results, run_id = None):
+    """Stores today's raw search results, skipping any listing unchanged since the previous run
+
+    Args:
+        snapshots (Collection): Snapshots collection
+        runs (Collection): Runs collection
+        results (list): Raw search results from `get_listings_in_postcode`
+        run_id (str, optional): Id to store the run under. Defaults to a new run id.
+
+    Returns:
+        str: the run id
+    """
+    run_id = run_id or new_run_id()
+    created = datetime.utcnow()
+    hashes, changed = store_snapshot_page(snapshots, run_id, results, previous_hashes(runs, run_id), created)
+    store_run_manifest(runs, run_id, hashes, changed, created)
+    return run_id
+
+def previous_hashes(runs, run_id):
+    """Gets the content hash of every listing in the run before `run_id`, by listing_id"""
+    previous = get_previous_run(runs, run_id)
+    return dict(zip(previous['listing_ids'], previous['content_hashes'])) if previous else {}
+
+def store_snapshot_page(snapshots, run_id, results, previous, created):
+    """Stores the raw search results of part of a run that are new or changed since the previous run.
+    Used to store a run a page at a time, `store_run_manifest` is called once every page is stored.
+
+    Args:
+        snapshots (Collection): Snapshots collection
+        run_id (str): Id of the run
+        results (list): Raw search results
+        previous (dict): Content hashes of the previous run, from `previous_hashes`
+        created (datetime): When the run started
+
+    Returns:
+        tuple: dict of the content hash of every result by listing_id, and the number of results stored
+    """
+    by_id = {result['listing']['id']: result for result in results}
+    hashes = {listing_id: content_hash(result) for listing_id, result in by_id.items()}
+    changed = [{
+        'run_id': run_id,
+        'listing_id': listing_id,
+        'content_hash': hashes[listing_id],
+        'listing': result,
+        'created': created
+    } for listing_id, result in by_id.items() if previous.get(listing_id) != hashes[listing_id]]
+    for batch in chunked(changed, BULK_WRITE_BATCH_SIZE):
+        try:
+            snapshots.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Shards of a run can both find a listing on a postcode boundary, the first one stored is kept
+            if any(x['code'] != DUPLICATE_KEY for x in e.details['writeErrors']):
+                raise
+    return hashes, len(changed)
+
+def store_run_manifest(runs, run_id, hashes, changed, created):
+    """Records the manifest of a run: the id and content hash of every listing in it
+
+    Args:
+        runs (Collection): Runs collection
+        run_id (str): Id of the run
+        hashes (dict): Content hash by listing_id, in the order Domain returned the listings
+        changed (int): Number of listings new or changed since the previous run
+        created (datetime): When the run started
+    """
+    runs.insert_one({
+        'run_id': run_id,
+        'created': created,
+        'count': len(hashes),
+        'changed': changed,
+        'listing_ids': list(hashes),
+        'content_hashes': list(hashes.values())
+    })
+    logger.info("Stored run %s: %s listings, %s new or changed since the previous run", run_id, len(hashes), changed)
+
+def changed_listings(snapshots, run_id):
+    """Gets the raw search results that were new or changed in a run
+
+    Args:
+        snapshots (Collection): Snapshots collection
+        run_id (str): Id of the run
+
+    Returns:
+        list: raw search results
+    """
+    return [x['listing'] for x in snapshots.find({"run_id": run_id}, {"listing": 1, "_id": 0})]
+
+def diff_runs(runs, run_id, previous_run_id = None):
+    """Compares the manifests of two runs without reading any snapshots
+
+    Args:
+        runs (Collection): Runs collection
+        run_id (str): Id of the run
+        previous_run_id (str, optional): Id of the run to compare against. Defaults to the run before `run_id`.
+
+    Returns:
+        dict: sets of listing ids that are `new`, `removed` and `changed` in `run_id`
+    """
+    current = get_run(runs, run_id)
+    previous = get_run(runs, previous_run_id) if previous_run_id else get_previous_run(runs, run_id)
+    current_hashes = dict(zip(current['listing_ids'], current['content_hashes']))
+    previous_hashes = dict(zip(previous['listing_ids'], previous['content_hashes'])) if previous else {}
+    return {
+        'new': current_hashes.keys() - previous_hashes.keys(),
+        'removed': previous_hashes.keys() - current_hashes.keys(),
+        'changed': {k for k, v in current_hashes.items() if k in previous_hashes and previous_hashes[k] != v}
+    }
+
+def read_run_listings(snapshots, runs, run_id = None):
+    """Rebuilds the full raw search results of a run from the stored snapshots
+
+    Args:
+        snapshots (Collection): Snapshots collection
+        runs (Collection): Runs collection
+        run_id (str, optional): Id of the run. Defaults to the latest run.
+
+    Returns:
+        list: raw search results in the order they were returned by Domain
+    """
+    run = get_run(runs, run_id)
+    if run is None:
+        return []
+    wanted = dict(zip(run['listing_ids'], run['content_hashes']))
+    found = {}
+    for chunk in chunked(wanted):
+        query = {"listing_id": {"$in": chunk}, "content_hash": {"$in": [wanted[x] for x in chunk]}}
+        for x in snapshots.find(query, {"listing_id": 1, "content_hash": 1, "listing": 1}):
+            if x['content_hash'] == wanted[x['listing_id']]:
+                found[x['listing_id']] = x['listing']
+    missing = len(wanted) - len(found)
+    if missing:
+        logger.warning("Unable to find snapshots for %s listings in run %s", missing, run['run_id'])
+    return [found[x] for x in run['listing_ids'] if x in found]
+
+def ensure_detail_indexes(details):
+    """Creates the index the raw details store relies on. Safe to call on every run."""
+    details.create_index([("listing_id", ASCENDING)], unique=True, name="listing_id_unique")
+
+def store_raw_details(details, raw_listings):
+    """Stores the raw details of listings from Domain, replacing any older details of the same listing
+
+    Args:
+        details (Collection): Details collection
+        raw_listings (dict): Raw listings by listing_id, from `fetch_listing_details`
+
+    Returns:
+        int: Number of listings whose details were new or had changed
+    """
+    fetched = datetime.utcnow()
+    hashes = {listing_id: content_hash(raw) for listing_id, raw in raw_listings.items()}
+    stored_hashes = {}
+    for chunk in chunked(hashes):
+        query = {"listing_id": {"$in": chunk}}
+        for x in details.find(query, {"listing_id": 1, "content_hash": 1, "_id": 0}):
+            stored_hashes[x['listing_id']] = x['content_hash']
+    operations = [UpdateOne({"listing_id": listing_id},
+                            {"$set": {"content_hash": hashes[listing_id], "listing": raw, "fetched": fetched}},
+                            upsert=True)
+                  for listing_id, raw in raw_listings.items() if stored_hashes.get(listing_id) != hashes[listing_id]]
+    stored = 0
+    for batch in chunked(operations, BULK_WRITE_BATCH_SIZE):
+        details.bulk_write(batch, ordered=False)
+        stored += len(batch)
+    logger.debug("Stored raw details of %s of %s listings", stored, len(raw_listings))
+    return stored
+
+def read_raw_details(details, listing_ids):
+    """Gets the stored raw details of listings
+
+    Args:
+        details (Collection): Details collection
+        listing_ids (list): Ids of the listings
+
+    Returns:
+        dict: raw listings by listing_id, listings without stored details are left out
+    """
+    raw_listings = {}
+    for chunk in chunked(listing_ids):
+        for x in details.find({"listing_id": {"$in": chunk}}, {"listing_id": 1, "listing": 1, "_id": 0}):
+            raw_listings[x['listing_id']] = x['listing']
+    return raw_listings
@@ -0,0 +1,271 @@
+"""Finds the indicative selling price in the statement of information (SOI) of listings that don't give a price.
+
+Victorian agents must publish an SOI with an indicative price or price range, even when the listing itself
+only says "Contact Agent". Each SOI PDF is downloaded once into a local cache, named by the hash of its
+content, and the price is read from the text of the PDF, falling back to OCR for scanned documents when
+`pytesseract` and `pdf2image` are installed. Results are stored in the `soi` collection keyed by the
+document hash, so:
+
+- an SOI URL that's already been seen is never downloaded again
+- a document that's already been parsed is never parsed again, even under a new URL
+- bumping `SOI_PARSER_VERSION` re-parses documents from the local cache, only downloading those missing from it
+
+The price found is written to the listing as `soi_minimumPrice` and `soi_maximumPrice`, leaving the prices
+from Domain untouched. This runs on its own schedule with its own pools of workers, outside the daily flow.
+
+Usage:
+    python -m DomainAnalysis.soi [--workers 4] [--download-workers 8] [--cache-dir soi_cache]
+"""
+import argparse
+import hashlib
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+import requests
+from pymongo import ASCENDING, UpdateOne
+from DomainAnalysis.logger import logger
+from DomainAnalysis.mongo import connect_to_mongo_db, connect_to_domain_listings, connect_to_domain_soi, chunked, MODIFIED
+from DomainAnalysis.prices import parse_display_price, PRICE_RANGE, PRICE_SINGLE
+
+try:
+    from pdfminer.high_level import extract_text as _pdf_to_text
+except ImportError:
+    _pdf_to_text = None
+
+try:
+    import pytesseract
+    from pdf2image import convert_from_path
+except ImportError:
+    pytesseract = convert_from_path = None
+
+# Bump whenever the way prices are read from an SOI changes so stored results are parsed again
+SOI_PARSER_VERSION = 1
+SOI_CACHE_DIR = "soi_cache"
+DOWNLOAD_TIMEOUT = 30
+
+# Ways a price is found
+TEXT = "text"
+OCR = "ocr"
+
+# The indicative price is between its heading and the median price of the suburb
+_INDICATIVE_PRICE = re.compile(r"indicative\s+selling\s+price(?P<section>.{0,400}?)(?:median\s+sale\s+price|$)",
+                               re.IGNORECASE | re.DOTALL)
+
+def ensure_soi_indexes(soi):
+    """Creates the indexes the SOI store relies on. Safe to call on every run."""
+    soi.create_index([("document_hash", ASCENDING)], unique=True, name="document_hash")
+    soi.create_index([("urls", ASCENDING)], name="urls")
+
+def document_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+def cache_path(cache_dir, digest):
+    """Path of a cached SOI, in a sub directory per first two characters of its hash"""
+    return os.path.join(cache_dir, digest[:2], f"{digest}.pdf")
+
+def store_in_cache(cache_dir, content):
+    """Saves an SOI to the content addressed cache
+
+    Returns:
+        str: the document hash
+    """
+    digest = document_hash(content)
+    path = cache_path(cache_dir, digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so a crash never leaves a half written document in the cache. Each writer has its
+        # own temporary file as the same document can be downloaded under two urls at once
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(content)
+        os.replace(tmp_path, path)
+    return digest
+
+def download_soi(session, url, cache_dir):
+    """Downloads an SOI into the cache
+
+    Returns:
+        str: the document hash
+    """
+    res = session.get(url, timeout=DOWNLOAD_TIMEOUT)
+    res.raise_for_status()
+    return store_in_cache(cache_dir, res.content)
+
+def price_from_text(text):
+    """Finds the indicative price in the text of an SOI
+
+    Returns:
+        ParsedPrice: the minimum and maximum price, see `parse_display_price`
+    """
+    match = _INDICATIVE_PRICE.search(text or "")
+    # "Range between $600,000 & $660,000" uses "&" rather than "-" between the prices
+    section = match.group('section').replace("&", "-") if match else ""
+    return parse_display_price(section)
+
+def ocr_pdf(path):
+    return "\n".join(pytesseract.image_to_string(page) for page in convert_from_path(path))
+
+def parse_soi(path, pdf_to_text = None, ocr = None):
+    """Reads the indicative price from a cached SOI. Runs in a worker process.
+
+    Args:
+        path (str): Path of the SOI in the cache
+        pdf_to_text (callable, optional): Gets the text of a PDF. Defaults to pdfminer.
+        ocr (callable, optional): Gets the text of a scanned PDF. Defaults to tesseract when it's installed.
+
+    Returns:
+        dict: `minimumPrice` and `maximumPrice` (None when no price is found), the `method` the price was found
+            with and any `error`
+    """
+    pdf_to_text = pdf_to_text or _pdf_to_text
+    ocr = ocr or (ocr_pdf if pytesseract is not None else None)
+    result = {'minimumPrice': None, 'maximumPrice': None, 'method': None, 'error': None}
+    for method, extract in ((TEXT, pdf_to_text), (OCR, ocr)):
+        if extract is None:
+            continue
+        try:
+            parsed = price_from_text(extract(path))
+        except Exception as e:
+            result['error'] = f"{method}: {type(e).__name__}: {e}"
+            continue
+        if parsed.status in (PRICE_RANGE, PRICE_SINGLE):
+            return {'minimumPrice': parsed.minimum, 'maximumPrice': parsed.maximum, 'method': method, 'error': None}
+    return result
+
+def download_all(session, urls, cache_dir, download_workers = 8):
+    """Downloads SOIs into the cache on a pool of threads
+
+    Returns:
+        tuple: dict of document hashes by url, and the number of urls that failed to download
+    """
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        futures = {url: executor.submit(download_soi, session, url, cache_dir) for url in urls}
+    hash_by_url, failed = {}, 0
+    for url, future in futures.items():
+        try:
+            hash_by_url[url] = future.result()
+        except Exception as e:
+            failed += 1
+            logger.warning("Unable to download SOI %s: %s", url, e)
+    return hash_by_url, failed
+
+def parsed_results(soi, hashes):
+    """Gets the stored results of the documents the current parser has already read, by document hash"""
+    results = {}
+    for chunk in chunked(list(hashes)):
+        results.update({x['document_hash']: x for x in soi.find({"document_hash": {"$in": chunk}})
+                        if x.get('version') == SOI_PARSER_VERSION})
+    return results
+
+def listings_missing_prices(coll):
+    """Gets the listings without a price whose SOI hasn't been read by the current parser"""
+    query = {"statementOfInformation": {"$ne": None}, "minimumPrice": None}
+    project = {"listing_id": 1, "statementOfInformation": 1, "soi_url": 1, "soi_version": 1, "_id": 0}
+    return [x for x in coll.find(query, project)
+            if x.get('soi_url') != x['statementOfInformation'] or x.get('soi_version') != SOI_PARSER_VERSION]
+
+def process_statements(coll, soi, cache_dir = SOI_CACHE_DIR, workers = None, download_workers = 8, session = None,
+                       parse = parse_soi):
+    """Fills in the SOI price of every listing that's missing a price
+
+    Args:
+        coll (Collection): Listings collection
+        soi (Collection): SOI collection
+        cache_dir (str, optional): Directory of the SOI cache. Defaults to SOI_CACHE_DIR.
+        workers (int, optional): Processes parsing SOIs. Defaults to the number of cores.
+        download_workers (int, optional): Threads downloading SOIs. Defaults to 8.
+        session (Session, optional): requests session to download with. Defaults to a new session.
+        parse (callable, optional): Parses a cached SOI, see `parse_soi`. Defaults to parse_soi.
+
+    Returns:
+        dict: counts of listings `checked`, SOIs `downloaded` and `parsed`, listings `priced` and `failed` downloads
+    """
+    listings = listings_missing_prices(coll)
+    summary = {'checked': len(listings), 'downloaded': 0, 'parsed': 0, 'priced': 0, 'failed': 0}
+    if not listings:
+        return summary
+    urls = list(dict.fromkeys(x['statementOfInformation'] for x in listings))
+
+    # Documents already stored for these urls are never downloaded again
+    stored = {}
+    for chunk in chunked(urls):
+        for x in soi.find({"urls": {"$in": chunk}}):
+            stored.update({url: x for url in x['urls']})
+    hash_by_url = {url: x['document_hash'] for url, x in stored.items()}
+    to_download = [x for x in urls if x not in hash_by_url]
+
+    session = session or requests.Session()
+    downloaded, summary['failed'] = download_all(session, to_download, cache_dir, download_workers)
+    hash_by_url.update(downloaded)
+    summary['downloaded'] = len(downloaded)
+
+    # Documents are only parsed when the current parser hasn't seen their content before
+    results = parsed_results(soi, set(hash_by_url.values()))
+    # A document the current parser hasn't seen is downloaded again when it's missing from the cache, e.g. after
+    # bumping SOI_PARSER_VERSION on a machine that didn't download it in the first place
+    missing = {digest: url for url, digest in hash_by_url.items()
+               if digest not in results and not os.path.exists(cache_path(cache_dir, digest))}
+    if missing:
+        downloaded, failed = download_all(session, list(missing.values()), cache_dir, download_workers)
+        hash_by_url.update(downloaded)
+        summary['downloaded'] += len(downloaded)
+        summary['failed'] += failed
+        # The url may now serve a different document, which may have already been parsed
+        results.update(parsed_results(soi, set(downloaded.values()) - set(missing)))
+    hashes = set(hash_by_url.values())
+    to_parse = [x for x in hashes if x not in results and os.path.exists(cache_path(cache_dir, x))]
+    parsed_at = datetime.utcnow()
+    if to_parse:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed = executor.map(parse, [cache_path(cache_dir, x) for x in to_parse])
+            for digest, result in zip(to_parse, parsed):
+                results[digest] = dict(result, document_hash=digest, version=SOI_PARSER_VERSION, parsed=parsed_at)
+        summary['parsed'] = len(to_parse)
+
+    urls_by_hash = {}
+    for url, digest in hash_by_url.items():
+        urls_by_hash.setdefault(digest, []).append(url)
+    fields = ('minimumPrice', 'maximumPrice', 'method', 'error', 'version', 'parsed')
+    soi_updates = [UpdateOne({"document_hash": digest},
+                             {"$set": {k: results[digest].get(k) for k in fields},
+                              "$addToSet": {"urls": {"$each": urls_by_hash[digest]}}},
+                             upsert=True)
+                   for digest in urls_by_hash if digest in results]
+    if soi_updates:
+        soi.bulk_write(soi_updates, ordered=False)
+
+    listing_updates = []
+    for listing in listings:
+        result = results.get(hash_by_url.get(listing['statementOfInformation']))
+        if result is None:
+            continue
+        summary['priced'] += result['minimumPrice'] is not None
+        listing_updates.append(UpdateOne({"listing_id": listing['listing_id']}, {"$set": {
+            'soi_minimumPrice': result['minimumPrice'],
+            'soi_maximumPrice': result['maximumPrice'],
+            'soi_document_hash': result['document_hash'],
+            'soi_url': listing['statementOfInformation'],
+            'soi_version': SOI_PARSER_VERSION
+        }, "$currentDate": {MODIFIED: True}}))
+    for chunk in chunked(listing_updates):
+        coll.bulk_write(chunk, ordered=False)
+    logger.info("Checked the SOI of %s listings without a price: %s downloaded, %s parsed, %s priced, "
+                "%s failed to download", summary['checked'], summary['downloaded'], summary['parsed'],
+                summary['priced'], summary['failed'])
+    return summary
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=None, help="Processes parsing SOIs. Defaults to the number of cores")
+    parser.add_argument("--download-workers", type=int, default=8, help="Threads downloading SOIs")
+    parser.add_argument("--cache-dir", default=os.environ.get("SOI_CACHE_DIR", SOI_CACHE_DIR), help="Directory of the SOI cache")
+    args = parser.parse_args(argv)
+    client = connect_to_mongo_db()
+    soi = connect_to_domain_soi(client)
+    ensure_soi_indexes(soi)
+    return process_statements(connect_to_domain_listings(client), soi, args.cache_dir, args.workers, args.download_workers)
+
+if __name__ == "__main__":
+    main()
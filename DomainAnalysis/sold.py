@@ -0,0 +1,167 @@
+"""Finds listings that have come off the market, and whether they were sold or withdrawn.
+
+A listing that was in the previous run's search but isn't in today's has either been sold, been withdrawn
+or simply fallen out of the search. The listings that disappeared are found by comparing the listing ids in
+the two runs' manifests, without touching the listings collection. Only those listings are asked for from
+Domain, as many as today's request budget can afford, and any left over are carried in the run's manifest
+to be asked for in the next run.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pymongo import DESCENDING, UpdateOne
+from DomainAnalysis.domain_api import DomainClient
+from DomainAnalysis.logger import logger
+from DomainAnalysis.mongo import chunked, BULK_WRITE_BATCH_SIZE, MODIFIED
+from DomainAnalysis.quota import QuotaExceeded, DETAIL
+
+# Statuses given to listings that have come off the market
+SOLD = "sold"
+WITHDRAWN = "withdrawn"
+
+# Domain statuses of listings that are still on the market
+LIVE_STATUSES = {"live", "underOffer", "new", "depositTaken"}
+
+def disappeared(previous_ids, current_ids, unprobed = ()):
+    """Finds the listings that are no longer in the search, in O(n)
+
+    Args:
+        previous_ids (list): Listing ids in the previous run
+        current_ids (list): Listing ids in the current run
+        unprobed (list, optional): Listings that disappeared in earlier runs but weren't asked for yet. Defaults to ().
+
+    Returns:
+        list: listing ids, the earliest to disappear first
+    """
+    current = set(current_ids)
+    ended = [x for x in dict.fromkeys(unprobed) if x not in current]
+    # A listing waiting to be checked from an earlier run is only returned once
+    current.update(ended)
+    return ended + [x for x in previous_ids if x not in current]
+
+def ended_listing_candidates(runs, run_id):
+    """Gets the listings to check for having come off the market in a run, from the run manifests alone
+
+    Args:
+        runs (Collection): Runs collection
+        run_id (str): Id of the run
+
+    Returns:
+        list: listing ids
+    """
+    current = runs.find_one({"run_id": run_id}, {"listing_ids": 1})
+    previous = runs.find_one({"run_id": {"$lt": run_id}}, {"listing_ids": 1, "unprobed": 1},
+                             sort=[("run_id", DESCENDING)])
+    if current is None or previous is None:
+        return []
+    return disappeared(previous['listing_ids'], current['listing_ids'], previous.get('unprobed', []))
+
+def classify_listing(status_code, raw_listing, checked):
+    """Works out whether a listing has come off the market from Domain's response
+
+    Args:
+        status_code (int): Status code of the response
+        raw_listing (dict): Listing details, None unless the response was 200
+        checked (str): When the listing was checked, used as the end date when Domain doesn't give one
+
+    Returns:
+        dict: the `status` and `dateEnded` of the listing, plus `soldPrice` for sold listings.
+            None if the listing is still on the market, or the response doesn't say either way
+    """
+    if status_code in (404, 410):
+        return {'status': WITHDRAWN, 'dateEnded': checked}
+    if status_code != 200 or raw_listing.get('status') in LIVE_STATUSES:
+        return None
+    sold_details = (raw_listing.get('saleDetails') or {}).get('soldDetails') or {}
+    if raw_listing.get('status') == SOLD or sold_details:
+        return {'status': SOLD, 'dateEnded': sold_details.get('soldDate') or checked,
+                'soldPrice': sold_details.get('soldPrice')}
+    return {'status': WITHDRAWN, 'dateEnded': checked}
+
+def _probe(client, listing_id):
+    res = client.get_listing(listing_id)
+    return res.status_code, (res.json() if res.status_code == 200 else None)
+
+def probe_listings(client: DomainClient, listing_ids: list, concurrency: int = 8):
+    """Asks Domain for listings that disappeared from the search
+
+    Args:
+        client (DomainClient): Client to make the requests with
+        listing_ids (list): Ids of the listings
+        concurrency (int, optional): Max number of requests in flight. Defaults to 8.
+
+    Returns:
+        tuple: dict of `classify_listing` results by listing_id for the listings that have come off the market,
+            and a list of the listings that couldn't be checked
+    """
+    checked = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    ended = {}
+    unprobed = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {listing_id: executor.submit(_probe, client, listing_id) for listing_id in listing_ids}
+    for listing_id, future in futures.items():
+        try:
+            status_code, raw_listing = future.result()
+        except QuotaExceeded:
+            unprobed.append(listing_id)
+            continue
+        except Exception as e:
+            logger.warning("Unable to check whether listing (%s) is still on the market: %s", listing_id, e)
+            unprobed.append(listing_id)
+            continue
+        if status_code not in (200, 404, 410):
+            unprobed.append(listing_id)
+            continue
+        result = classify_listing(status_code, raw_listing, checked)
+        if result is not None:
+            ended[listing_id] = result
+    return ended, unprobed
+
+def mark_ended_listings(coll, ended):
+    """Bulk updates the status and end date of listings that have come off the market
+
+    Args:
+        coll (Collection): Listings collection
+        ended (dict): `classify_listing` results by listing_id
+
+    Returns:
+        int: Number of listings modified
+    """
+    operations = [UpdateOne({"listing_id": listing_id}, {"$set": result, "$currentDate": {MODIFIED: True}})
+                  for listing_id, result in ended.items()]
+    modified = 0
+    for batch in chunked(operations, BULK_WRITE_BATCH_SIZE):
+        modified += coll.bulk_write(batch, ordered=False).modified_count
+    return modified
+
+def detect_ended_listings(coll, runs, client: DomainClient, run_id, budget = None, concurrency: int = 8):
+    """Checks the listings that disappeared from the search in a run and records the ones that have come off the market
+
+    Args:
+        coll (Collection): Listings collection
+        runs (Collection): Runs collection
+        client (DomainClient): Client to make the requests with
+        run_id (str): Id of the run
+        budget (RequestBudget, optional): Request budget, only as many listings as it can afford are checked.
+            Defaults to None, every listing is checked.
+        concurrency (int, optional): Max number of requests in flight. Defaults to 8.
+
+    Returns:
+        dict: counts of listings that `disappeared`, were `checked`, `sold`, `withdrawn` and left `unprobed`
+    """
+    candidates = ended_listing_candidates(runs, run_id)
+    affordable = len(candidates) if budget is None else min(len(candidates), budget.available(DETAIL))
+    ended, unprobed = probe_listings(client, candidates[:affordable], concurrency)
+    unprobed += candidates[affordable:]
+    mark_ended_listings(coll, ended)
+    runs.update_one({"run_id": run_id}, {"$set": {"unprobed": unprobed}})
+    statuses = [x['status'] for x in ended.values()]
+    summary = {
+        'disappeared': len(candidates),
+        'checked': len(candidates) - len(unprobed),
+        'sold': statuses.count(SOLD),
+        'withdrawn': statuses.count(WITHDRAWN),
+        'unprobed': len(unprobed)
+    }
+    logger.info("%s listings left the search: %s sold, %s withdrawn, %s left to check in the next run",
+                summary['disappeared'], summary['sold'], summary['withdrawn'], summary['unprobed'])
+    return summary
@@ -0,0 +1,236 @@
+"""Scrapes today's listings as a stream rather than one stage at a time.
+
+Each page of the search is handled as soon as it arrives from Domain: its snapshot is stored and the new
+and updated listings on it are found and planned against the request budget, while the following pages
+are still being requested. The details of those listings are fetched and wrangled by a pool of threads,
+and a writer thread stores them in Mongo in batches, so searching, fetching and writing all overlap.
+
+The stages are joined by bounded queues. When a later stage falls behind, the stage before it waits
+rather than piling up listings in memory, so memory stays flat however many postcodes are searched.
+Only the id and content hash of each listing in the run are kept until the end, for the run's manifest.
+
+The stored listings, snapshots, run manifest and deferred requests are the same as the
+`scrape-raw-from-domain` flow's, so the two modes can be swapped between runs.
+
+Usage:
+    python -m DomainAnalysis.streaming 3228 3227 [--concurrency 8] [--no-refresh]
+"""
+import argparse
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from DomainAnalysis.descriptions import update_description_features
+from DomainAnalysis.domain_api import DomainClient, get_client, iter_search_pages
+from DomainAnalysis.fetcher import get_raw_listing, wrangle_listings, QUOTA, REQUEST
+from DomainAnalysis.logger import logger
+from DomainAnalysis.metrics import metrics
+from DomainAnalysis.mongo import (connect_to_domain_listings, connect_to_domain_snapshots, connect_to_domain_runs,
+                                  connect_to_domain_details, which_new_listings, which_updated_listings,
+                                  update_changed_listings, bulk_upsert_listings, BULK_WRITE_BATCH_SIZE)
+from DomainAnalysis.quota import QuotaExceeded, DETAIL
+from DomainAnalysis.snapshots import (new_run_id, previous_hashes, store_snapshot_page, store_run_manifest,
+                                      store_raw_details)
+
+# Stage a listing's batch failed to be written in
+WRITE = "write"
+# Put on a queue to tell the threads reading it to finish
+_DONE = object()
+
+def _fetch_details(domain_client, to_fetch, to_write, errors):
+    """Fetcher thread, gets and wrangles each listing id taken from `to_fetch` until it's told to finish"""
+    while True:
+        listing_id = to_fetch.get()
+        if listing_id is _DONE:
+            return
+        try:
+            raw_listing = get_raw_listing(domain_client, listing_id)
+        except QuotaExceeded as e:
+            errors[listing_id] = {'stage': QUOTA, 'error': str(e)}
+            continue
+        except Exception as e:
+            errors[listing_id] = {'stage': REQUEST, 'error': str(e)}
+            continue
+        listings, wrangle_errors = wrangle_listings([listing_id], {listing_id: raw_listing})
+        errors.update(wrangle_errors)
+        to_write.put((listing_id, raw_listing, listings[0] if listings else None))
+
+def _write_batch(client, batch, summary):
+    """Stores the raw details of a batch and writes its listings, new listings inserted and stored ones updated"""
+    listings_coll = connect_to_domain_listings(client)
+    store_raw_details(connect_to_domain_details(client), {listing_id: raw for listing_id, raw, _ in batch})
+    listings = [x for _, _, x in batch if x is not None]
+    existing_ids = set(which_new_listings(listings_coll, [x.listing_id for x in listings], return_existing=True))
+    results = bulk_upsert_listings(listings_coll, [x for x in listings if x.listing_id not in existing_ids])
+    summary['inserted'] += sum(x['inserted'] for x in results)
+    summary['refreshed'] += update_changed_listings(listings_coll, [x for x in listings if x.listing_id in existing_ids])
+    summary['features'] += update_description_features(listings_coll, [x.listing_id for x in listings])
+    summary['fetched'] += len(listings)
+    metrics.inc("stream_batches_written_total")
+
+def _write_listings(client, to_write, errors, summary, batch_size, flush_interval):
+    """Writer thread, writes listings taken from `to_write` in batches of `batch_size`, or whatever has
+    arrived every `flush_interval` seconds, until it's told to finish
+    """
+    batch = []
+    first_at = None
+    while True:
+        # Waits for as long as the oldest listing in the batch has left before it's due to be written
+        timeout = max(0, flush_interval - (time.monotonic() - first_at)) if batch else None
+        try:
+            item = to_write.get(timeout=timeout)
+        except queue.Empty:
+            item = None
+        finished = item is _DONE
+        if item is not None and not finished:
+            if not batch:
+                first_at = time.monotonic()
+            batch.append(item)
+        due = bool(batch) and time.monotonic() - first_at >= flush_interval
+        if batch and (finished or len(batch) >= batch_size or due):
+            try:
+                with metrics.timer("stream_write_seconds"):
+                    _write_batch(client, batch, summary)
+            except Exception as e:
+                # The batch is given up on rather than the thread, so the fetchers never wait on a full queue forever
+                logger.error("Unable to write a batch of %s listings: %s", len(batch), e)
+                errors.update({listing_id: {'stage': WRITE, 'error': str(e)} for listing_id, _, _ in batch})
+            batch = []
+        if finished:
+            return
+
+def stream_listings(client, domain_client: DomainClient, postcodes: list, run_id = None, budget = None,
+                    refresh_updated = True, concurrency: int = 8, batch_size = BULK_WRITE_BATCH_SIZE,
+                    max_pending = None, flush_interval = 5, store_manifest = True):
+    """Searches Domain for today's listings and stores them, handling each page of the search as it arrives
+
+    Args:
+        client (MongoClient): Mongo client
+        domain_client (DomainClient): Client to make the requests to Domain with
+        postcodes (list): Postcodes to search in
+        run_id (str, optional): Id of the run. Defaults to None, a new run id.
+        budget (RequestBudget, optional): Request budget, details it can't afford are deferred to the next run.
+            Defaults to None, every new and updated listing is fetched.
+        refresh_updated (bool, optional): Also fetch stored listings updated on Domain. Defaults to True.
+        concurrency (int, optional): Max number of detail requests in flight. Defaults to 8.
+        batch_size (int, optional): Listings written to Mongo at a time. Defaults to BULK_WRITE_BATCH_SIZE.
+        max_pending (int, optional): Max listings waiting in each queue between stages. Defaults to `batch_size`.
+        flush_interval (float, optional): Max seconds a fetched listing waits to be written. Defaults to 5.
+        store_manifest (bool, optional): Store the run's manifest at the end. When False the content hash of
+            each listing is returned as `hashes` instead, along with when the run was `created`, for the
+            caller to store the manifest, see `DomainAnalysis.sharding`. Defaults to True.
+
+    Returns:
+        dict: the `run_id`, and counts of the listings `searched`, `changed` since the previous run,
+            `fetched`, `inserted`, `refreshed`, given description `features`, `deferred` and `failed`
+    """
+    run_id = run_id or new_run_id()
+    created = datetime.utcnow()
+    snapshots, runs = connect_to_domain_snapshots(client), connect_to_domain_runs(client)
+    listings_coll = connect_to_domain_listings(client)
+    previous = previous_hashes(runs, run_id)
+    max_pending = max_pending or batch_size
+
+    to_fetch = queue.Queue(maxsize=max_pending)
+    to_write = queue.Queue(maxsize=max_pending)
+    errors = {}
+    summary = {'fetched': 0, 'inserted': 0, 'refreshed': 0, 'features': 0}
+    fetchers = [threading.Thread(target=_fetch_details, args=(domain_client, to_fetch, to_write, errors),
+                                 name=f"stream-fetch-{x}", daemon=True) for x in range(concurrency)]
+    writer = threading.Thread(target=_write_listings, args=(client, to_write, errors, summary, batch_size, flush_interval),
+                              name="stream-write", daemon=True)
+    for thread in fetchers + [writer]:
+        thread.start()
+
+    hashes = {}
+    changed = 0
+    queued = 0
+    allowance = None
+    try:
+        for page in iter_search_pages(domain_client, postcodes, max_workers=min(concurrency, 4)):
+            if type(page) is dict:
+                logger.critical("Domain search failed: %s", page)
+                raise Exception(f"Domain search failed: {page}")
+            # A listing on more than one page is only handled the first time it's seen
+            page = [x for x in page if x['listing']['id'] not in hashes]
+            page_hashes, page_changed = store_snapshot_page(snapshots, run_id, page, previous, created)
+            hashes.update(page_hashes)
+            changed += page_changed
+
+            listing_ids = list(page_hashes)
+            needed = which_new_listings(listings_coll, listing_ids)
+            if refresh_updated:
+                needed += which_updated_listings(listings_coll, {x['listing']['id']: x['listing'].get('dateUpdated')
+                                                                 for x in page})
+            if budget is not None:
+                # Requests are only spent as they're made, so the run's allowance is taken before the first plan
+                # and each page can only plan what's left of it. Listings deferred by earlier runs are planned
+                # once, ahead of the first page
+                if allowance is None:
+                    allowance = budget.available(DETAIL)
+                    needed = budget.plan_details(needed, limit=allowance)
+                else:
+                    needed = budget.plan_details(needed, include_deferred=False, limit=allowance - queued)
+            for listing_id in needed:
+                # Blocks while the fetchers are `max_pending` listings behind
+                to_fetch.put(listing_id)
+                queued += 1
+            logger.debug("Searched %s listings, %s queued for details", len(hashes), queued)
+    except BaseException:
+        # Listings planned but not fetched yet go back to the budget's queue for the next run
+        drained = []
+        while True:
+            try:
+                listing_id = to_fetch.get_nowait()
+            except queue.Empty:
+                break
+            if listing_id is not _DONE:
+                drained.append(listing_id)
+        if budget is not None and drained:
+            budget.defer(drained)
+        raise
+    finally:
+        for _ in fetchers:
+            to_fetch.put(_DONE)
+        for thread in fetchers:
+            thread.join()
+        to_write.put(_DONE)
+        writer.join()
+
+    if store_manifest:
+        store_run_manifest(runs, run_id, hashes, changed, created)
+    for listing_id, error in errors.items():
+        logger.error("Unable to get listing (%s) during %s: %s", listing_id, error['stage'], error['error'])
+    deferred = [listing_id for listing_id, error in errors.items() if error['stage'] == QUOTA]
+    if deferred and budget is not None:
+        logger.warning("Request budget ran out, deferring %s listings to the next run", len(deferred))
+        budget.defer(deferred)
+    summary.update({
+        'run_id': run_id,
+        'searched': len(hashes),
+        'changed': changed,
+        'deferred': len(deferred),
+        'failed': len(errors) - len(deferred)
+    })
+    if not store_manifest:
+        summary.update({'hashes': hashes, 'created': created})
+    logger.info("Streamed run %s: %s listings searched, %s fetched, %s inserted, %s refreshed, %s deferred, %s failed",
+                run_id, summary['searched'], summary['fetched'], summary['inserted'], summary['refreshed'],
+                summary['deferred'], summary['failed'])
+    return summary
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("postcodes", nargs="+", help="Postcodes to search in")
+    parser.add_argument("--concurrency", type=int, default=8, help="Detail requests in flight")
+    parser.add_argument("--no-refresh", dest="refresh_updated", action="store_false",
+                        help="Don't fetch stored listings updated on Domain")
+    args = parser.parse_args(argv)
+    from DomainAnalysis.mongo import connect_to_mongo_db
+    from DomainAnalysis.quota import get_budget
+    return stream_listings(connect_to_mongo_db(), get_client(os.environ.get('DOMAIN_API_KEY')), args.postcodes,
+                           budget=get_budget(), refresh_updated=args.refresh_updated, concurrency=args.concurrency)
+
+if __name__ == "__main__":
+    main()
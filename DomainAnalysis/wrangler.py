@@ -1,16 +1,13 @@
-# TODO: Handle when the price isn't a value but a text like "CONTACT AGENT"
-# TODO: If price is auction or not available in the JSON response at all read the statement of information (if available) as the price HAS to be in there by law.
-
-
-from dataclasses import asdict, dataclass, field
+from dataclasses import dataclass, field, fields
 import datetime
 import json
-from collections.abc import MutableMapping
 import re
 from DomainAnalysis.logger import logger
+from DomainAnalysis.prices import cached_parse_display_price, price_cache, NO_PRICE, EMPTY
 
 @dataclass
 class Agent():
+    __slots__ = ('advertiserType', 'advertiserId')
     advertiserType: str
     advertiserId: int
     
@@ -30,17 +27,22 @@ class Agent():
      
 @dataclass        
 class HouseLocation():
-    state: str = None
-    streetNumber: str = None
-    unitNumber: str = None
-    street: str = None
-    suburb: str = None
-    postcode: str = None
-    displayAddress: str = None
-    latitude: float = None
-    longitude: float = None
+    __slots__ = ('state', 'streetNumber', 'unitNumber', 'street', 'suburb', 'postcode',
+                 'displayAddress', 'latitude', 'longitude')
+    state: str
+    streetNumber: str
+    unitNumber: str
+    street: str
+    suburb: str
+    postcode: str
+    displayAddress: str
+    latitude: float
+    longitude: float
     
     def __init__(self, addressParts, geoLocation) -> None:   
+        # Slotted classes can't have class level defaults, so every field starts as None here
+        self.state = self.streetNumber = self.unitNumber = self.street = self.suburb = None
+        self.postcode = self.displayAddress = self.latitude = self.longitude = None
         if addressParts:
             if addressParts['displayType'] == 'fullAddress':
                 self.state = addressParts['stateAbbreviation'].upper()
@@ -63,6 +65,8 @@ class HouseLocation():
         
 @dataclass        
 class HouseDetails():
+    __slots__ = ('bathrooms', 'bedrooms', 'carspaces', 'description', 'headline',
+                 'isNewDevelopment', 'propertyType', 'landAreaSqm')
     bathrooms: int
     bedrooms: int
     carspaces: int
@@ -96,6 +100,9 @@ class HouseDetails():
     
 @dataclass
 class Listing():
+    __slots__ = ('listing_id', 'created', 'dateListed', 'dateUpdated', 'saleMethod', 'saleMode',
+                 'displayPrice', 'minimumPrice', 'maximumPrice', 'inspectionsByAppointmentOnly', 'url',
+                 'statementOfInformation', 'location', 'house', 'agent')
     listing_id: int
     created: str
     dateListed: str
@@ -160,92 +167,105 @@ class Listing():
             # handle pricing
             if 'price' in raw_listing['priceDetails']:
                 self.minimumPrice = self.maximumPrice = raw_listing['priceDetails']['price']
-            elif '$' in raw_listing['priceDetails']['displayPrice']:
-                # Check to see if on or two prices
+            else:
+                # Display prices that aren't a price, e.g. "Contact Agent", leave the prices as None
                 displayPrice = raw_listing['priceDetails']['displayPrice']
+                parsed = cached_parse_display_price(displayPrice)
                 if displayPrice.count("$") < 2:
-                    self.minimumPrice = self.maximumPrice = get_minimum_price_from_display_price(displayPrice)
+                    # Ranges with one or no "$", e.g. "$600,000 - 650,000" or "600K-650K", keep both ends
+                    self.minimumPrice, self.maximumPrice = parsed.minimum, parsed.maximum
                 else:
                     self.minimumPrice = (raw_listing['priceDetails']['minimumPrice'] 
                                     if 'minimumPrice' in raw_listing['priceDetails']
-                                    else get_minimum_price_from_display_price(displayPrice))
+                                    else parsed.minimum)
                     self.maximumPrice = (raw_listing['priceDetails']['maximumPrice'] 
                                         if 'maximumPrice' in raw_listing['priceDetails']
-                                        else get_maximum_price_from_display_price(displayPrice))
+                                        else parsed.maximum)
                
         # if self.listing_id is None:
         #     raise ValueError("Listing Id can't be None") 
             
-    def __post_init__(self):
-        self.minimumPrice = get_minimum_price_from_display_price(self.displayPrice)
-    
     def as_no_nested_dicts(self):
         """Returns a dictionary of the listing class that has no nested dictionaries within
-        Ensures the class is prepared for tabular data entry
+        Ensures the class is prepared for tabular data entry. Nested classes are flattened into
+        `<field>_<nested field>` keys, or a single `<field>: None` when they're missing.
         """
-        def _flatten_dict_gen(d, parent_key, sep):
-            for k, v in d.items():
-                new_key = parent_key + sep + k if parent_key else k
-                if isinstance(v, MutableMapping):
-                    yield from flatten_dict(v, new_key, sep=sep).items()
-                else:
-                    yield new_key, v
+        row = {}
+        for name, nested in _FLAT_LAYOUT:
+            value = getattr(self, name)
+            if nested is None:
+                row[name] = value
+            elif value is None:
+                row[name] = None
+            else:
+                for attr, key in nested:
+                    row[key] = getattr(value, attr)
+        return row
 
+# Fields of Listing that hold nested classes, in the order they're flattened
+NESTED_FIELDS = {
+    'location': HouseLocation,
+    'house': HouseDetails,
+    'agent': Agent,
+}
 
-        def flatten_dict(d: MutableMapping, parent_key: str = '', sep: str = '_'):
-            return dict(_flatten_dict_gen(d, parent_key, sep))
- 
-        return flatten_dict(asdict(self))
-        
+def flat_field_names(cls = Listing, nested = NESTED_FIELDS):
+    """Gets the keys of a fully populated flattened listing, in order
+
+    Returns:
+        list: column names, e.g. `listing_id`, ..., `location_state`, ..., `agent_advertiserId`
+    """
+    names = []
+    for f in fields(cls):
+        if f.name in nested:
+            names.extend(f"{f.name}_{x.name}" for x in fields(nested[f.name]))
+        else:
+            names.append(f.name)
+    return names
 
+# Each field of Listing in order, with the attributes and keys of its nested class or None if it isn't one.
+# The layout is fixed, so it's worked out once here rather than walking the dataclass fields on every call
+_FLAT_LAYOUT = tuple((f.name, tuple((x.name, f"{f.name}_{x.name}") for x in fields(NESTED_FIELDS[f.name]))
+                      if f.name in NESTED_FIELDS else None)
+                     for f in fields(Listing))
 
 def get_minimum_price_from_display_price(displayPrice: str):
     """Get's the minimum value described in a display price. 
     Display price should be in the format "$950,000 - $1,050,000" 
 
     Args:
-        displayPrice ([type]): [description]
+        displayPrice (str): The value in the display price
 
     Returns:
-        [type]: [description]
+        int: the minimum price
     """
-    # Clean price
-    displayPrice = displayPrice.replace("$", "")
-    displayPrice = displayPrice.replace(",", "")
-    displayPrice = displayPrice.replace(" ", "")
-    
-    
-    # Handle a range price eg "$950,000 - $1,050,000"
-    try:
-        return convert_to_integer(re.split(r'-|to', displayPrice)[0])
-    except:
-        logger.critical(f"Unable to get_minimum_price_from_display_price for price: {displayPrice}")
+    parsed, cached = price_cache.lookup(displayPrice)
+    if parsed.status in (NO_PRICE, EMPTY):
+        # Only log the first time, the same display price turns up on many listings
+        if not cached:
+            logger.critical("Unable to get_minimum_price_from_display_price for price: %s", displayPrice)
         raise ValueError(f"Unable to get_minimum_price_from_display_price for price: {displayPrice}")
+    return parsed.minimum
 
 def get_maximum_price_from_display_price(displayPrice):
     """Get's the maximum value described in a display price. 
     Display price should be in the format "$950,000 - $1,050,000" 
 
     Args:
-        displayPrice ([type]): [description]
+        displayPrice (str): The value in the display price
 
     Returns:
-        [type]: [description]
+        int: the maximum price
     """
-    # Clean price
-    displayPrice = displayPrice.replace("$", "")
-    displayPrice = displayPrice.replace(",", "")
-    displayPrice = displayPrice.replace(" ", "")
-    
-    # Handle a range price eg "$950,000 - $1,050,000"
-    try:
-        return convert_to_integer(re.split(r'-|to', displayPrice)[1])
-    except:
-        logger.critical(f"Unable to get_maximum_price_from_display_price for price: {displayPrice}")
+    parsed, cached = price_cache.lookup(displayPrice)
+    if parsed.status in (NO_PRICE, EMPTY):
+        if not cached:
+            logger.critical("Unable to get_maximum_price_from_display_price for price: %s", displayPrice)
         raise ValueError(f"Unable to get_maximum_price_from_display_price for price: {displayPrice}")
+    return parsed.maximum
 
 def get_min_max_price_from_display_price(displayPrice):
-    """Get's the maximum value described in a display price. 
+    """Get's the minimum and maximum value described in a display price. 
     Display price should be in the format "$950,000 - $1,050,000" 
 
     Args:
@@ -254,8 +274,12 @@ def get_min_max_price_from_display_price(displayPrice):
     Returns:
         tuple: first element is minimum and the second is the maximum
     """    
-    return (get_minimum_price_from_display_price(displayPrice),
-            get_maximum_price_from_display_price(displayPrice))
+    parsed, cached = price_cache.lookup(displayPrice)
+    if parsed.status in (NO_PRICE, EMPTY):
+        if not cached:
+            logger.critical("Unable to get_min_max_price_from_display_price for price: %s", displayPrice)
+        raise ValueError(f"Unable to get_min_max_price_from_display_price for price: {displayPrice}")
+    return parsed.minimum, parsed.maximum
     
 def convert_to_integer(string):
     return int(re.findall(r'\d+', string )[0])
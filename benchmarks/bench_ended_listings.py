@@ -0,0 +1,36 @@
+"""Time taken to find the listings that left the search by diffing two run manifests, at 10k/50k/100k
+tracked listings with 2% of them leaving and being replaced between runs.
+
+Usage (from the repo root, with the package installed):
+    python benchmarks/bench_ended_listings.py [--sizes 10000 50000 100000] [--churn 0.02]
+"""
+import argparse
+import random
+import time
+
+from DomainAnalysis.sold import disappeared
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000, 100000])
+    parser.add_argument("--churn", type=float, default=0.02, help="Fraction of listings that leave between runs")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'listings':>10} {'left':>8} {'ms':>8}")
+    for size in args.sizes:
+        previous_ids = random.sample(range(2_000_000_000, 2_100_000_000), size)
+        left = int(size * args.churn)
+        current_ids = previous_ids[left:] + list(range(size, size + left))
+        random.shuffle(current_ids)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            ended = disappeared(previous_ids, current_ids)
+        elapsed = (time.perf_counter() - start) / args.repeat
+        assert len(ended) == left
+        print(f"{size:>10} {left:>8} {elapsed * 1000:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
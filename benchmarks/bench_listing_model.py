@@ -0,0 +1,180 @@
+"""Construction and flattening cost of the slotted listing model against the original dataclasses.
+
+The original classes kept a `__dict__` per instance and flattened with `dataclasses.asdict`, which
+deep copies the whole listing, followed by a recursive generator. They're reproduced here, trimmed to
+the same attribute assignments, so both models do the same work on the same raw listings.
+
+Usage (from the repo root, with the package installed):
+    python benchmarks/bench_listing_model.py [--count 10000] [--raw examples/raw_listing.json]
+"""
+import argparse
+import copy
+import datetime
+import json
+import logging
+import time
+import tracemalloc
+from collections.abc import MutableMapping
+from dataclasses import asdict, dataclass
+
+from DomainAnalysis.logger import logger
+from DomainAnalysis.prices import cached_parse_display_price
+from DomainAnalysis.wrangler import Listing
+
+
+@dataclass
+class LegacyAgent():
+    advertiserType: str
+    advertiserId: int
+
+    def __init__(self, advertiserIdentifiers):
+        self.advertiserType = advertiserIdentifiers['advertiserType']
+        self.advertiserId = advertiserIdentifiers['advertiserId']
+
+
+@dataclass
+class LegacyHouseLocation():
+    state: str = None
+    streetNumber: str = None
+    unitNumber: str = None
+    street: str = None
+    suburb: str = None
+    postcode: str = None
+    displayAddress: str = None
+    latitude: float = None
+    longitude: float = None
+
+    def __init__(self, addressParts, geoLocation):
+        if addressParts and addressParts['displayType'] == 'fullAddress':
+            self.state = addressParts['stateAbbreviation'].upper()
+            self.streetNumber = addressParts.get('streetNumber')
+            self.unitNumber = addressParts.get('unitNumber')
+            self.street = addressParts['street']
+            self.suburb = addressParts['suburb']
+            self.postcode = addressParts['postcode']
+            self.displayAddress = addressParts['displayAddress']
+        if geoLocation:
+            self.latitude = geoLocation['latitude']
+            self.longitude = geoLocation['longitude']
+
+
+@dataclass
+class LegacyHouseDetails():
+    bathrooms: int
+    bedrooms: int
+    carspaces: int
+    description: str
+    headline: str
+    isNewDevelopment: bool
+    propertyType: str
+    landAreaSqm: int
+
+    def __init__(self, raw_listing):
+        self.bathrooms = raw_listing['bathrooms']
+        self.bedrooms = raw_listing['bedrooms']
+        self.carspaces = raw_listing['carspaces']
+        self.description = raw_listing['description']
+        self.headline = raw_listing['headline']
+        self.landAreaSqm = raw_listing.get('landAreaSqm')
+        self.isNewDevelopment = raw_listing['isNewDevelopment']
+        self.propertyType = raw_listing['propertyTypes'][0]
+
+
+@dataclass
+class LegacyListing():
+    listing_id: int
+    created: str
+    dateListed: str
+    dateUpdated: str
+    saleMethod: str
+    saleMode: str
+    displayPrice: str
+    minimumPrice: int
+    maximumPrice: int
+    inspectionsByAppointmentOnly: bool
+    url: str
+    statementOfInformation: str
+    location: LegacyHouseLocation
+    house: LegacyHouseDetails
+    agent: LegacyAgent
+
+    def __init__(self, raw_listing):
+        self.listing_id = raw_listing['id']
+        self.created = datetime.datetime.utcnow().isoformat()
+        self.dateListed = raw_listing['dateListed']
+        self.dateUpdated = raw_listing['dateUpdated']
+        self.saleMethod = raw_listing['saleDetails']['saleMethod']
+        self.saleMode = raw_listing['saleMode']
+        self.displayPrice = raw_listing['priceDetails']['displayPrice']
+        self.inspectionsByAppointmentOnly = raw_listing.get('inspectionDetails', {}).get('isByAppointmentOnly')
+        self.url = raw_listing['seoUrl']
+        self.location = LegacyHouseLocation(raw_listing.get('addressParts'), raw_listing.get('geoLocation'))
+        self.house = LegacyHouseDetails(raw_listing)
+        self.agent = LegacyAgent(raw_listing['advertiserIdentifiers'])
+        self.statementOfInformation = raw_listing.get('statementOfInformation', {}).get('documentationUrl')
+        parsed = cached_parse_display_price(self.displayPrice)
+        self.minimumPrice, self.maximumPrice = parsed.minimum, parsed.maximum
+
+    def as_no_nested_dicts(self):
+        def _flatten_dict_gen(d, parent_key, sep):
+            for k, v in d.items():
+                new_key = parent_key + sep + k if parent_key else k
+                if isinstance(v, MutableMapping):
+                    yield from flatten_dict(v, new_key, sep=sep).items()
+                else:
+                    yield new_key, v
+
+        def flatten_dict(d, parent_key='', sep='_'):
+            return dict(_flatten_dict_gen(d, parent_key, sep))
+
+        return flatten_dict(asdict(self))
+
+
+def make_raw_listings(raw_listing, count):
+    raw_listings = []
+    for i in range(count):
+        raw = copy.deepcopy(raw_listing)
+        raw['id'] = raw_listing['id'] + i
+        raw_listings.append(raw)
+    return raw_listings
+
+
+def measure(cls, raw_listings):
+    """Times construction and flattening, and the memory held by the constructed listings"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    listings = [cls(x) for x in raw_listings]
+    construct = time.perf_counter() - start
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    rows = [x.as_no_nested_dicts() for x in listings]
+    flatten = time.perf_counter() - start
+    return construct, flatten, held, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=10000, help="Number of listings to build")
+    parser.add_argument("--raw", default="examples/raw_listing.json", help="Raw listing to copy")
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+
+    with open(args.raw) as infile:
+        raw_listings = make_raw_listings(json.load(infile), args.count)
+
+    print(f"{args.count} listings")
+    print(f"{'model':<10} {'construct s':>12} {'flatten s':>10} {'held MiB':>9} {'bytes/listing':>14}")
+    results = {}
+    for name, cls in (("legacy", LegacyListing), ("slotted", Listing)):
+        construct, flatten, held, rows = measure(cls, raw_listings)
+        results[name] = rows
+        print(f"{name:<10} {construct:>12.3f} {flatten:>10.3f} {held / 2**20:>9.2f} {held / args.count:>14,.0f}")
+
+    same = all(list(a) == list(b) for a, b in zip(results["legacy"], results["slotted"]))
+    print(f"flattened keys match: {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""Runs every stage of the `scrape-raw-from-domain` flow end to end against the local fake Domain server,
+at 100/1k/10k listings, and reports the wall time, requests made to Domain and peak memory of each stage.
+
+Each size is run twice against a fresh database: a cold run where every listing is new, then a run after
+`--churn` of the listings have sold (replaced by new listings) and as many again have been updated.
+The stages are called directly in the order the flow runs them, as importing the flow runs it.
+
+By default the database is mongomock, so the Mongo stages include mongomock's collection scans and are
+only comparable between runs of this benchmark. mongomock scans the whole collection for every write,
+so sizes past MOCK_MAX_SIZE take hours and are skipped. Pass `--mongo-uri` to run every size against a
+real MongoDB (a throwaway database is used). Peak memory is measured with tracemalloc, which slows down
+every stage, so pass `--no-memory` for wall times closer to production. Pass `--streaming` to run the
+search, details and writes as one overlapping stage with `DomainAnalysis.streaming` instead.
+
+Usage (from the repo root, with the package installed):
+    python benchmarks/bench_pipeline.py [--sizes 100 1000 10000] [--latency 0.005] [--rate-limit-every 50]
+                                        [--concurrency 8] [--churn 0.05] [--mongo-uri mongodb://localhost]
+                                        [--streaming]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from DomainAnalysis.descriptions import update_description_features
+from DomainAnalysis.domain_api import DomainClient, get_listings_in_postcode
+from DomainAnalysis.fetcher import fetch_listing_details, wrangle_listings
+from DomainAnalysis.logger import logger
+from DomainAnalysis.mongo import (bulk_upsert_listings, ensure_geo_index, ensure_listing_indexes,
+                                  update_changed_listings, which_new_listings, which_updated_listings)
+from DomainAnalysis.quota import RequestBudget
+from DomainAnalysis.snapshots import ensure_detail_indexes, ensure_snapshot_indexes, store_raw_details, store_snapshot
+from DomainAnalysis.sold import detect_ended_listings
+from DomainAnalysis.streaming import stream_listings
+from fake_domain import DETAIL, RATE_LIMITED, SEARCH, FakeDomainServer
+
+DATABASE = "bench-pipeline"
+POSTCODES = ["3195"]
+# mongomock is O(n) per write, past this size a run takes hours so it is skipped without a real MongoDB
+MOCK_MAX_SIZE = 1000
+
+
+def mock_database():
+    """In memory database, with bulk_write patched the same way as in the tests, see `tests/mongomock_patch.py`"""
+    import mongomock
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "tests"))
+    from mongomock_patch import bulk_write
+
+    mongomock.Collection.bulk_write = bulk_write
+    return mongomock.MongoClient()[DATABASE], lambda: None
+
+
+def make_database(mongo_uri):
+    if mongo_uri is None:
+        return mock_database()
+    from pymongo import MongoClient
+    client = MongoClient(mongo_uri)
+    client.drop_database(DATABASE)
+    return client[DATABASE], lambda: client.drop_database(DATABASE)
+
+
+class StageRecorder():
+    """Records the wall time, requests to the fake server and peak memory of each stage of a run"""
+    def __init__(self, server, memory):
+        self.server = server
+        self.memory = memory
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        before = dict(self.server.request_counts)
+        if self.memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if self.memory else None
+        after = self.server.request_counts
+        self.stages[name] = {
+            'seconds': elapsed,
+            'requests': after[SEARCH] + after[DETAIL] - before[SEARCH] - before[DETAIL],
+            'rate_limited': after[RATE_LIMITED] - before[RATE_LIMITED],
+            'peak_mb': peak / 2 ** 20 if peak is not None else None
+        }
+
+
+def run_pipeline(db, client, budget, run_id, recorder, concurrency):
+    """Runs the stages of the flow once, in the order the flow runs them"""
+    listings_coll, details = db.listings, db.details
+    with recorder.stage("search"):
+        results = get_listings_in_postcode("bench-key", POSTCODES, client=client)
+    with recorder.stage("store snapshot"):
+        store_snapshot(db.snapshots, db.runs, results, run_id)
+    with recorder.stage("check new/updated"):
+        listing_ids = [x['listing']['id'] for x in results]
+        new_listing_ids = which_new_listings(listings_coll, listing_ids)
+        update_dates = {x['listing']['id']: x['listing'].get('dateUpdated') for x in results}
+        updated_listing_ids = which_updated_listings(listings_coll, update_dates)
+    with recorder.stage("plan details"):
+        to_fetch = budget.plan_details(new_listing_ids + updated_listing_ids)
+    with recorder.stage("fetch details"):
+        raw_listings, errors = fetch_listing_details(client, to_fetch, concurrency)
+    with recorder.stage("store details"):
+        store_raw_details(details, raw_listings)
+    with recorder.stage("wrangle"):
+        listings, errors = wrangle_listings(to_fetch, raw_listings, errors)
+    with recorder.stage("write listings"):
+        existing_ids = set(which_new_listings(listings_coll, [x.listing_id for x in listings], return_existing=True))
+        bulk_upsert_listings(listings_coll, [x for x in listings if x.listing_id not in existing_ids])
+        update_changed_listings(listings_coll, [x for x in listings if x.listing_id in existing_ids])
+    with recorder.stage("description features"):
+        update_description_features(listings_coll, [x.listing_id for x in listings])
+    with recorder.stage("ended listings"):
+        ended = detect_ended_listings(listings_coll, db.runs, client, run_id, budget, concurrency)
+    assert not errors, f"{len(errors)} listings failed, e.g. {next(iter(errors.items()))}"
+    return {'fetched': len(listings), 'sold': ended['sold']}
+
+
+def run_streaming(db, client, budget, run_id, recorder, concurrency):
+    """Runs the streaming mode, then checks for ended listings as the streaming flow does"""
+    # stream_listings finds its collections in the client's `raw-requests` database, point it at the throwaway one
+    with recorder.stage("stream"):
+        summary = stream_listings({'raw-requests': db}, client, POSTCODES, run_id, budget, concurrency=concurrency,
+                                  flush_interval=0.5)
+    with recorder.stage("ended listings"):
+        ended = detect_ended_listings(db.listings, db.runs, client, run_id, budget, concurrency)
+    assert not summary['failed'], f"{summary['failed']} listings failed"
+    return {'fetched': summary['fetched'], 'sold': ended['sold']}
+
+
+def benchmark_size(size, args):
+    """Runs a cold run then a run with churn against a fresh database and budget
+
+    Returns:
+        list: the StageRecorder of each run
+    """
+    db, drop_database = make_database(args.mongo_uri)
+    ensure_listing_indexes(db.listings)
+    ensure_geo_index(db.listings)
+    ensure_snapshot_indexes(db.snapshots, db.runs)
+    ensure_detail_indexes(db.details)
+    churn = max(1, int(size * args.churn))
+    recorders = []
+    with tempfile.TemporaryDirectory() as tmp, \
+            FakeDomainServer(total=size, latency=args.latency, rate_limit_every=args.rate_limit_every) as server:
+        # A budget the runs can't exhaust, so every request is made and none are deferred
+        budget = RequestBudget(os.path.join(tmp, "quota.db"), daily_limit=10 ** 9)
+        with DomainClient("bench-key", server.base_url, pool_size=args.concurrency, backoff_factor=0.01,
+                          budget=budget) as client:
+            for run_number in (1, 2):
+                if run_number == 2:
+                    server.first_id += churn
+                    server.updated_ids = set(range(server.first_id, server.first_id + churn))
+                recorder = StageRecorder(server, args.memory)
+                run = run_streaming if args.streaming else run_pipeline
+                counts = run(db, client, budget, f"bench-{run_number}", recorder, args.concurrency)
+                expected_sold = churn if run_number == 2 else 0
+                assert counts['sold'] == expected_sold, f"expected {expected_sold} sold listings, got {counts['sold']}"
+                recorders.append(recorder)
+    drop_database()
+    return recorders
+
+
+def print_table(size, recorders, churn):
+    print(f"\n{size} listings (cold run, then {churn:.0%} sold and {churn:.0%} updated)")
+    print(f"{'stage':<22}" + "".join(f" {'s':>8} {'requests':>8} {'429s':>5} {'peak MB':>8}" for _ in recorders))
+    totals = [{'seconds': 0, 'requests': 0, 'rate_limited': 0, 'peak_mb': None} for _ in recorders]
+    for name in recorders[0].stages:
+        row = f"{name:<22}"
+        for recorder, total in zip(recorders, totals):
+            stage = recorder.stages[name]
+            peak = f"{stage['peak_mb']:>8.1f}" if stage['peak_mb'] is not None else f"{'-':>8}"
+            row += f" {stage['seconds']:>8.3f} {stage['requests']:>8} {stage['rate_limited']:>5} {peak}"
+            for key in ('seconds', 'requests', 'rate_limited'):
+                total[key] += stage[key]
+            if stage['peak_mb'] is not None:
+                total['peak_mb'] = max(total['peak_mb'] or 0, stage['peak_mb'])
+        print(row)
+    row = f"{'total':<22}"
+    for total in totals:
+        peak = f"{total['peak_mb']:>8.1f}" if total['peak_mb'] is not None else f"{'-':>8}"
+        row += f" {total['seconds']:>8.3f} {total['requests']:>8} {total['rate_limited']:>5} {peak}"
+    print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--latency", type=float, default=0.005, help="Seconds the fake server waits per request")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="Answer every nth request with a 429")
+    parser.add_argument("--concurrency", type=int, default=8, help="Detail requests in flight")
+    parser.add_argument("--churn", type=float, default=0.05, help="Fraction of listings sold and updated between runs")
+    parser.add_argument("--mongo-uri", default=None, help="Run against this MongoDB rather than mongomock")
+    parser.add_argument("--streaming", action="store_true", help="Run the streaming mode rather than each stage in turn")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="Don't measure peak memory")
+    args = parser.parse_args()
+    logger.setLevel(logging.ERROR)
+
+    if args.memory:
+        tracemalloc.start()
+    for size in args.sizes:
+        if args.mongo_uri is None and size > MOCK_MAX_SIZE:
+            print(f"\nSkipping {size} listings, mongomock is too slow past {MOCK_MAX_SIZE}. Pass --mongo-uri to run it")
+            continue
+        print_table(size, benchmark_size(size, args), args.churn)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Throughput of display price parsing over the display prices in notebooks/output/half_processed.csv.
+
+Compares the original split-and-findall functions applied row by row (as pull_from_mongo.ipynb did),
+the single pass scalar parser applied row by row, and the vectorised parser over the whole column.
+
+The CSV is about 7k lines but only 597 records, as the listings' descriptions span lines. The records are
+tiled to `--rows` (7,000 by default), and that table is repeated `--repeat` times to make a bigger backfill.
+
+Usage (from the repo root, with the package installed):
+    python benchmarks/bench_price_parser.py [--rows 7000] [--repeat 100]
+"""
+import argparse
+import re
+import time
+
+import pandas as pd
+
+from DomainAnalysis.prices import parse_display_price, parse_display_prices
+
+CSV_PATH = "notebooks/output/half_processed.csv"
+
+
+def legacy_price(displayPrice, side):
+    """The original wrangler implementation: clean, split on -/to and take the first digits of a side"""
+    displayPrice = displayPrice.replace("$", "")
+    displayPrice = displayPrice.replace(",", "")
+    displayPrice = displayPrice.replace(" ", "")
+    return int(re.findall(r'\d+', re.split(r'-|to', displayPrice)[side])[0])
+
+
+def legacy_min_max(displayPrice):
+    """The original get_min_max_price_from_display_price, with errors ignored as in the notebook"""
+    try:
+        return legacy_price(displayPrice, 0), legacy_price(displayPrice, 1)
+    except Exception:
+        return None
+
+
+def time_it(fn, prices):
+    start = time.perf_counter()
+    fn(prices)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=7000, help="Rows to tile the CSV's records to")
+    parser.add_argument("--repeat", type=int, default=100, help="Times to repeat the rows to make a bigger backfill")
+    args = parser.parse_args()
+
+    column = pd.read_csv(CSV_PATH, usecols=["displayPrice"]).displayPrice
+    tiles = -(-args.rows // len(column))
+    table = pd.concat([column] * tiles, ignore_index=True).iloc[:args.rows]
+    prices = pd.concat([table] * args.repeat, ignore_index=True)
+    print(f"{len(column)} records in {CSV_PATH} ({column.nunique()} distinct display prices), "
+          f"tiled to {len(table)} rows x {args.repeat} = {len(prices)} rows")
+
+    runs = {
+        "legacy row by row": lambda x: x.apply(legacy_min_max),
+        "single pass row by row": lambda x: x.apply(parse_display_price),
+        "vectorised": parse_display_prices,
+    }
+    print(f"{'parser':<24} {'seconds':>9} {'rows/s':>12}")
+    for name, fn in runs.items():
+        elapsed = time_it(fn, prices)
+        print(f"{name:<24} {elapsed:>9.3f} {len(prices) / elapsed:>12,.0f}")
+
+    parsed = parse_display_prices(column)
+    print(f"rows with a minimum price: legacy {column.apply(legacy_min_max).notna().sum()}, "
+          f"single pass {parsed.minimumPrice.notna().sum()}")
+
+
+if __name__ == "__main__":
+    main()
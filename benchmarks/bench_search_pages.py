@@ -0,0 +1,46 @@
+"""Compares fetching search pages one at a time against the concurrent fan-out in
+`get_listings_in_postcode`, against the local fake Domain server.
+
+Usage (from the repo root, with the package installed):
+    python benchmarks/bench_search_pages.py [--latency 0.1] [--workers 4]
+"""
+import argparse
+import logging
+import time
+
+from DomainAnalysis.domain_api import DomainClient, get_listings_in_postcode
+from DomainAnalysis.logger import logger
+from fake_domain import FakeDomainServer
+
+PAGE_SIZE = 200
+
+
+def time_search(server, max_workers):
+    # A client without a request budget so benchmarks don't spend the real daily quota
+    with DomainClient("bench-key", server.base_url) as client:
+        start = time.perf_counter()
+        listings = get_listings_in_postcode("bench-key", ["3195"], page_size=PAGE_SIZE,
+                                            max_workers=max_workers, client=client)
+        elapsed = time.perf_counter() - start
+    assert len(listings) == server.total, f"expected {server.total} listings, got {len(listings)}"
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds the fake server waits per request")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent page requests")
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 2, 5, 10, 20])
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+
+    print(f"{'pages':>6} {'sequential (s)':>15} {'concurrent (s)':>15} {'speedup':>8}")
+    for pages in args.pages:
+        with FakeDomainServer(total=pages * PAGE_SIZE, latency=args.latency) as server:
+            sequential = time_search(server, max_workers=1)
+            concurrent = time_search(server, max_workers=args.workers)
+        print(f"{pages:>6} {sequential:>15.3f} {concurrent:>15.3f} {sequential / concurrent:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Compares the original list-based `which_new_listings` against the set-based, chunked version
+at 1k/10k/100k listing ids, half of which already exist in the database.
+
+By default the collection is held in memory and indexed by listing_id, so the timings isolate the
+client side work. Pass `--mongo-uri` to run against a real MongoDB (a throwaway database is used).
+
+Usage (from the repo root, with the package installed):
+    python benchmarks/bench_which_new_listings.py [--sizes 1000 10000 100000] [--mongo-uri mongodb://localhost]
+"""
+import argparse
+import logging
+import time
+
+from DomainAnalysis.logger import logger
+from DomainAnalysis.mongo import ensure_listing_indexes, which_new_listings
+
+# The original implementation is O(n·m), past this size it takes minutes so it is skipped
+LEGACY_MAX_SIZE = 20000
+
+
+def legacy_which_new_listings(coll, listing_ids, return_existing=False):
+    query = {"listing_id": {"$in": listing_ids}}
+    project = {"listing_id": 1}
+    existing_listing_ids = [x['listing_id'] for x in coll.find(query, project)]
+    if return_existing:
+        return existing_listing_ids
+    return [x for x in listing_ids if x not in existing_listing_ids]
+
+
+class IndexedCollection():
+    """In memory stand-in for a collection with an index on listing_id"""
+    def __init__(self, listing_ids):
+        self.index = {x: {"_id": i, "listing_id": x} for i, x in enumerate(listing_ids)}
+
+    def find(self, query, projection=None):
+        for listing_id in query["listing_id"]["$in"]:
+            if listing_id in self.index:
+                yield {"listing_id": listing_id}
+
+
+def make_collection(existing_ids, mongo_uri):
+    if mongo_uri is None:
+        return IndexedCollection(existing_ids), lambda: None
+    from pymongo import MongoClient
+    client = MongoClient(mongo_uri)
+    coll = client["bench-which-new-listings"].listings
+    coll.drop()
+    coll.insert_many([{"listing_id": x} for x in existing_ids])
+    ensure_listing_indexes(coll)
+    return coll, lambda: client.drop_database("bench-which-new-listings")
+
+
+def time_call(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--mongo-uri", default=None)
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+
+    print(f"{'ids':>8} {'legacy (s)':>12} {'set-based (s)':>14}")
+    for size in args.sizes:
+        listing_ids = list(range(2017000000, 2017000000 + size))
+        coll, cleanup = make_collection(listing_ids[::2], args.mongo_uri)
+        try:
+            new_time, new_ids = time_call(which_new_listings, coll, listing_ids)
+            legacy = "skipped"
+            if size <= LEGACY_MAX_SIZE:
+                legacy_time, legacy_ids = time_call(legacy_which_new_listings, coll, listing_ids)
+                assert legacy_ids == new_ids
+                legacy = f"{legacy_time:.4f}"
+        finally:
+            cleanup()
+        print(f"{size:>8} {legacy:>12} {new_time:>14.4f}")
+
+
+if __name__ == "__main__":
+    main()
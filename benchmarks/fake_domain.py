@@ -0,0 +1,211 @@
+"""A local stand-in for the Domain API used by the benchmarks.
+
+Serves generated search results from `POST /listings/residential/_search` with the
+same pagination headers Domain returns, and generated listing details from `GET /listings/{id}`,
+after sleeping for a configurable latency. Every `rate_limit_every`th request is answered with a
+429 and a `Retry-After` header instead, the way Domain answers when its rate limit is hit.
+
+The listings in the search are ids `first_id` to `first_id + total - 1`. Listings below `first_id` have
+left the search and are returned as sold, so moving `first_id` on between runs simulates listings
+selling and new ones being listed. Listings in `updated_ids` have a later `dateUpdated` and a new
+description, simulating agents editing their listings.
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SEARCH = "search"
+DETAIL = "detail"
+RATE_LIMITED = "rate_limited"
+
+_LISTING_PATH = re.compile(r"(?:/v1)?/listings/(?P<listing_id>\d+)$")
+
+SUBURBS = [("3195", "Mordialloc", -37.999, 145.086), ("3228", "Torquay", -38.331, 144.326),
+           ("3227", "Barwon Heads", -38.273, 144.490), ("3226", "Ocean Grove", -38.264, 144.521)]
+STREETS = ["Melrose Street", "Beach Road", "Main Street", "Bay Road", "Station Street", "Park Crescent"]
+DISPLAY_PRICES = ["${low:,} - ${high:,}", "Offers over ${low:,}", "${low:,}", "Contact Agent", "Auction"]
+DESCRIPTIONS = [
+    "Renovated family home with a solar heated pool, split system air conditioning and a study. Set on 650m2.",
+    "Renovator's delight in original condition on 0.5 acres, moments from the beach. Inspect by appointment.",
+    "Open for inspection Saturday 11:00am - 11:30am. Bay views from the balcony, spa in the ensuite.",
+    "Low maintenance unit close to shops and transport, perfect for first home buyers or investors.",
+]
+
+def updated_date(listing_id, updated):
+    return "2021-10-02T09:30:00Z" if updated else f"2021-09-{listing_id % 28 + 1:02d}T22:29:18.3Z"
+
+def make_search_result(listing_id, updated=False):
+    return {"type": "PropertyListing", "listing": {"id": listing_id, "listingType": "Sale",
+                                                   "dateUpdated": updated_date(listing_id, updated)}}
+
+def make_raw_listing(listing_id, updated=False, sold=False):
+    """Generates the details of a listing, shaped like Domain's response. The same listing id always
+    gives the same listing, so requesting a listing twice gives the same details.
+    """
+    rng = random.Random(listing_id)
+    postcode, suburb, latitude, longitude = rng.choice(SUBURBS)
+    street_number = str(rng.randint(1, 200))
+    street = rng.choice(STREETS)
+    low = rng.randrange(500_000, 2_000_000, 10_000)
+    description = rng.choice(DESCRIPTIONS)
+    if updated:
+        description = "PRICE REDUCED. " + description
+    raw_listing = {
+        "id": listing_id,
+        "status": "live",
+        "dateListed": "2021-09-01T06:43:18Z",
+        "dateUpdated": updated_date(listing_id, updated),
+        "saleDetails": {"saleMethod": rng.choice(["privateTreaty", "auction"])},
+        "saleMode": "buy",
+        "priceDetails": {"displayPrice": rng.choice(DISPLAY_PRICES).format(low=low, high=low + 100_000)},
+        "inspectionDetails": {"isByAppointmentOnly": rng.random() < 0.2},
+        "seoUrl": f"https://www.domain.com.au/{street_number}-{street.lower().replace(' ', '-')}-{listing_id}",
+        "geoLocation": {"latitude": latitude + rng.uniform(-0.02, 0.02),
+                        "longitude": longitude + rng.uniform(-0.02, 0.02)},
+        "addressParts": {
+            "displayType": "fullAddress",
+            "stateAbbreviation": "vic",
+            "streetNumber": street_number,
+            "street": street,
+            "suburb": suburb,
+            "postcode": postcode,
+            "displayAddress": f"{street_number} {street}, {suburb} VIC {postcode}"
+        },
+        "bathrooms": rng.randint(1, 3),
+        "bedrooms": rng.randint(1, 5),
+        "carspaces": rng.randint(0, 3),
+        "description": description,
+        "headline": f"{rng.randint(1, 5)} bedrooms in {suburb}",
+        "isNewDevelopment": False,
+        "propertyTypes": [rng.choice(["house", "townhouse", "apartmentUnitFlat"])],
+        "advertiserIdentifiers": {"advertiserType": "agency", "advertiserId": rng.randint(1000, 9999)},
+        "statementOfInformation": {"documentationUrl": f"https://soi.example.com/{listing_id}.pdf"}
+    }
+    if sold:
+        raw_listing["status"] = "sold"
+        raw_listing["saleDetails"]["soldDetails"] = {"soldDate": "2021-10-01", "soldPrice": low + 50_000}
+    return raw_listing
+
+
+class FakeDomainHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, body, status=200, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _rate_limited(self, kind):
+        """Records the request, waits out the latency and answers with a 429 if it's this request's turn"""
+        server = self.server
+        limited = server.record_request(kind)
+        time.sleep(server.latency)
+        if limited:
+            self._send_json({"message": "API rate limit exceeded"}, status=429,
+                            headers={"Retry-After": str(server.retry_after)})
+        return limited
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        query = json.loads(self.rfile.read(length) or b"{}")
+        server = self.server
+
+        if not self.path.endswith("/listings/residential/_search"):
+            server.record_request(SEARCH)
+            return self._send_json({"detail": "Not found"}, status=404)
+        if self._rate_limited(SEARCH):
+            return
+
+        page_size = query.get("pageSize", 200)
+        page_number = query.get("pageNumber", 1)
+        start = (page_number - 1) * page_size
+        end = min(start + page_size, server.total)
+        listing_ids = range(server.first_id + start, server.first_id + end)
+        results = [make_search_result(x, x in server.updated_ids) for x in listing_ids]
+        self._send_json(results, headers={
+            "X-Total-Count": str(server.total),
+            "X-Pagination-PageNumber": str(page_number),
+            "X-Pagination-PageSize": str(page_size),
+        })
+
+    def do_GET(self):
+        server = self.server
+        match = _LISTING_PATH.search(self.path)
+        if match is None:
+            server.record_request(DETAIL)
+            return self._send_json({"detail": "Not found"}, status=404)
+        if self._rate_limited(DETAIL):
+            return
+
+        listing_id = int(match.group("listing_id"))
+        if listing_id >= server.first_id + server.total:
+            return self._send_json({"message": "Listing not found"}, status=404)
+        self._send_json(make_raw_listing(listing_id, listing_id in server.updated_ids,
+                                         sold=listing_id < server.first_id))
+
+
+class FakeDomainServer(ThreadingHTTPServer):
+    """Fake Domain API served from a background thread while used as a context manager
+
+    Args:
+        total (int, optional): Number of listings in the search. Defaults to 1000.
+        latency (float, optional): Seconds to wait before answering each request. Defaults to 0.05.
+        first_id (int, optional): Id of the first listing in the search. Defaults to 2017000000.
+        port (int, optional): Port to listen on. Defaults to 0, any free port.
+        rate_limit_every (int, optional): Answer every nth request with a 429. Defaults to 0, never.
+        retry_after (float, optional): Seconds given in the `Retry-After` of a 429. Defaults to 0.
+    """
+    daemon_threads = True
+
+    def __init__(self, total=1000, latency=0.05, first_id=2017000000, port=0, rate_limit_every=0, retry_after=0):
+        super().__init__(("127.0.0.1", port), FakeDomainHandler)
+        self.total = total
+        self.latency = latency
+        self.first_id = first_id
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.updated_ids = set()
+        self.request_count = 0
+        self.request_counts = dict.fromkeys((SEARCH, DETAIL, RATE_LIMITED), 0)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address
+        return f"http://{host}:{port}"
+
+    def record_request(self, kind=SEARCH):
+        """Counts a request
+
+        Returns:
+            bool: True if the request should be rate limited
+        """
+        with self._lock:
+            self.request_count += 1
+            self.request_counts[kind] += 1
+            limited = bool(self.rate_limit_every) and self.request_count % self.rate_limit_every == 0
+            if limited:
+                self.request_counts[RATE_LIMITED] += 1
+        return limited
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
@@ -1,93 +1,147 @@
-from prefect import task, Flow, unmapped, Parameter
+from prefect import task, Flow, Parameter
 from prefect.storage.github import GitHub
 from prefect.run_configs.docker import DockerRun
 from prefect.tasks.secrets import PrefectSecret
-from DomainAnalysis.domain_api import get_listings_in_postcode, get_listing
+from DomainAnalysis.descriptions import update_description_features
+from DomainAnalysis.domain_api import get_listings_in_postcode, get_client
+from DomainAnalysis.fetcher import wrangle_listings, QUOTA
+from DomainAnalysis.flow_tasks import (connect_to_mongo, start_or_resume_run, check_for_ended_listings,
+                                       report_request_budget, report_metrics, finish_run)
+from DomainAnalysis.journal import get_journal, fetch_journaled_details, SEARCHED, PLANNED, DETAILED
 from DomainAnalysis.logger import logger
-from DomainAnalysis.mongo import (connect_to_mongo_db, connect_to_domain_raw_collection, 
-                   insert_into_collection, connect_to_domain_listings,
-                   which_new_listings)
-from datetime import datetime
-from DomainAnalysis.wrangler import Listing
+from DomainAnalysis.metrics import time_flow_stage
+from DomainAnalysis.mongo import (connect_to_domain_snapshots, connect_to_domain_runs,
+                   connect_to_domain_listings, connect_to_domain_details,
+                   which_new_listings, which_updated_listings, update_changed_listings, bulk_upsert_listings)
+from DomainAnalysis.quota import get_budget
+from DomainAnalysis.snapshots import store_snapshot, get_run, read_run_listings
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
-@task
-def get_todays_listings_on_domain(domain_key, postcode):
+@task(state_handlers=[time_flow_stage])
+def get_todays_listings_on_domain(client, domain_key, postcode, run_id):
+    # A resumed run reads the search it already stored back rather than searching again
+    runs = connect_to_domain_runs(client)
+    if get_journal().is_complete(run_id, SEARCHED) or get_run(runs, run_id) is not None:
+        listings = read_run_listings(connect_to_domain_snapshots(client), runs, run_id)
+        logger.info("%s listings read back from the stored search of run %s", len(listings), run_id)
+        return listings
     # get new listings
     listings = get_listings_in_postcode(domain_key, postcode)
     if type(listings) is dict:
         if listings['detail'] == "Unable to verify credentials":
-            logger.critical(f"Unable to verify domain credentials")
+            logger.critical("Unable to verify domain credentials")
             raise Exception(f"Unable to verify domain credentials")
-    logger.info(f"{len(listings)} listings returned from domain API")
+    logger.info("%s listings returned from domain API", len(listings))
     return listings
     
-@task
-def upload_raw_listings(client, data):    
-    collection = connect_to_domain_raw_collection(client)
-    # prepare data for upload
-    listings_to_insert = {
-        'listings': data,
-        'created': datetime.utcnow()
-    }
+@task(state_handlers=[time_flow_stage])
+def upload_raw_listings(client, data, run_id):
+    # Store one snapshot per new or changed listing, tagged with today's run id
+    runs = connect_to_domain_runs(client)
+    if get_run(runs, run_id) is None:
+        store_snapshot(connect_to_domain_snapshots(client), runs, data, run_id)
+        logger.info("Successfully inserted today's listings into database as run %s", run_id)
+    get_journal().complete_stage(run_id, SEARCHED)
+    return run_id
 
-    # Insert data
-    objectId = insert_into_collection(collection, listings_to_insert)
-    if objectId:
-        logger.info(f"Successfully inserted today's listings into database")
-    
-    return objectId
-
-@task
+@task(state_handlers=[time_flow_stage])
 def check_for_new_listings(client, listings):
     # connect to db
     collection = connect_to_domain_listings(client)
-    logger.debug(f"Checking which listings are new. Listings: {listings}")
+    logger.debug("Checking which of %s listings are new", len(listings))
     new_listings = which_new_listings(collection, listings)
-    logger.debug(f"There are {len(new_listings)} new listings from a total {len(listings)} listings currently active")
+    logger.debug("There are %s new listings from a total %s listings currently active",
+                 len(new_listings), len(listings))
     return new_listings
 
-@task
+@task(state_handlers=[time_flow_stage])
+def check_for_updated_listings(client, update_dates, refresh_updated):
+    if not refresh_updated:
+        return []
+    collection = connect_to_domain_listings(client)
+    updated_listings = which_updated_listings(collection, update_dates)
+    logger.debug("There are %s listings updated on Domain since they were stored", len(updated_listings))
+    return updated_listings
+
+@task(state_handlers=[time_flow_stage])
 def get_listing_ids(listings):
     return [x['listing']['id'] for x in listings]
 
-@task
-def get_new_listing_details(domain_key, listing_id):
-    logger.debug(f"Getting listing for listing_id: {listing_id}")
-    raw_listing = get_listing(domain_key, listing_id)
-    try:
-        listing = Listing(raw_listing)
-        return listing
-    except Exception as e:
-        logger.critical(f"Unable to create listing class due to: {e}")
-        raise ValueError(f"Unable to create listing class for listing ({listing_id}) due to: {e}")
+@task(state_handlers=[time_flow_stage])
+def get_listing_update_dates(listings):
+    return {x['listing']['id']: x['listing'].get('dateUpdated') for x in listings}
 
-@task
-def add_new_listing_to_mongo(client, listing: Listing):
-    # connect to db
+@task(state_handlers=[time_flow_stage])
+def plan_listing_detail_requests(new_listing_ids, updated_listing_ids, run_id):
+    """Picks the listings to get details for within today's request budget. 
+    Listings deferred from earlier runs go first, then new listings, then listings to refresh.
+    Any that can't be afforded are deferred to the next run.
+    A resumed run keeps the plan it made before, as the listings it already stored are no longer new.
+    """
+    journal = get_journal()
+    if journal.is_complete(run_id, PLANNED):
+        return journal.stage_result(run_id, PLANNED)
+    listing_ids = get_budget().plan_details(new_listing_ids + updated_listing_ids)
+    journal.complete_stage(run_id, PLANNED, listing_ids)
+    return listing_ids
+
+@task(state_handlers=[time_flow_stage])
+def get_new_listing_details(client, domain_key, listing_ids, run_id):
+    """Gets the details of all the new listings. Listings that fail are logged rather than
+    failing the batch and any the request budget ran out for are deferred to the next run.
+    The raw details are stored as they arrive, so the listings can be wrangled again later
+    (see `DomainAnalysis.backfill`) and a resumed run doesn't request them again.
+    """
+    logger.debug("Getting listings for %s listing_ids", len(listing_ids))
+    listing_ids = list(dict.fromkeys(listing_ids))
+    journal = get_journal()
+    raw_listings, errors = fetch_journaled_details(journal, run_id, get_client(domain_key),
+                                                   connect_to_domain_details(client), listing_ids)
+    journal.complete_stage(run_id, DETAILED)
+    listings, errors = wrangle_listings(listing_ids, raw_listings, errors)
+    for listing_id, error in errors.items():
+        logger.error("Unable to get listing (%s) during %s: %s", listing_id, error['stage'], error['error'])
+    deferred = [listing_id for listing_id, error in errors.items() if error['stage'] == QUOTA]
+    if deferred:
+        logger.warning("Request budget ran out, deferring %s listings to the next run", len(deferred))
+        get_budget().defer(deferred)
+    return listings
+
+@task(nout=2, state_handlers=[time_flow_stage])
+def split_new_and_updated_listings(client, listings):
+    """Splits the fetched listings into those new to the database and those already stored"""
     collection = connect_to_domain_listings(client)
-    # TODO: Add handle if listing is "NoneType"
-    objectId = insert_into_collection(collection, listing.as_no_nested_dicts())
-    if objectId:
-        logger.info(f"Successfully inserted listing ({listing.listing_id}) into database")
-    return objectId
+    existing_ids = set(which_new_listings(collection, [x.listing_id for x in listings], return_existing=True))
+    new_listings = [x for x in listings if x.listing_id not in existing_ids]
+    updated_listings = [x for x in listings if x.listing_id in existing_ids]
+    return new_listings, updated_listings
 
-@task
-def connect_to_mongo(db_user, db_password):
-    """Connects to domain analysis mongo db
+@task(state_handlers=[time_flow_stage])
+def update_listings_in_mongo(client, listings):
+    collection = connect_to_domain_listings(client)
+    modified = update_changed_listings(collection, listings)
+    logger.info("Refreshed %s of %s updated listings in database", modified, len(listings))
+    return modified
 
-    Args:
-        db_user (str): username
-        db_password (str): MongoDB password
+@task(state_handlers=[time_flow_stage])
+def add_new_listings_to_mongo(client, listings):
+    # connect to db
+    collection = connect_to_domain_listings(client)
+    results = bulk_upsert_listings(collection, listings)
+    inserted = sum(x['inserted'] for x in results)
+    errors = [error for x in results for error in x['errors']]
+    logger.info("Successfully inserted %s of %s new listings into database", inserted, len(listings))
+    if errors:
+        logger.error("Unable to insert %s listings: %s", len(errors), errors)
+    return results
 
-    Returns:
-        client: MongoDB database
-    """
-    return connect_to_mongo_db(db_user, db_password)
-    
-    
+@task(state_handlers=[time_flow_stage])
+def find_description_features(client, listings):
+    # Only listings whose headline or description changed have their features found again
+    collection = connect_to_domain_listings(client)
+    return update_description_features(collection, [x.listing_id for x in listings])
 
 with Flow("scrape-raw-from-domain") as flow:
     # Creds
@@ -97,6 +151,7 @@ with Flow("scrape-raw-from-domain") as flow:
     
     # Params
     postcodes = Parameter('postcodes', default=["3228","3227","3226","3230","3231", "3220", "3218", "3195"])
+    refresh_updated = Parameter('refresh_updated', default=True)
     
     # Connect to Mongo
     client = connect_to_mongo(db_user, db_password)
@@ -109,18 +164,32 @@ with Flow("scrape-raw-from-domain") as flow:
     # 3220: Geelong City / Newtown
     # 3218: Geelong West
     
-    listings = get_todays_listings_on_domain(domain_key, postcodes)
-    objectId = upload_raw_listings(client, listings)
+    # Resume the last run if it died part way through
+    run_id = start_or_resume_run()
+    listings = get_todays_listings_on_domain(client, domain_key, postcodes, run_id)
+    run_id = upload_raw_listings(client, listings, run_id)
     # Check which listings are new
     listing_ids = get_listing_ids(listings)
     new_listing_ids = check_for_new_listings(client, listing_ids)
-    # Get details for new listings
-    new_listings = get_new_listing_details.map(unmapped(domain_key), new_listing_ids)
+    # Check which stored listings have been updated on Domain
+    update_dates = get_listing_update_dates(listings)
+    updated_listing_ids = check_for_updated_listings(client, update_dates, refresh_updated)
+    # Only request the details today's budget can afford
+    listing_ids_to_fetch = plan_listing_detail_requests(new_listing_ids, updated_listing_ids, run_id)
+    # Get details for new and updated listings
+    fetched_listings = get_new_listing_details(client, domain_key, listing_ids_to_fetch, run_id)
+    new_listings, updated_listings = split_new_and_updated_listings(client, fetched_listings)
     # Upload new listings to mongo
-    new_listing_objectIds = add_new_listing_to_mongo.map(unmapped(client), new_listings)
-    # Check which listings are sold
-    
+    new_listing_results = add_new_listings_to_mongo(client, new_listings)
     # Update listing in mongo
+    refreshed_count = update_listings_in_mongo(client, updated_listings)
+    # Find features in the descriptions of new and updated listings
+    features_count = find_description_features(client, fetched_listings, upstream_tasks=[new_listing_results, refreshed_count])
+    # Check which listings are sold
+    ended_listings = check_for_ended_listings(client, domain_key, run_id, upstream_tasks=[fetched_listings])
+    budget_metrics = report_request_budget(upstream_tasks=[new_listing_results, refreshed_count, ended_listings])
+    run_metrics = report_metrics(run_id, upstream_tasks=[budget_metrics, features_count])
+    finished = finish_run(run_id, upstream_tasks=[run_metrics])
     
 flow.run()
 
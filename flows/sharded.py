@@ -0,0 +1,85 @@
+from prefect import task, Flow, Parameter, unmapped
+from prefect.executors import LocalDaskExecutor
+from prefect.storage.github import GitHub
+from prefect.run_configs.docker import DockerRun
+from prefect.tasks.secrets import PrefectSecret
+from DomainAnalysis.flow_tasks import (connect_to_mongo, start_or_resume_run, check_for_ended_listings,
+                                       report_request_budget, report_metrics, finish_run)
+from DomainAnalysis.journal import get_journal, SEARCHED, DETAILED
+from DomainAnalysis.logger import logger
+from DomainAnalysis.metrics import time_flow_stage
+from DomainAnalysis.mongo import connect_to_domain_listings, connect_to_domain_runs
+from DomainAnalysis.sharding import plan_shards, run_shard, merge_shards
+from DomainAnalysis.snapshots import get_run
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+@task(state_handlers=[time_flow_stage])
+def plan_postcode_shards(client, postcodes, workers):
+    """Splits the postcodes into a shard per worker with about as many listings each, see `DomainAnalysis.sharding`"""
+    return plan_shards(connect_to_domain_listings(client), postcodes, workers)
+
+@task(state_handlers=[time_flow_stage])
+def scrape_shard(client, shard, run_id, domain_key, refresh_updated):
+    """Searches, fetches, wrangles and stores the listings in a shard's postcodes with the shard's share
+    of the request budget, with its own connections to Domain.
+    The shards are journaled as a whole once they're merged. A resumed run whose shards were merged
+    isn't scraped again, otherwise every shard is scraped again under the same run id. The listings
+    already stored are no longer new, so their details aren't requested again.
+    """
+    if _is_merged(client, run_id):
+        return None
+    return run_shard(shard, run_id, domain_key, connect=lambda: client, refresh_updated=refresh_updated)
+
+@task(state_handlers=[time_flow_stage])
+def merge_shard_runs(client, run_id, summaries):
+    """Stores the run's manifest with each listing once, however many shards found it"""
+    journal = get_journal()
+    if _is_merged(client, run_id):
+        logger.info("The shards of run %s have already been merged", run_id)
+        return journal.stage_result(run_id, DETAILED)
+    summary = merge_shards(connect_to_domain_runs(client), run_id, summaries)
+    journal.complete_stage(run_id, SEARCHED)
+    journal.complete_stage(run_id, DETAILED, summary)
+    logger.info("Run %s across %s shards: %s listings searched, %s fetched, %s inserted, %s refreshed",
+                run_id, summary['shards'], summary['searched'], summary['fetched'], summary['inserted'],
+                summary['refreshed'])
+    return summary
+
+def _is_merged(client, run_id):
+    return get_journal().is_complete(run_id, DETAILED) or get_run(connect_to_domain_runs(client), run_id) is not None
+
+with Flow("scrape-raw-from-domain-sharded") as flow:
+    # Creds
+    db_user = PrefectSecret('MONGO_USERNAME')
+    db_password = PrefectSecret('MONGO_PASSWORD')
+    domain_key = PrefectSecret('DOMAIN_API_KEY')
+
+    # Params
+    postcodes = Parameter('postcodes', default=["3228","3227","3226","3230","3231", "3220", "3218", "3195"])
+    refresh_updated = Parameter('refresh_updated', default=True)
+    workers = Parameter('workers', default=4)
+
+    client = connect_to_mongo(db_user, db_password)
+    # Resume the last run if it died part way through
+    run_id = start_or_resume_run()
+    # One shard per worker, balanced by how many listings each postcode has had
+    shards = plan_postcode_shards(client, postcodes, workers)
+    summaries = scrape_shard.map(unmapped(client), shards, unmapped(run_id), unmapped(domain_key),
+                                 unmapped(refresh_updated))
+    run_summary = merge_shard_runs(client, run_id, summaries)
+    # Check which listings are sold
+    ended_listings = check_for_ended_listings(client, domain_key, run_id, upstream_tasks=[run_summary])
+    budget_metrics = report_request_budget(upstream_tasks=[ended_listings])
+    run_metrics = report_metrics(run_id, upstream_tasks=[budget_metrics])
+    finished = finish_run(run_id, upstream_tasks=[run_metrics])
+
+# Shards run at the same time on threads sharing the Mongo client, set num_workers to at least the `workers` parameter.
+# `python -m DomainAnalysis.sharding` runs each shard in its own process instead
+flow.executor = LocalDaskExecutor(scheduler="threads", num_workers=int(os.environ.get("FLOW_WORKERS", 4)))
+flow.run()
+
+flow.storage = GitHub(repo = "ZacHooper/realestate-analysis", path="/flows/sharded.py")
+flow.run_config = DockerRun(image = "zhooper/domain-analysis")
+# flow.register(project_name="realestate-analysis", labels=["testing"])
@@ -0,0 +1,62 @@
+from prefect import task, Flow, Parameter
+from prefect.storage.github import GitHub
+from prefect.run_configs.docker import DockerRun
+from prefect.tasks.secrets import PrefectSecret
+from DomainAnalysis.domain_api import get_client
+from DomainAnalysis.flow_tasks import (connect_to_mongo, start_or_resume_run, check_for_ended_listings,
+                                       report_request_budget, report_metrics, finish_run)
+from DomainAnalysis.journal import get_journal, SEARCHED, DETAILED
+from DomainAnalysis.logger import logger
+from DomainAnalysis.metrics import time_flow_stage
+from DomainAnalysis.mongo import connect_to_domain_runs
+from DomainAnalysis.quota import get_budget
+from DomainAnalysis.snapshots import get_run
+from DomainAnalysis.streaming import stream_listings
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+@task(state_handlers=[time_flow_stage])
+def stream_todays_listings(client, domain_key, postcodes, refresh_updated, run_id):
+    """Searches, fetches, wrangles and stores today's listings with every stage running at once,
+    see `DomainAnalysis.streaming`.
+    The stream is journaled as a whole rather than listing by listing. A resumed run whose stream finished
+    isn't streamed again, and one whose stream died part way is streamed again under the same run id. The
+    listings it already stored are no longer new, so their details aren't requested again.
+    """
+    journal = get_journal()
+    if journal.is_complete(run_id, DETAILED) or get_run(connect_to_domain_runs(client), run_id) is not None:
+        logger.info("Run %s has already been streamed", run_id)
+        return run_id
+    summary = stream_listings(client, get_client(domain_key), postcodes, run_id=run_id, budget=get_budget(),
+                              refresh_updated=refresh_updated)
+    journal.complete_stage(run_id, SEARCHED)
+    journal.complete_stage(run_id, DETAILED, summary)
+    return run_id
+
+with Flow("scrape-raw-from-domain-streaming") as flow:
+    # Creds
+    db_user = PrefectSecret('MONGO_USERNAME')
+    db_password = PrefectSecret('MONGO_PASSWORD')
+    domain_key = PrefectSecret('DOMAIN_API_KEY')
+
+    # Params
+    postcodes = Parameter('postcodes', default=["3228","3227","3226","3230","3231", "3220", "3218", "3195"])
+    refresh_updated = Parameter('refresh_updated', default=True)
+
+    client = connect_to_mongo(db_user, db_password)
+    # Resume the last run if it died part way through
+    run_id = start_or_resume_run()
+    # Search pages, detail requests and writes to Mongo all overlap
+    run_id = stream_todays_listings(client, domain_key, postcodes, refresh_updated, run_id)
+    # Check which listings are sold
+    ended_listings = check_for_ended_listings(client, domain_key, run_id)
+    budget_metrics = report_request_budget(upstream_tasks=[ended_listings])
+    run_metrics = report_metrics(run_id, upstream_tasks=[budget_metrics])
+    finished = finish_run(run_id, upstream_tasks=[run_metrics])
+
+flow.run()
+
+flow.storage = GitHub(repo = "ZacHooper/realestate-analysis", path="/flows/streaming.py")
+flow.run_config = DockerRun(image = "zhooper/domain-analysis")
+# flow.register(project_name="realestate-analysis", labels=["testing"])
@@ -0,0 +1,9 @@
+import mongomock
+import pytest
+from mongomock_patch import bulk_write
+
+@pytest.fixture
+def mongo_db(monkeypatch):
+    """In memory `raw-requests` database, with bulk_write patched, see `mongomock_patch`"""
+    monkeypatch.setattr(mongomock.Collection, "bulk_write", bulk_write)
+    return mongomock.MongoClient()['raw-requests']
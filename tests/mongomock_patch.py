@@ -0,0 +1,17 @@
+"""mongomock can't run the UpdateOne operations of newer versions of pymongo through bulk_write, so the
+tests and benchmarks patch `mongomock.Collection.bulk_write` with this, which applies them one at a time
+with update_one instead.
+"""
+from pymongo.results import BulkWriteResult
+
+def bulk_write(self, requests, ordered=True, **kwargs):
+    counts = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0,
+              'upserted': [], 'writeErrors': [], 'writeConcernErrors': []}
+    for index, request in enumerate(requests):
+        res = self.update_one(request._filter, request._doc, upsert=request._upsert)
+        if res.upserted_id is not None:
+            counts['nUpserted'] += 1
+            counts['upserted'].append({'index': index, '_id': res.upserted_id})
+        counts['nMatched'] += res.matched_count
+        counts['nModified'] += res.modified_count
+    return BulkWriteResult(counts, True)
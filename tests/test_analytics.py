@@ -0,0 +1,76 @@
+import mongomock
+import pytest
+from datetime import datetime, timezone
+from DomainAnalysis.analytics import export_listings_to_parquet, load_listings, parse_timestamp, read_watermark
+
+def make_listing(listing_id, postcode="3195", suburb="Mordialloc", date_listed="2021-09-24T06:43:18Z"):
+    return {
+        "listing_id": listing_id,
+        "created": "2021-09-30T02:26:12.895734",
+        "dateListed": date_listed,
+        "dateUpdated": "2021-09-27T22:29:18.3Z",
+        "saleMethod": "auction",
+        "displayPrice": "$950,000 - $1,050,000",
+        "minimumPrice": 950000,
+        "maximumPrice": 1050000,
+        "inspectionsByAppointmentOnly": False,
+        "location_suburb": suburb,
+        "location_postcode": postcode,
+        "location_streetNumber": "12C",
+        "house_bathrooms": 2,
+        "house_propertyType": "house",
+        "house_description": "A long description",
+        "agent_advertiserId": 5600,
+    }
+
+@pytest.fixture
+def coll():
+    return mongomock.MongoClient()['raw-requests'].listings
+
+def test_parse_timestamp():
+    assert parse_timestamp("2021-09-27T22:29:18.3Z") == datetime(2021, 9, 27, 22, 29, 18, 300000, tzinfo=timezone.utc)
+    assert parse_timestamp("2021-09-30T02:26:12.895734") == datetime(2021, 9, 30, 2, 26, 12, 895734, tzinfo=timezone.utc)
+    assert parse_timestamp(None) is None
+    assert parse_timestamp("not a date") is None
+
+def test_export_only_appends_new_listings(coll, tmp_path):
+    root = str(tmp_path / "listings")
+    coll.insert_many([make_listing(1), make_listing(2, "3228", "Torquay", "2021-10-02T00:00:00Z")])
+    assert export_listings_to_parquet(coll, root) == 2
+    assert export_listings_to_parquet(coll, root) == 0
+    coll.insert_one(make_listing(3))
+    assert export_listings_to_parquet(coll, root) == 1
+    assert read_watermark(root) == (coll.find_one({"listing_id": 3})['_id'], None)
+    assert sorted(load_listings(root).listing_id) == [1, 2, 3]
+
+def test_load_listings_types_and_filters(coll, tmp_path):
+    root = str(tmp_path / "listings")
+    coll.insert_many([make_listing(1), make_listing(2, "3228", "Torquay", "2021-10-02T00:00:00Z")])
+    export_listings_to_parquet(coll, root)
+    listings = load_listings(root, columns=["listing_id", "suburb", "dateListed", "advertiserId"], postcodes=["3195"])
+    assert list(listings.listing_id) == [1]
+    assert listings.suburb.dtype == "category"
+    assert listings.advertiserId.dtype == "category"
+    assert str(listings.dateListed.dtype).startswith("datetime64")
+    assert list(load_listings(root, columns=["listing_id"], listed_months=["2021-10"]).listing_id) == [2]
+
+def test_export_replaces_modified_listings(coll, tmp_path):
+    root = str(tmp_path / "listings")
+    coll.insert_many([make_listing(1), make_listing(2), make_listing(3, "3228", "Torquay")])
+    assert export_listings_to_parquet(coll, root) == 3
+    # The SOI price is found for one listing and another is relisted, moving it to a new partition
+    coll.update_one({"listing_id": 1}, {"$set": {"soi_minimumPrice": 900000}, "$currentDate": {"modified": True}})
+    coll.update_one({"listing_id": 2}, {"$set": {"dateListed": "2021-10-05T00:00:00Z", "status": "sold"},
+                                        "$currentDate": {"modified": True}})
+    assert export_listings_to_parquet(coll, root) == 2
+    assert read_watermark(root)[1] == coll.find_one({"listing_id": 2})['modified']
+
+    listings = load_listings(root).set_index("listing_id").sort_index()
+    assert list(listings.index) == [1, 2, 3]
+    assert listings.soi_minimumPrice[1] == 900000
+    assert listings.status[2] == "sold"
+    assert list(load_listings(root, columns=["listing_id"], listed_months=["2021-10"]).listing_id) == [2]
+    assert sorted(load_listings(root, columns=["listing_id"], postcodes=["3195"]).listing_id) == [1, 2]
+    # Listings exported again within the overlap are replaced, not duplicated
+    assert export_listings_to_parquet(coll, root) == 2
+    assert sorted(load_listings(root, columns=["listing_id"]).listing_id) == [1, 2, 3]
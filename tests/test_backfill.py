@@ -0,0 +1,88 @@
+import json
+import pytest
+from DomainAnalysis import backfill as backfill_module
+from DomainAnalysis.backfill import (backfill, iter_raw_listings_from_file, iter_raw_listings_from_mongo, read_checkpoint,
+                                   WRANGLE, WRITE)
+
+@pytest.fixture
+def dump(tmp_path):
+    with open('examples/raw_listing.json', 'r') as infile:
+        raw_listing = json.load(infile)
+    path = tmp_path / "details.ndjson"
+    with open(path, "w") as outfile:
+        for listing_id in range(1, 6):
+            outfile.write(json.dumps(dict(raw_listing, id=listing_id)) + "\n")
+        # Documents exported from the details collection hold the raw listing
+        outfile.write(json.dumps({'listing_id': 6, 'listing': dict(raw_listing, id=6)}) + "\n")
+        outfile.write(json.dumps({'id': 7}) + "\n")
+    return str(path)
+
+def test_iter_raw_listings_from_file_unwraps_details(dump):
+    assert [x['id'] for x in iter_raw_listings_from_file(dump)] == list(range(1, 8))
+
+def test_backfill_writes_listings_and_reports_failures(dump, tmp_path, mongo_db):
+    coll = mongo_db.listings
+    checkpoint, failures = str(tmp_path / "checkpoint.json"), str(tmp_path / "failures.ndjson")
+    summary = backfill(iter_raw_listings_from_file(dump), coll, dump, partition_size=2, workers=2,
+                       checkpoint_path=checkpoint, failures_path=failures)
+    assert summary['partitions'] == 4
+    assert summary['inserted'] == 6
+    assert summary['failed'] == 1
+    assert sorted(coll.distinct("listing_id")) == list(range(1, 7))
+    with open(failures) as infile:
+        failure = json.loads(infile.readline())
+    assert failure['listing_id'] == 7 and failure['stage'] == WRANGLE and failure['partition'] == 3
+    assert read_checkpoint(checkpoint, dump) == (7, set())
+
+def test_backfill_resumes_from_checkpoint(dump, tmp_path, mongo_db):
+    coll = mongo_db.listings
+    checkpoint = str(tmp_path / "checkpoint.json")
+    backfill(iter_raw_listings_from_file(dump), coll, dump, partition_size=2, workers=1,
+             checkpoint_path=checkpoint, failures_path=None)
+    summary = backfill(iter_raw_listings_from_file(dump), coll, dump, partition_size=2, workers=1,
+                       checkpoint_path=checkpoint, failures_path=None)
+    assert summary['skipped'] == 7 and summary['partitions'] == 0
+    with pytest.raises(ValueError):
+        backfill(iter_raw_listings_from_file(dump), coll, "another dump", checkpoint_path=checkpoint)
+
+def test_resume_isnt_thrown_by_details_stored_since(tmp_path, mongo_db):
+    with open('examples/raw_listing.json', 'r') as infile:
+        raw_listing = json.load(infile)
+    details, checkpoint = mongo_db.details, str(tmp_path / "checkpoint.json")
+    details.insert_many([{'listing_id': x, 'listing': dict(raw_listing, id=x)} for x in (10, 20, 30, 40)])
+    # The backfill stops after its first partition
+    first_partition = (x for i, x in enumerate(iter_raw_listings_from_mongo(details)) if i < 2)
+    backfill(first_partition, mongo_db.listings, "mongo:details", partition_size=2, workers=1,
+             checkpoint_path=checkpoint, failures_path=None)
+    assert read_checkpoint(checkpoint, "mongo:details") == (20, set())
+    # A detail with a lower listing id is stored before it's resumed
+    details.insert_one({'listing_id': 5, 'listing': dict(raw_listing, id=5)})
+    last_listing_id, retry = read_checkpoint(checkpoint, "mongo:details")
+    summary = backfill(iter_raw_listings_from_mongo(details, last_listing_id, retry), mongo_db.listings,
+                       "mongo:details", partition_size=2, workers=1, checkpoint_path=checkpoint, failures_path=None)
+    assert summary['wrangled'] == 2 and summary['inserted'] == 2
+    assert sorted(mongo_db.listings.distinct("listing_id")) == [10, 20, 30, 40]
+
+def test_listings_that_fail_to_be_written_are_retried(dump, tmp_path, mongo_db, monkeypatch):
+    checkpoint, failures = str(tmp_path / "checkpoint.json"), str(tmp_path / "failures.ndjson")
+    write_rows = backfill_module.bulk_upsert_rows
+
+    def fail_listing_3(coll, rows):
+        rows = list(rows)
+        results = write_rows(coll, [x for x in rows if x['listing_id'] != 3])
+        if any(x['listing_id'] == 3 for x in rows):
+            results[-1]['errors'].append({'listing_id': 3, 'error': "write failed"})
+        return results
+    monkeypatch.setattr(backfill_module, "bulk_upsert_rows", fail_listing_3)
+    backfill(iter_raw_listings_from_file(dump), mongo_db.listings, dump, partition_size=2, workers=1,
+             checkpoint_path=checkpoint, failures_path=failures)
+    assert read_checkpoint(checkpoint, dump) == (7, {3})
+    with open(failures) as infile:
+        assert {'listing_id': 3, 'stage': WRITE} in [{k: json.loads(x)[k] for k in ('listing_id', 'stage')} for x in infile]
+
+    monkeypatch.setattr(backfill_module, "bulk_upsert_rows", write_rows)
+    summary = backfill(iter_raw_listings_from_file(dump), mongo_db.listings, dump, partition_size=2, workers=1,
+                       checkpoint_path=checkpoint, failures_path=None)
+    assert summary['wrangled'] == 1 and summary['skipped'] == 6
+    assert read_checkpoint(checkpoint, dump) == (7, set())
+    assert 3 in mongo_db.listings.distinct("listing_id")
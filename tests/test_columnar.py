@@ -0,0 +1,76 @@
+import copy
+import json
+import pytest
+from DomainAnalysis.columnar import raw_listings_to_frame, iter_raw_listing_frames, frame_to_records
+from DomainAnalysis.wrangler import Listing
+
+@pytest.fixture
+def raw_listings():
+    raw_listings = []
+    for name in ('raw_listing', 'faulty_inspectionDetails', 'faulty_streetNumber'):
+        with open(f'examples/{name}.json', 'r') as infile:
+            raw_listings.append(json.load(infile))
+    return raw_listings
+
+def test_frame_matches_listing(raw_listings):
+    records = frame_to_records(raw_listings_to_frame(raw_listings, created="2021-10-01T00:00:00"))
+    for raw_listing, record in zip(raw_listings, records):
+        expected = Listing(raw_listing).as_no_nested_dicts()
+        expected['created'] = "2021-10-01T00:00:00"
+        assert list(record) == list(expected)
+        assert record == expected
+
+@pytest.mark.parametrize("priceDetails", [
+    {'displayPrice': "$600,000 - 650,000"},
+    {'displayPrice': "Offers 600K-650K"},
+    {'displayPrice': "$1.1 - 1.2M"},
+    {'displayPrice': "$850K"},
+    {'displayPrice': "Contact Agent"},
+    {'displayPrice': "Offers $900,000 - $1,000,000"},
+    {'displayPrice': "Offers $900,000 - $1,000,000", 'minimumPrice': 880000},
+    {'displayPrice': "Offers $900,000 - $1,000,000", 'maximumPrice': 1020000},
+    {'displayPrice': "Offers $900,000 - $1,000,000", 'minimumPrice': 880000, 'maximumPrice': 1020000},
+    {'displayPrice': "Auction", 'price': 700000},
+])
+def test_frame_matches_listing_prices(raw_listings, priceDetails):
+    raw_listing = copy.deepcopy(raw_listings[0])
+    raw_listing['priceDetails'] = priceDetails
+    record = frame_to_records(raw_listings_to_frame([raw_listing], created="2021-10-01T00:00:00"))[0]
+    expected = Listing(raw_listing).as_no_nested_dicts()
+    expected['created'] = "2021-10-01T00:00:00"
+    for field, value in expected.items():
+        assert record[field] == value, field
+    assert list(record) == list(expected)
+
+def test_price_fallbacks(raw_listings):
+    listed_price = copy.deepcopy(raw_listings[0])
+    listed_price['priceDetails']['price'] = 700000
+    several_prices = copy.deepcopy(raw_listings[0])
+    several_prices['priceDetails'] = {'displayPrice': "Offers $900,000 - $1,000,000", 'minimumPrice': 880000}
+    no_price = copy.deepcopy(raw_listings[0])
+    no_price['priceDetails'] = {'displayPrice': "Contact Agent"}
+    frame = raw_listings_to_frame([listed_price, several_prices, no_price])
+    assert frame.minimumPrice.tolist()[:2] == [700000, 880000]
+    assert frame.maximumPrice.tolist()[:2] == [700000, 1000000]
+    assert frame.minimumPrice.isna().tolist() == [False, False, True]
+
+def test_suburb_only_address(raw_listings):
+    raw_listing = copy.deepcopy(raw_listings[0])
+    raw_listing['addressParts']['displayType'] = 'suburbOnly'
+    row = raw_listings_to_frame([raw_listing]).iloc[0]
+    assert row.location_street is None
+    assert row.location_streetNumber is None
+    assert row.location_suburb == "Mordialloc"
+    assert row.location_state == "VIC"
+
+def test_missing_fields_are_null():
+    records = frame_to_records(raw_listings_to_frame([{'id': 1, 'priceDetails': {}}]))
+    assert records[0]['listing_id'] == 1
+    assert records[0]['minimumPrice'] is None
+    assert records[0]['location_latitude'] is None
+    assert records[0]['house_propertyType'] is None
+
+def test_iter_frames_batches(raw_listings):
+    frames = list(iter_raw_listing_frames(iter(raw_listings * 3), batch_size=4))
+    assert [len(x) for x in frames] == [4, 4, 1]
+    assert frames[0].created.nunique() == 1 and frames[0].created[0] == frames[-1].created[0]
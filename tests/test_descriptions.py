@@ -0,0 +1,43 @@
+import pandas as pd
+from DomainAnalysis.descriptions import (extract_description_features, extract_many, add_description_features,
+                                         update_description_features, FEATURE_NAMES)
+
+DESCRIPTION = ("OPEN FOR PRIVATE INSPECTION SAT 2ND OCTOBER - 11:00AM - 12:30PM\r\n"
+               "Renovated home with a solar heated pool and ocean views on 650sqm. Also open 1pm to 1.30pm.")
+
+def test_extract_description_features():
+    features = extract_description_features(DESCRIPTION)
+    assert features['pool'] and features['solar'] and features['renovated'] and features['water_views']
+    assert features['by_appointment']
+    assert not features['spa'] and not features['needs_renovation']
+    assert features['land_size_sqm'] == 650
+    assert features['inspection_times'] == ["11:00-12:30", "13:00-13:30"]
+
+def test_extract_description_features_edge_cases():
+    features = extract_description_features("A renovator's delight with a pool table on 1.5 acres, 120 m2 home")
+    assert features['needs_renovation']
+    assert not features['pool']
+    assert round(features['land_size_sqm']) == 6070
+    assert extract_description_features(None)['land_size_sqm'] is None
+
+def test_extract_many_in_a_process_pool():
+    texts = [DESCRIPTION, "Spa and study", DESCRIPTION] * 4
+    assert extract_many(texts, workers=2, chunksize=1) == extract_many(texts)
+
+def test_add_description_features():
+    frame = pd.DataFrame({'house_headline': ["Big block", None], 'house_description': ["1,012 sqm", "Pool"]})
+    features = add_description_features(frame)
+    assert list(features.columns[2:]) == [f"features_{x}" for x in FEATURE_NAMES]
+    assert features.features_land_size_sqm[0] == 1012
+    assert features.features_pool.tolist() == [False, True]
+
+def test_features_only_found_again_when_text_changes(mongo_db):
+    coll = mongo_db.listings
+    coll.insert_many([{"listing_id": 1, "house_headline": "Pool", "house_description": "With a spa"},
+                      {"listing_id": 2, "house_headline": "Study", "house_description": None}])
+    assert update_description_features(coll) == 2
+    assert coll.find_one({"listing_id": 1})['features_spa']
+    assert update_description_features(coll) == 0
+    coll.update_one({"listing_id": 2}, {"$set": {"house_description": "Now with solar"}})
+    assert update_description_features(coll, listing_ids=[1, 2]) == 1
+    assert coll.find_one({"listing_id": 2})['features_solar']
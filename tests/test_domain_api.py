@@ -1,6 +1,11 @@
 import os
+import pytest
 from DomainAnalysis.wrangler import Listing
-from DomainAnalysis.domain_api import build_location_parameter, build_query, need_to_run_again
+from DomainAnalysis import domain_api
+from DomainAnalysis.domain_api import (build_location_parameter, build_query, need_to_run_again,
+                                       merge_search_pages, get_listings_in_postcode, iter_search_pages,
+                                       parse_retry_after, DomainClient)
+from DomainAnalysis.quota import RequestBudget
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -36,3 +41,75 @@ def test_need_to_run_again_false():
     x_page = 2
     page_size = 200
     assert ~ need_to_run_again(x_page_count, x_page, page_size)
+
+def test_merge_search_pages_keeps_page_order_and_drops_duplicates():
+    page_1 = [{"listing": {"id": 1}}, {"listing": {"id": 2}}]
+    page_2 = [{"listing": {"id": 2}}, {"listing": {"id": 3}}]
+    merged = merge_search_pages([page_1, page_2])
+    assert [x['listing']['id'] for x in merged] == [1, 2, 3]
+
+class FakeSearchResponse():
+    def __init__(self, total, page_number, page_size):
+        start = (page_number - 1) * page_size
+        self.body = [{"listing": {"id": i}} for i in range(start, min(start + page_size, total))]
+        self.headers = {"X-Total-Count": str(total), "X-Pagination-PageNumber": str(page_number)}
+
+    def json(self):
+        return self.body
+
+def test_get_listings_in_postcode_fetches_every_page(monkeypatch):
+    requested_pages = []
+    def fake_search_page(client, data):
+        requested_pages.append(data['pageNumber'])
+        return FakeSearchResponse(450, data['pageNumber'], data['pageSize'])
+    monkeypatch.setattr(domain_api, "search_page", fake_search_page)
+    
+    listings = get_listings_in_postcode("key", ["3228"], page_size=200, client=DomainClient("key"))
+    assert sorted(requested_pages) == [1, 2, 3]
+    assert [x['listing']['id'] for x in listings] == list(range(450))
+
+def test_iter_search_pages_yields_pages_in_order(monkeypatch):
+    monkeypatch.setattr(domain_api, "search_page",
+                        lambda client, data: FakeSearchResponse(1000, data['pageNumber'], data['pageSize']))
+    pages = list(iter_search_pages(DomainClient("key"), ["3228"], page_size=100, max_workers=3))
+    assert len(pages) == 10
+    assert [x['listing']['id'] for page in pages for x in page] == list(range(1000))
+
+def test_parse_retry_after():
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert parse_retry_after("soon") is None
+
+class FakeResponse():
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+def test_client_retries_with_retry_after(monkeypatch):
+    responses = [FakeResponse(429, {"Retry-After": "2"}), FakeResponse(503), FakeResponse(200)]
+    waits = []
+    client = DomainClient("key")
+    monkeypatch.setattr(client.session, "request", lambda *args, **kwargs: responses.pop(0))
+    monkeypatch.setattr(domain_api.time, "sleep", waits.append)
+    
+    res = client.get_listing(123)
+    assert res.status_code == 200
+    assert waits[0] == 2.0
+    assert 0 <= waits[1] <= client.backoff_factor * 2
+
+def test_client_does_not_wait_on_long_retry_after(monkeypatch):
+    client = DomainClient("key", max_backoff=60)
+    monkeypatch.setattr(client.session, "request", lambda *args, **kwargs: FakeResponse(429, {"Retry-After": "3600"}))
+    monkeypatch.setattr(domain_api.time, "sleep", lambda wait: pytest.fail("should not wait"))
+    assert client.get_listing(123).status_code == 429
+
+def test_client_spends_budget_on_every_attempt(monkeypatch, tmp_path):
+    budget = RequestBudget(str(tmp_path / "quota.db"), daily_limit=10, search_reserve=0)
+    responses = [FakeResponse(503), FakeResponse(200)]
+    client = DomainClient("key", budget=budget)
+    monkeypatch.setattr(client.session, "request", lambda *args, **kwargs: responses.pop(0))
+    monkeypatch.setattr(domain_api.time, "sleep", lambda wait: None)
+    
+    client.get_listing(123)
+    assert budget.metrics()['used_detail'] == 2
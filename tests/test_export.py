@@ -0,0 +1,41 @@
+import mongomock
+import pytest
+from datetime import date
+from DomainAnalysis.export import (build_listings_filter, iter_listing_documents, iter_listing_frames,
+                                   iter_listing_record_batches)
+
+@pytest.fixture
+def coll():
+    coll = mongomock.MongoClient()['raw-requests'].listings
+    coll.insert_many([{
+        "listing_id": i,
+        "dateListed": f"2021-09-{10 + i:02d}T06:43:18Z",
+        "location_postcode": "3195" if i % 2 else "3228",
+        "house_description": "A long description " * 50,
+        "minimumPrice": 900000 + i
+    } for i in range(10)])
+    return coll
+
+def test_build_listings_filter():
+    assert build_listings_filter() == {}
+    assert build_listings_filter([3195], date(2021, 9, 1), date(2021, 10, 1)) == {
+        "location_postcode": {"$in": ["3195"]},
+        "dateListed": {"$gte": "2021-09-01", "$lt": "2021-10-01"}
+    }
+
+def test_iter_listing_documents_chunks_and_projects(coll):
+    chunks = list(iter_listing_documents(coll, ["listing_id", "minimumPrice"], batch_size=4))
+    assert [len(x) for x in chunks] == [4, 4, 2]
+    assert set(chunks[0][0]) == {"listing_id", "minimumPrice"}
+
+def test_iter_listing_frames_filters(coll):
+    frames = list(iter_listing_frames(coll, ["listing_id", "dateListed"], batch_size=100,
+                                      postcodes=["3195"], listed_from=date(2021, 9, 13)))
+    assert len(frames) == 1
+    assert list(frames[0].columns) == ["listing_id", "dateListed"]
+    assert sorted(frames[0].listing_id) == [3, 5, 7, 9]
+
+def test_iter_listing_record_batches(coll):
+    batches = list(iter_listing_record_batches(coll, ["listing_id", "minimumPrice"], batch_size=5))
+    assert sum(x.num_rows for x in batches) == 10
+    assert batches[0].schema.names == ["listing_id", "minimumPrice"]
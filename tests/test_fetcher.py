@@ -0,0 +1,33 @@
+from DomainAnalysis.fetcher import fetch_listing_details, fetch_listings, REQUEST, QUOTA, WRANGLE
+from DomainAnalysis.quota import QuotaExceeded
+
+class FakeResponse():
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+
+    def json(self):
+        return self.body
+
+class FakeClient():
+    def get_listing(self, listing_id):
+        if listing_id == 404:
+            return FakeResponse(404, {"message": "Not found"})
+        if listing_id == 500:
+            raise QuotaExceeded("Daily Domain request budget exhausted for detail requests")
+        return FakeResponse(200, {"id": listing_id})
+
+def test_fetch_listing_details_reports_errors_per_listing():
+    raw_listings, errors = fetch_listing_details(FakeClient(), [1, 2, 404, 500, 2], concurrency=2)
+    assert raw_listings == {1: {"id": 1}, 2: {"id": 2}}
+    assert errors[404]['stage'] == REQUEST
+    assert errors[500]['stage'] == QUOTA
+
+def test_fetch_listings_reports_wrangle_errors():
+    listings, errors = fetch_listings(FakeClient(), [1])
+    assert listings == []
+    assert errors[1]['stage'] == WRANGLE
+
+def test_fetch_listing_details_with_no_ids():
+    assert fetch_listing_details(FakeClient(), []) == ({}, {})
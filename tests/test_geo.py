@@ -0,0 +1,70 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+from DomainAnalysis.geo import AmenityIndex, load_amenity_indexes, add_amenity_distances, store_amenity_distances
+from DomainAnalysis.mongo import EARTH_RADIUS_KM
+
+def haversine_km(latitude, longitude, latitudes, longitudes):
+    latitude, longitude, latitudes, longitudes = map(np.radians, (latitude, longitude, latitudes, longitudes))
+    a = (np.sin((latitudes - latitude) / 2) ** 2
+         + np.cos(latitude) * np.cos(latitudes) * np.sin((longitudes - longitude) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+def test_nearest_matches_brute_force_haversine():
+    rng = np.random.default_rng(0)
+    amenities = rng.uniform([-38.4, 144.0], [-37.8, 145.2], size=(200, 2))
+    listings = rng.uniform([-38.4, 144.0], [-37.8, 145.2], size=(50, 2))
+    index = AmenityIndex(amenities[:, 0], amenities[:, 1])
+    distances, nearest = index.nearest(listings[:, 0], listings[:, 1])
+    for (latitude, longitude), distance, i in zip(listings, distances, nearest):
+        brute_force = haversine_km(latitude, longitude, amenities[:, 0], amenities[:, 1])
+        assert i == brute_force.argmin()
+        assert distance == pytest.approx(brute_force.min())
+
+def test_unknown_locations():
+    index = AmenityIndex([-38.0], [145.0])
+    distances, nearest = index.nearest([np.nan, -38.0], [np.nan, 145.0])
+    assert np.isnan(distances[0]) and nearest[0] == -1
+    assert distances[1] == pytest.approx(0)
+    assert index.count_within([np.nan, -38.0], [np.nan, 145.0], 1).tolist() == [0, 1]
+
+def test_count_within():
+    # Roughly 1.1km and 11km north of the listing
+    index = AmenityIndex([-37.99, -37.9], [145.0, 145.0])
+    assert index.count_within([-38.0], [145.0], 5).tolist() == [1]
+    assert index.count_within([-38.0], [145.0], 15).tolist() == [2]
+
+def test_load_amenity_indexes(tmp_path):
+    with open(tmp_path / "supermarket.csv", "w") as outfile:
+        outfile.write("name,latitude,longitude\nColes,-38.0,145.08\nWoolworths,-37.95,145.05\n")
+    coastline = {"type": "FeatureCollection", "features": [
+        {"type": "Feature", "geometry": {"type": "LineString", "coordinates": [[145.07, -38.0], [145.06, -37.99]]}}]}
+    with open(tmp_path / "beach.geojson", "w") as outfile:
+        json.dump(coastline, outfile)
+    (tmp_path / "notes.txt").write_text("not an amenity")
+    indexes = load_amenity_indexes(tmp_path)
+    assert sorted(indexes) == ["beach", "supermarket"]
+    assert indexes['supermarket'].names == ["Coles", "Woolworths"]
+    assert len(indexes['beach']) == 2
+
+    frame = pd.DataFrame({'listing_id': [1, 2], 'location_latitude': [-38.0, None],
+                          'location_longitude': [145.086221, None]}, index=[10, 11])
+    enriched = add_amenity_distances(frame, indexes)
+    assert list(enriched.index) == [10, 11]
+    assert enriched.distance_to_supermarket_km[10] == pytest.approx(
+        haversine_km(-38.0, 145.086221, -38.0, 145.08))
+    assert np.isnan(enriched.distance_to_beach_km[11])
+
+def test_store_amenity_distances(mongo_db):
+    mongo_db.listings.insert_many([
+        {"listing_id": 1, "location_latitude": -38.0, "location_longitude": 145.0},
+        {"listing_id": 2, "location_latitude": -37.99, "location_longitude": 145.0},
+        {"listing_id": 3, "location_latitude": None, "location_longitude": None},
+    ])
+    indexes = {'supermarket': AmenityIndex([-38.0], [145.0])}
+    assert store_amenity_distances(mongo_db.listings, indexes, batch_size=1) == 2
+    assert mongo_db.listings.find_one({"listing_id": 1})['distance_to_supermarket_km'] == pytest.approx(0)
+    assert mongo_db.listings.find_one({"listing_id": 2})['distance_to_supermarket_km'] == pytest.approx(
+        haversine_km(-37.99, 145.0, -38.0, 145.0))
+    assert 'distance_to_supermarket_km' not in mongo_db.listings.find_one({"listing_id": 3})
@@ -0,0 +1,64 @@
+from datetime import timedelta
+import pytest
+from DomainAnalysis.journal import RunJournal, fetch_journaled_details, PLANNED, ENDED, RUNNING, FINISHED, ABANDONED
+from DomainAnalysis.snapshots import ensure_detail_indexes
+
+class FakeResponse():
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+
+    def json(self):
+        return self.body
+
+class FakeClient():
+    def __init__(self):
+        self.requested = []
+
+    def get_listing(self, listing_id):
+        self.requested.append(listing_id)
+        return FakeResponse(200, {"id": listing_id})
+
+@pytest.fixture
+def journal(tmp_path):
+    return RunJournal(str(tmp_path / "journal.db"))
+
+def test_unfinished_run_is_resumed(journal):
+    run_id, unfetched = journal.start_run()
+    assert journal.status(run_id) == RUNNING and unfetched == []
+    journal.complete_stage(run_id, PLANNED, [1, 2, 3])
+    journal.complete_stage(run_id, ENDED, {'sold': 1})
+    # The process dies, the next run picks up where it left off
+    resumed = RunJournal(journal.path)
+    assert resumed.start_run() == (run_id, [])
+    assert resumed.stage_result(run_id, PLANNED) == [1, 2, 3]
+    assert resumed.stage_result(run_id, ENDED) == {'sold': 1}
+    assert not resumed.is_complete(run_id, "detailed")
+    resumed.finish_run(run_id)
+    assert journal.status(run_id) == FINISHED
+    assert journal.start_run()[0] != run_id
+
+def test_old_runs_are_abandoned(journal):
+    run_id, _ = journal.start_run()
+    journal.complete_stage(run_id, PLANNED, [1, 2, 3])
+    journal.record_fetched(run_id, [2])
+    journal.max_age = timedelta(seconds=-1)
+    new_run_id, unfetched = journal.start_run()
+    assert new_run_id != run_id
+    assert unfetched == [1, 3]
+    assert journal.status(run_id) == ABANDONED
+
+def test_fetched_details_are_not_requested_again(journal, mongo_db):
+    ensure_detail_indexes(mongo_db.details)
+    run_id, _ = journal.start_run()
+    # The run dies after fetching the first four listings
+    fetch_journaled_details(journal, run_id, FakeClient(), mongo_db.details, list(range(4)), checkpoint_size=2)
+    assert journal.fetched(run_id) == {0, 1, 2, 3}
+
+    client = FakeClient()
+    raw_listings, errors = fetch_journaled_details(journal, run_id, client, mongo_db.details, list(range(10)),
+                                                   checkpoint_size=2)
+    assert sorted(client.requested) == [4, 5, 6, 7, 8, 9]
+    assert sorted(raw_listings) == list(range(10)) and errors == {}
+    assert journal.fetched(run_id) == set(range(10))
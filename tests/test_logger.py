@@ -0,0 +1,84 @@
+import json
+import logging
+import multiprocessing
+from DomainAnalysis.logger import (get_logger, stop_logging, JsonFormatter, LazyQueueHandler, SamplingFilter,
+                                   SAMPLED, logger)
+
+def make_record(msg, args=(), level=logging.DEBUG, **extra):
+    record = logging.LogRecord("test", level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+def test_get_logger_is_idempotent():
+    handlers = list(logger.handlers)
+    assert get_logger() is logger
+    assert get_logger("other.log") is logger
+    assert logger.handlers == handlers
+    assert len([x for x in logger.handlers if isinstance(x, LazyQueueHandler)]) == 1
+
+def test_json_formatter_includes_extra_fields_and_exceptions():
+    try:
+        raise ValueError("bad listing")
+    except ValueError:
+        record = logging.LogRecord("test", logging.ERROR, __file__, 1, "Unable to get listing %s", (123,),
+                                   exc_info=__import__("sys").exc_info())
+    record.run_id = "20211001T000000Z"
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry['message'] == "Unable to get listing 123"
+    assert entry['level'] == "ERROR"
+    assert entry['run_id'] == "20211001T000000Z"
+    assert "ValueError: bad listing" in entry['exception']
+
+def test_sampling_filter_keeps_one_in_every_n_of_each_message():
+    sampler = SamplingFilter(every=10)
+    kept = [sampler.filter(make_record("Got listing %s", (x,), **SAMPLED)) for x in range(25)]
+    assert kept.count(True) == 3 and kept[0]
+    # Counted separately from other messages
+    assert sampler.filter(make_record("Listing (%s) changed fields: %s", (1, []), **SAMPLED))
+    # Unsampled records and records above the sampled level are always kept
+    assert all(sampler.filter(make_record("Got listing %s", (x,))) for x in range(5))
+    assert all(sampler.filter(make_record("Got listing %s", (x,), level=logging.WARNING, **SAMPLED)) for x in range(5))
+
+def test_queue_handler_formats_arguments_when_logged():
+    handler = LazyQueueHandler(None)
+    listing_ids = [1, 2]
+    record = handler.prepare(make_record("Getting listings %s", (listing_ids,)))
+    listing_ids.append(3)
+    assert record.getMessage() == "Getting listings [1, 2]"
+    assert record.args is None
+
+def test_records_are_written_as_json_lines_by_the_listener(tmp_path):
+    path = tmp_path / "test.log"
+    test_logger = get_logger(str(path), filepath_level=logging.DEBUG, console_level=logging.CRITICAL,
+                             sample_every=100, name="test-logger")
+    for listing_id in range(150):
+        test_logger.debug("Got listing %s", listing_id, extra=SAMPLED)
+    test_logger.info("Stored run %s", "run-1", extra={'run_id': "run-1"})
+    stop_logging("test-logger")
+    entries = [json.loads(x) for x in path.read_text().splitlines()]
+    assert [x['message'] for x in entries] == ["Got listing 0", "Got listing 100", "Stored run run-1"]
+    assert entries[-1]['run_id'] == "run-1"
+
+def test_stop_logging_writes_later_records_directly(tmp_path):
+    path = tmp_path / "stopped.log"
+    test_logger = get_logger(str(path), console_level=logging.CRITICAL, name="stopped-logger")
+    test_logger.info("Queued")
+    stop_logging("stopped-logger")
+    assert not any(isinstance(x, LazyQueueHandler) for x in test_logger.handlers)
+    assert get_logger(name="stopped-logger") is test_logger
+    test_logger.info("Written directly")
+    stop_logging("stopped-logger")
+    assert [json.loads(x)['message'] for x in path.read_text().splitlines()] == ["Queued", "Written directly"]
+
+def _log_in_worker(name):
+    logging.getLogger(name).info("Logged in a worker")
+
+def test_forked_workers_log_through_their_own_listener(tmp_path):
+    path = tmp_path / "forked.log"
+    get_logger(str(path), console_level=logging.CRITICAL, name="forked-logger")
+    worker = multiprocessing.get_context("fork").Process(target=_log_in_worker, args=("forked-logger",))
+    worker.start()
+    worker.join()
+    assert worker.exitcode == 0
+    stop_logging("forked-logger")
+    assert [json.loads(x)['message'] for x in path.read_text().splitlines()] == ["Logged in a worker"]
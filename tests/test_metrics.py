@@ -0,0 +1,118 @@
+import json
+from types import SimpleNamespace
+from DomainAnalysis import domain_api
+from DomainAnalysis.domain_api import DomainClient
+from DomainAnalysis.fetcher import wrangle_listings
+from DomainAnalysis.metrics import Metrics, MongoCommandMetrics, metrics, percentile, time_flow_stage
+
+def test_percentile_interpolates():
+    values = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    assert percentile(values, 50) == 5.5
+    assert percentile(values, 0) == 1
+    assert percentile(values, 100) == 10
+    assert percentile([], 50) is None
+
+def test_counters_and_histograms_are_kept_per_label():
+    registry = Metrics()
+    registry.inc("requests_total", kind="search")
+    registry.inc("requests_total", 2, kind="detail")
+    registry.inc("requests_total", kind="detail")
+    for value in (0.1, 0.3, 0.2):
+        registry.observe("request_seconds", value, kind="detail")
+    assert registry.counter("requests_total", kind="detail") == 3
+    assert registry.counter("requests_total", kind="search") == 1
+    assert registry.counter("requests_total", kind="other") == 0
+    assert registry.values("request_seconds", kind="detail") == [0.1, 0.3, 0.2]
+
+def test_timer_observes_even_when_the_body_fails():
+    registry = Metrics()
+    try:
+        with registry.timer("stage_seconds", stage="wrangle"):
+            raise ValueError("bad listing")
+    except ValueError:
+        pass
+
+    @registry.timed("stage_seconds", stage="search")
+    def search():
+        return "results"
+
+    assert search() == "results"
+    assert len(registry.values("stage_seconds", stage="wrangle")) == 1
+    assert len(registry.values("stage_seconds", stage="search")) == 1
+
+def test_summary_and_json(tmp_path):
+    registry = Metrics()
+    registry.inc("requests_total", status=200)
+    for value in range(1, 101):
+        registry.observe("request_seconds", value / 100)
+    path = registry.write_summary(str(tmp_path / "metrics" / "run_1.json"), run_id="1")
+    with open(path) as infile:
+        summary = json.load(infile)
+    assert summary['run_id'] == "1"
+    assert summary['counters'] == [{'name': 'requests_total', 'labels': {'status': '200'}, 'value': 1}]
+    histogram = summary['histograms'][0]
+    assert histogram['count'] == 100
+    assert histogram['min'] == 0.01 and histogram['max'] == 1.0
+    assert round(histogram['p50'], 3) == 0.505
+    assert round(histogram['p99'], 3) == 0.99
+
+def test_prometheus_text(tmp_path):
+    registry = Metrics(buckets=(0.1, 1))
+    registry.inc("requests_total", kind="detail")
+    for value in (0.05, 0.1, 0.5, 2):
+        registry.observe("request_seconds", value, kind="detail")
+    text = registry.to_prometheus()
+    assert "# TYPE requests_total counter\n" in text
+    assert 'requests_total{kind="detail"} 1\n' in text
+    assert "# TYPE request_seconds histogram\n" in text
+    assert 'request_seconds_bucket{kind="detail",le="0.1"} 2\n' in text
+    assert 'request_seconds_bucket{kind="detail",le="1"} 3\n' in text
+    assert 'request_seconds_bucket{kind="detail",le="+Inf"} 4\n' in text
+    assert 'request_seconds_count{kind="detail"} 4\n' in text
+    path = registry.write_prometheus(str(tmp_path / "domain.prom"))
+    with open(path) as infile:
+        assert infile.read() == text
+
+def test_mongo_command_listener():
+    registry = Metrics()
+    listener = MongoCommandMetrics(registry)
+    listener.succeeded(SimpleNamespace(command_name="find", duration_micros=1500))
+    listener.failed(SimpleNamespace(command_name="insert", duration_micros=500))
+    assert registry.values("mongo_command_seconds", command="find") == [0.0015]
+    assert registry.counter("mongo_commands_total", command="find", outcome="succeeded") == 1
+    assert registry.counter("mongo_commands_total", command="insert", outcome="failed") == 1
+
+class FakeResponse():
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+def test_client_records_requests_retries_and_bytes(monkeypatch):
+    metrics.reset()
+    responses = [FakeResponse(503), FakeResponse(200, {"Content-Length": "1234"})]
+    client = DomainClient("key")
+    monkeypatch.setattr(client.session, "request", lambda *args, **kwargs: responses.pop(0))
+    monkeypatch.setattr(domain_api.time, "sleep", lambda wait: None)
+
+    client.get_listing(123)
+    assert metrics.counter("domain_requests_total", kind="detail", status=503) == 1
+    assert metrics.counter("domain_requests_total", kind="detail", status=200) == 1
+    assert metrics.counter("domain_retries_total", kind="detail") == 1
+    assert metrics.counter("domain_response_bytes_total", kind="detail") == 1234
+    assert len(metrics.values("domain_request_seconds", kind="detail")) == 2
+
+def test_wrangle_listings_records_each_listing():
+    metrics.reset()
+    listings, errors = wrangle_listings([1], {1: {'id': 1}})
+    assert listings == [] and 1 in errors
+    assert metrics.counter("listings_wrangled_total", outcome="failed") == 1
+    assert len(metrics.values("wrangle_seconds")) == 1
+
+def test_time_flow_stage():
+    metrics.reset()
+    task = SimpleNamespace(name="check_for_new_listings")
+    running = SimpleNamespace(is_running=lambda: True, is_finished=lambda: False)
+    success = SimpleNamespace(is_running=lambda: False, is_finished=lambda: True)
+    assert time_flow_stage(task, None, running) is running
+    assert time_flow_stage(task, running, success) is success
+    assert len(metrics.values("flow_stage_seconds", stage="check_for_new_listings")) == 1
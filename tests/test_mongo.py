@@ -0,0 +1,110 @@
+import pytest
+from pymongo.errors import BulkWriteError
+from DomainAnalysis.mongo import (which_new_listings, which_updated_listings, diff_listing, bulk_upsert_listings,
+                                  location_point, listings_within, set_location_points,
+                                  QUERY_CHUNK_SIZE, LOCATION_POINT)
+
+class FakeCollection():
+    """Just enough of a pymongo Collection to run queries on `listing_id`"""
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find(self, query=None, projection=None):
+        ids = set(query["listing_id"]["$in"]) if query else None
+        for doc in self.documents:
+            if ids is None or doc["listing_id"] in ids:
+                yield {k: v for k, v in doc.items() if projection is None or k in projection}
+
+def test_which_new_listings():
+    coll = FakeCollection([{"listing_id": 1}, {"listing_id": 2}])
+    assert which_new_listings(coll, [1, 2, 3, 4]) == [3, 4]
+    assert which_new_listings(coll, [1, 2, 3, 4], return_existing=True) == [1, 2]
+
+def test_which_updated_listings():
+    coll = FakeCollection([
+        {"listing_id": 1, "dateUpdated": "2021-09-27T22:29:18.3Z"},
+        {"listing_id": 2, "dateUpdated": "2021-09-27T22:29:18.3Z"},
+    ])
+    update_dates = {1: "2021-09-27T22:29:18.3Z", 2: "2021-10-01T01:00:00Z", 3: "2021-10-01T01:00:00Z"}
+    assert which_updated_listings(coll, update_dates) == [2]
+
+def test_diff_listing_only_returns_changed_fields():
+    stored = {"_id": "abc", "listing_id": 1, "created": "2021-09-30", "displayPrice": "$950,000", "minimumPrice": 950000}
+    listing = {"listing_id": 1, "created": "2021-10-01", "displayPrice": "SOLD", "minimumPrice": 950000, "status": "sold"}
+    assert diff_listing(stored, listing) == {"displayPrice": "SOLD", "status": "sold"}
+
+class RecordingCollection(FakeCollection):
+    def __init__(self, documents):
+        super().__init__(documents)
+        self.queries = []
+
+    def find(self, query=None, projection=None):
+        self.queries.append(query)
+        return super().find(query, projection)
+
+def test_which_new_listings_chunks_large_queries():
+    coll = RecordingCollection([{"listing_id": x} for x in range(0, 2500, 2)])
+    listing_ids = list(range(2500))
+    assert which_new_listings(coll, listing_ids) == list(range(1, 2500, 2))
+    assert len(coll.queries) == 3
+    assert max(len(q["listing_id"]["$in"]) for q in coll.queries) == QUERY_CHUNK_SIZE
+
+class FakeListing():
+    def __init__(self, listing_id):
+        self.listing_id = listing_id
+
+    def as_no_nested_dicts(self):
+        return {"listing_id": self.listing_id, "created": "2021-10-01T00:00:00", "displayPrice": "$950,000"}
+
+class FakeBulkResult():
+    def __init__(self, operations):
+        self.bulk_api_result = {"nUpserted": len(operations), "nMatched": 0, "nModified": 0}
+
+class BulkCollection():
+    def __init__(self, fail_listing_id=None):
+        self.batches = []
+        self.fail_listing_id = fail_listing_id
+
+    def bulk_write(self, operations, ordered=True):
+        assert not ordered
+        self.batches.append(operations)
+        failed = [i for i, op in enumerate(operations) if op._filter["listing_id"] == self.fail_listing_id]
+        if failed:
+            raise BulkWriteError({"nUpserted": len(operations) - 1, "nMatched": 0, "nModified": 0,
+                                  "writeErrors": [{"index": failed[0], "errmsg": "E11000 duplicate key"}]})
+        return FakeBulkResult(operations)
+
+def test_bulk_upsert_listings_batches_upserts():
+    coll = BulkCollection()
+    results = bulk_upsert_listings(coll, (FakeListing(x) for x in range(5)), batch_size=2)
+    assert [x['size'] for x in results] == [2, 2, 1]
+    assert sum(x['inserted'] for x in results) == 5
+    operation = coll.batches[0][0]
+    assert operation._filter == {"listing_id": 0}
+    assert operation._upsert
+    assert operation._doc["$setOnInsert"] == {"created": "2021-10-01T00:00:00"}
+    assert "created" not in operation._doc["$set"]
+
+def test_bulk_upsert_listings_reports_errors():
+    results = bulk_upsert_listings(BulkCollection(fail_listing_id=3), [FakeListing(x) for x in range(5)], batch_size=2)
+    assert results[1]['errors'] == [{'listing_id': 3, 'error': "E11000 duplicate key"}]
+    assert results[1]['inserted'] == 1
+
+def test_location_point():
+    assert location_point({"location_latitude": -38.0, "location_longitude": 145.08}) == {
+        "type": "Point", "coordinates": [145.08, -38.0]}
+    assert location_point({"location_latitude": None, "location_longitude": None}) is None
+
+def test_listings_within_queries_the_location_point():
+    coll = RecordingCollection([])
+    listings_within(coll, -38.0, 145.08, 5)
+    [center, radius] = coll.queries[0][LOCATION_POINT]["$geoWithin"]["$centerSphere"]
+    assert center == [145.08, -38.0]
+    assert radius == pytest.approx(5 / 6371.0088)
+
+def test_set_location_points(mongo_db):
+    mongo_db.listings.insert_many([{"listing_id": 1, "location_latitude": -38.0, "location_longitude": 145.08},
+                                   {"listing_id": 2, "location_latitude": None, "location_longitude": None}])
+    assert set_location_points(mongo_db.listings) == 1
+    assert mongo_db.listings.find_one({"listing_id": 1})[LOCATION_POINT]["coordinates"] == [145.08, -38.0]
+    assert LOCATION_POINT not in mongo_db.listings.find_one({"listing_id": 2})
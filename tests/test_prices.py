@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+from DomainAnalysis.prices import (parse_display_price, parse_display_prices, ParsedPrice, PriceCache,
+                                   PRICE_RANGE, PRICE_SINGLE, NO_PRICE, EMPTY)
+
+def test_parse_range():
+    assert parse_display_price("$950,000 - $1,050,000") == ParsedPrice(950000, 1050000, PRICE_RANGE)
+    assert parse_display_price("950 ,000-1,050,000") == ParsedPrice(950000, 1050000, PRICE_RANGE)
+    assert parse_display_price("$1,300,000 to $1,400,000") == ParsedPrice(1300000, 1400000, PRICE_RANGE)
+    assert parse_display_price("AUCTION: EPR $1,400,000 - $1,450,000") == ParsedPrice(1400000, 1450000, PRICE_RANGE)
+
+def test_parse_suffixes():
+    assert parse_display_price("2.4M - 2.6M") == ParsedPrice(2400000, 2600000, PRICE_RANGE)
+    assert parse_display_price("830K-890K") == ParsedPrice(830000, 890000, PRICE_RANGE)
+    assert parse_display_price("$1.1 - $1.2M") == ParsedPrice(1100000, 1200000, PRICE_RANGE)
+    assert parse_display_price("Price guide $1.5 million") == ParsedPrice(1500000, 1500000, PRICE_SINGLE)
+
+def test_parse_single():
+    assert parse_display_price("Quoting $1,750,000") == ParsedPrice(1750000, 1750000, PRICE_SINGLE)
+    # A comma after a price isn't a thousands group
+    assert parse_display_price("$650,000, 4 bedrooms") == ParsedPrice(650000, 650000, PRICE_SINGLE)
+    assert parse_display_price("Price guide $1,000,000 - $1,100,000, 3 bed") == ParsedPrice(1000000, 1100000, PRICE_RANGE)
+    assert parse_display_price("Offers over $800k") == ParsedPrice(800000, 800000, PRICE_SINGLE)
+
+def test_numbers_that_are_not_prices_are_ignored():
+    assert parse_display_price("Auction - Sat 27th Nov @ 11:00am").status == NO_PRICE
+    assert parse_display_price("3 bed 2 bath $1.2M") == ParsedPrice(1200000, 1200000, PRICE_SINGLE)
+    assert parse_display_price("Call 0412345678").status == NO_PRICE
+
+def test_parse_no_price():
+    assert parse_display_price("Contact Agent") == ParsedPrice(None, None, NO_PRICE)
+    assert parse_display_price("") == ParsedPrice(None, None, EMPTY)
+    assert parse_display_price(None) == ParsedPrice(None, None, EMPTY)
+
+def test_parse_display_prices_series():
+    prices = pd.Series(["$1M - $1.1M", None, "Contact Agent", "$1M - $1.1M"], index=[10, 11, 12, 13])
+    parsed = parse_display_prices(prices)
+    assert list(parsed.index) == [10, 11, 12, 13]
+    assert parsed.minimumPrice.tolist() == [1000000, pd.NA, pd.NA, 1000000]
+    assert parsed.maximumPrice.dtype == "Int64"
+    assert parsed.priceStatus.tolist() == [PRICE_RANGE, EMPTY, NO_PRICE, PRICE_RANGE]
+
+def test_parse_display_prices_array():
+    parsed = parse_display_prices(np.array(["$600,000", "Auction"], dtype=object))
+    assert parsed.minimumPrice.tolist() == [600000, pd.NA]
+
+def test_price_cache_counts_hits_and_misses():
+    cache = PriceCache(maxsize=10)
+    assert cache.get("$950,000 - $1,050,000") == ParsedPrice(950000, 1050000, PRICE_RANGE)
+    assert cache.lookup("$950,000  -  $1,050,000 ") == (ParsedPrice(950000, 1050000, PRICE_RANGE), True)
+    info = cache.info()
+    assert (info['hits'], info['misses'], info['size']) == (1, 1, 1)
+
+def test_price_cache_caches_no_price():
+    cache = PriceCache(maxsize=10)
+    assert cache.lookup("Contact Agent") == (ParsedPrice(None, None, NO_PRICE), False)
+    assert cache.lookup("CONTACT AGENT") == (ParsedPrice(None, None, NO_PRICE), True)
+
+def test_price_cache_evicts_least_recently_used():
+    cache = PriceCache(maxsize=2)
+    cache.get("$600,000")
+    cache.get("$700,000")
+    cache.get("$600,000")
+    cache.get("$800,000")
+    assert cache.lookup("$600,000")[1]
+    assert not cache.lookup("$700,000")[1]
+    assert cache.info()['evictions'] == 2
+    cache.resize(1)
+    assert cache.info()['size'] == 1
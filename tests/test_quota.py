@@ -0,0 +1,77 @@
+import pytest
+import sqlite3
+from DomainAnalysis.quota import RequestBudget, ShardBudget, QuotaExceeded, immediate_transaction, SEARCH, DETAIL
+
+@pytest.fixture
+def budget(tmp_path):
+    return RequestBudget(str(tmp_path / "quota.db"), daily_limit=10, search_reserve=4)
+
+def test_budget_counts_requests(budget):
+    assert budget.try_acquire(SEARCH)
+    assert budget.try_acquire(DETAIL, 2)
+    metrics = budget.metrics()
+    assert metrics['used_search'] == 1
+    assert metrics['used_detail'] == 2
+    assert metrics['remaining'] == 7
+
+def test_budget_persists_between_instances(budget):
+    budget.acquire(DETAIL)
+    assert RequestBudget(budget.path, daily_limit=10).metrics()['used'] == 1
+
+def test_details_cannot_spend_search_reserve(budget):
+    assert budget.available(DETAIL) == 6
+    assert not budget.try_acquire(DETAIL, 7)
+    budget.acquire(DETAIL, 6)
+    with pytest.raises(QuotaExceeded):
+        budget.acquire(DETAIL)
+    # Searches can still use the reserve
+    budget.acquire(SEARCH, 4)
+    assert budget.metrics()['remaining'] == 0
+
+def test_plan_details_defers_what_cannot_be_afforded(budget):
+    assert budget.plan_details([1, 2, 3, 4, 5, 6, 7, 8]) == [1, 2, 3, 4, 5, 6]
+    assert budget.deferred() == [7, 8]
+    
+def test_plan_details_puts_deferred_first(budget):
+    budget.defer([7, 8])
+    assert budget.plan_details([1, 7]) == [7, 8, 1]
+    assert budget.deferred() == []
+
+def test_plan_details_can_leave_the_deferred_queue_and_be_limited(budget):
+    budget.defer([7, 8])
+    assert budget.plan_details([1, 2, 3], include_deferred=False, limit=2) == [1, 2]
+    assert budget.deferred() == [7, 8, 3]
+    assert budget.plan_details([], limit=0) == []
+    assert budget.deferred() == [7, 8, 3]
+
+def test_shards_spend_their_share_of_one_budget(tmp_path):
+    path = str(tmp_path / "quota.db")
+    first = ShardBudget(path, daily_limit=100, search_reserve=10, shard="0", share=0.6)
+    second = ShardBudget(path, daily_limit=100, search_reserve=10, shard="1", share=0.4)
+    # Each shard holds back its share of the search reserve
+    assert first.available(DETAIL) == 54
+    assert second.available(DETAIL) == 36
+    assert first.plan_details(range(60)) == list(range(54))
+    first.acquire(SEARCH, 6)
+    first.acquire(DETAIL, 54)
+    with pytest.raises(QuotaExceeded):
+        first.acquire(SEARCH)
+    # The deferred listings are shared, and the whole budget counts every shard
+    assert second.plan_details([]) == [54, 55, 56, 57, 58, 59]
+    assert second.available(SEARCH) == 40
+    assert RequestBudget(path, daily_limit=100).metrics()['used'] == 60
+
+def test_immediate_transaction_raises_the_locking_error(tmp_path):
+    path = str(tmp_path / "quota.db")
+    with immediate_transaction(path) as conn:
+        conn.execute("CREATE TABLE counts (n INTEGER)")
+        # Another connection can't take the lock, and that's the error raised rather than a failed rollback
+        with pytest.raises(sqlite3.OperationalError, match="locked"):
+            with immediate_transaction(path, timeout=0):
+                pass
+    with pytest.raises(ValueError):
+        with immediate_transaction(path) as conn:
+            conn.execute("INSERT INTO counts VALUES (1)")
+            raise ValueError("rolled back")
+    with immediate_transaction(path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM counts").fetchone() == (0,)
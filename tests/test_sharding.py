@@ -0,0 +1,59 @@
+import json
+import pytest
+from DomainAnalysis import domain_api
+from DomainAnalysis.sharding import shard_postcodes, postcode_counts, plan_shards, run_shard, merge_shards
+from DomainAnalysis.snapshots import ensure_snapshot_indexes, get_run
+
+class FakeResponse():
+    def __init__(self, status_code, body, headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+        self.headers = headers or {}
+
+    def json(self):
+        return self.body
+
+# Listing 5 is on the boundary of 3228 and 3227 so both searches return it
+SEARCHES = {("3228",): [1, 2, 3, 4, 5], ("3227",): [5, 6, 7]}
+
+def fake_search_page(client, data):
+    postcodes = tuple(x['postCode'] for x in data['locations'])
+    body = [{"listing": {"id": x, "dateUpdated": "2021-10-01"}} for x in SEARCHES[postcodes]]
+    return FakeResponse(200, body, {"X-Total-Count": str(len(body)), "X-Pagination-PageNumber": "1"})
+
+def test_shard_postcodes_balances_listings():
+    counts = {"3228": 500, "3227": 300, "3226": 250, "3230": 200, "3231": 50}
+    shards = shard_postcodes(["3228", "3227", "3226", "3230", "3231", "3195"], counts, 2)
+    assert [x['postcodes'] for x in shards] == [["3228", "3226", "3231"], ["3227", "3195", "3230"]]
+    # 3195 has no listings yet so counts as the average postcode
+    assert [x['weight'] for x in shards] == [800, 760]
+    assert len(shard_postcodes(["3228", "3227"], counts, 4)) == 2
+
+def test_plan_shards_splits_the_budget_by_listings(mongo_db):
+    mongo_db.listings.insert_many([{"listing_id": x, "location_postcode": "3228" if x < 30 else "3227"}
+                                   for x in range(40)])
+    assert postcode_counts(mongo_db.listings, ["3228", "3227", "3226"]) == {"3228": 30, "3227": 10}
+    shards = plan_shards(mongo_db.listings, ["3228", "3227"], 4)
+    assert [(x['shard'], x['postcodes'], x['share']) for x in shards] == [("0", ["3228"], 0.75), ("1", ["3227"], 0.25)]
+
+def test_shards_are_merged_into_one_run(mongo_db, monkeypatch, tmp_path):
+    with open('examples/raw_listing.json', 'r') as infile:
+        raw_listing = json.load(infile)
+    monkeypatch.setattr(domain_api, "search_page", fake_search_page)
+    monkeypatch.setattr(domain_api.DomainClient, "get_listing",
+                        lambda self, listing_id: FakeResponse(200, dict(raw_listing, id=listing_id)))
+    monkeypatch.setenv("DOMAIN_QUOTA_DB", str(tmp_path / "quota.db"))
+    ensure_snapshot_indexes(mongo_db.snapshots, mongo_db.runs)
+
+    shards = [{'shard': "0", 'postcodes': ["3228"], 'share': 0.5}, {'shard': "1", 'postcodes': ["3227"], 'share': 0.5}]
+    summaries = [run_shard(x, "20211001T000000Z", "key", connect=lambda: mongo_db.client, concurrency=2)
+                 for x in shards]
+    assert mongo_db.runs.count_documents({}) == 0
+    summary = merge_shards(mongo_db.runs, "20211001T000000Z", summaries)
+    assert summary['searched'] == summary['changed'] == 7
+    assert summary['duplicates'] == 1
+    assert summary['inserted'] == 7 and summary['shards'] == 2
+    assert get_run(mongo_db.runs, "20211001T000000Z")['listing_ids'] == [1, 2, 3, 4, 5, 6, 7]
+    assert mongo_db.snapshots.count_documents({}) == 7
+    assert sorted(mongo_db.listings.distinct("listing_id")) == [1, 2, 3, 4, 5, 6, 7]
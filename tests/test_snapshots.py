@@ -0,0 +1,50 @@
+import mongomock
+import pytest
+from DomainAnalysis.snapshots import (store_snapshot, ensure_snapshot_indexes, changed_listings, diff_runs,
+                                      read_run_listings, content_hash, ensure_detail_indexes, store_raw_details,
+                                      read_raw_details)
+
+def search_result(listing_id, price="$950,000"):
+    return {"type": "PropertyListing", "listing": {"id": listing_id, "priceDetails": {"displayPrice": price}}}
+
+@pytest.fixture
+def store():
+    db = mongomock.MongoClient()['raw-requests']
+    ensure_snapshot_indexes(db.snapshots, db.runs)
+    return db.snapshots, db.runs
+
+def test_content_hash_ignores_key_order():
+    assert content_hash({"a": 1, "b": 2}) == content_hash({"b": 2, "a": 1})
+
+def test_unchanged_listings_are_not_stored_again(store):
+    snapshots, runs = store
+    store_snapshot(snapshots, runs, [search_result(1), search_result(2)], run_id="20211001T000000Z")
+    store_snapshot(snapshots, runs, [search_result(1), search_result(2, "$1,000,000"), search_result(3)],
+                   run_id="20211002T000000Z")
+    assert snapshots.count_documents({}) == 4
+    changed = changed_listings(snapshots, "20211002T000000Z")
+    assert sorted(x['listing']['id'] for x in changed) == [2, 3]
+
+def test_diff_runs(store):
+    snapshots, runs = store
+    store_snapshot(snapshots, runs, [search_result(1), search_result(2)], run_id="20211001T000000Z")
+    store_snapshot(snapshots, runs, [search_result(2, "$1,000,000"), search_result(3)], run_id="20211002T000000Z")
+    assert diff_runs(runs, "20211002T000000Z") == {'new': {3}, 'removed': {1}, 'changed': {2}}
+
+def test_read_run_listings_rebuilds_full_run(store):
+    snapshots, runs = store
+    first = [search_result(1), search_result(2)]
+    second = [search_result(2), search_result(1, "$1,000,000")]
+    store_snapshot(snapshots, runs, first, run_id="20211001T000000Z")
+    store_snapshot(snapshots, runs, second, run_id="20211002T000000Z")
+    assert read_run_listings(snapshots, runs, "20211001T000000Z") == first
+    assert read_run_listings(snapshots, runs) == second
+
+def test_store_raw_details_skips_unchanged_details(mongo_db):
+    details = mongo_db.details
+    ensure_detail_indexes(details)
+    assert store_raw_details(details, {1: {"id": 1, "headline": "a"}, 2: {"id": 2, "headline": "b"}}) == 2
+    assert store_raw_details(details, {1: {"id": 1, "headline": "a"}, 2: {"id": 2, "headline": "c"}}) == 1
+    assert details.count_documents({}) == 2
+    assert details.find_one({"listing_id": 2})['listing']['headline'] == "c"
+    assert read_raw_details(details, [2, 3]) == {2: {"id": 2, "headline": "c"}}
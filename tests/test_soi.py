@@ -0,0 +1,96 @@
+from DomainAnalysis.prices import PRICE_RANGE
+from DomainAnalysis import soi as soi_module
+from DomainAnalysis.soi import (price_from_text, parse_soi, process_statements, store_in_cache, cache_path,
+                                ensure_soi_indexes, TEXT, OCR)
+
+SOI_TEXT = ["Statement of Information", "Indicative selling price",
+            "For the meaning of this price see consumer.vic.gov.au/underquoting",
+            "Range between $600,000 & $660,000", "Median sale price", "Median price $720,000 House Suburb Mordialloc"]
+
+def make_pdf(lines):
+    """Builds a one page PDF with a line of Helvetica text per line"""
+    text = "\n".join(f"BT /F1 10 Tf 50 {750 - 20 * i} Td ({line}) Tj ET" for i, line in enumerate(lines))
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>",
+               "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+               "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R "
+               "/Resources << /Font << /F1 5 0 R >> >> >>",
+               f"<< /Length {len(text)} >>\nstream\n{text}\nendstream",
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    pdf = "%PDF-1.4\n"
+    offsets = []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += f"{i} 0 obj\n{obj}\nendobj\n"
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n"
+    pdf += "".join(f"{x:010d} 00000 n \n" for x in offsets)
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    return pdf.encode()
+
+class FakeResponse():
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+class FakeSession():
+    def __init__(self, documents):
+        self.documents = documents
+        self.requested = []
+
+    def get(self, url, timeout=None):
+        self.requested.append(url)
+        return FakeResponse(self.documents[url])
+
+def test_price_from_text():
+    parsed = price_from_text("\n".join(SOI_TEXT))
+    assert (parsed.minimum, parsed.maximum, parsed.status) == (600000, 660000, PRICE_RANGE)
+    assert price_from_text("Indicative selling price\nSingle price $1,250,000\nMedian sale price $900,000").minimum == 1250000
+
+def test_parse_soi_reads_pdf_text(tmp_path):
+    path = cache_path(tmp_path, store_in_cache(tmp_path, make_pdf(SOI_TEXT)))
+    assert parse_soi(path) == {'minimumPrice': 600000, 'maximumPrice': 660000, 'method': TEXT, 'error': None}
+
+def test_parse_soi_falls_back_to_ocr(tmp_path):
+    path = cache_path(tmp_path, store_in_cache(tmp_path, make_pdf(["A scanned page"])))
+    result = parse_soi(path, ocr=lambda path: "\n".join(SOI_TEXT))
+    assert (result['minimumPrice'], result['method']) == (600000, OCR)
+
+def test_process_statements_downloads_and_parses_once(mongo_db, tmp_path):
+    soi = mongo_db.soi
+    ensure_soi_indexes(soi)
+    document = make_pdf(SOI_TEXT)
+    mongo_db.listings.insert_many([
+        {"listing_id": 1, "statementOfInformation": "https://soi/1", "minimumPrice": None},
+        {"listing_id": 2, "statementOfInformation": "https://soi/2", "minimumPrice": None},
+        {"listing_id": 3, "statementOfInformation": "https://soi/3", "minimumPrice": 950000},
+    ])
+    # The same document published under two urls
+    session = FakeSession({"https://soi/1": document, "https://soi/2": document})
+    summary = process_statements(mongo_db.listings, soi, str(tmp_path), workers=1, session=session)
+    assert summary == {'checked': 2, 'downloaded': 2, 'parsed': 1, 'priced': 2, 'failed': 0}
+    assert mongo_db.listings.find_one({"listing_id": 2})['soi_maximumPrice'] == 660000
+    assert sorted(soi.find_one()['urls']) == ["https://soi/1", "https://soi/2"]
+
+    # Nothing is downloaded or parsed again, even for a new listing with a url already seen
+    mongo_db.listings.insert_one({"listing_id": 4, "statementOfInformation": "https://soi/1", "minimumPrice": None})
+    summary = process_statements(mongo_db.listings, soi, str(tmp_path), workers=1, session=session)
+    assert summary == {'checked': 1, 'downloaded': 0, 'parsed': 0, 'priced': 1, 'failed': 0}
+    assert len(session.requested) == 2
+    assert mongo_db.listings.find_one({"listing_id": 4})['soi_minimumPrice'] == 600000
+
+def test_stale_documents_missing_from_the_cache_are_downloaded_again(mongo_db, tmp_path, monkeypatch):
+    soi = mongo_db.soi
+    ensure_soi_indexes(soi)
+    mongo_db.listings.insert_one({"listing_id": 1, "statementOfInformation": "https://soi/1", "minimumPrice": None})
+    session = FakeSession({"https://soi/1": make_pdf(SOI_TEXT)})
+    process_statements(mongo_db.listings, soi, str(tmp_path / "first"), workers=1, session=session)
+
+    # A new parser version run on a machine without the cache
+    monkeypatch.setattr(soi_module, "SOI_PARSER_VERSION", 2)
+    summary = process_statements(mongo_db.listings, soi, str(tmp_path / "second"), workers=1, session=session)
+    assert summary == {'checked': 1, 'downloaded': 1, 'parsed': 1, 'priced': 1, 'failed': 0}
+    assert session.requested == ["https://soi/1", "https://soi/1"]
+    assert soi.find_one()['version'] == 2
+    assert mongo_db.listings.find_one({"listing_id": 1})['soi_version'] == 2
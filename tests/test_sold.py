@@ -0,0 +1,63 @@
+from DomainAnalysis.quota import RequestBudget, QuotaExceeded
+from DomainAnalysis.sold import (disappeared, ended_listing_candidates, classify_listing, detect_ended_listings,
+                                 SOLD, WITHDRAWN)
+
+class FakeResponse():
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+class FakeClient():
+    def __init__(self, responses):
+        self.responses = responses
+        self.requested = []
+
+    def get_listing(self, listing_id):
+        self.requested.append(listing_id)
+        if listing_id not in self.responses:
+            raise QuotaExceeded("Daily Domain request budget exhausted for detail requests")
+        return self.responses[listing_id]
+
+def add_run(runs, run_id, listing_ids):
+    runs.insert_one({"run_id": run_id, "listing_ids": listing_ids, "content_hashes": ["x"] * len(listing_ids)})
+
+def test_disappeared():
+    assert disappeared([1, 2, 3, 4], [2, 4, 5], unprobed=[9, 3]) == [9, 3, 1]
+
+def test_ended_listing_candidates_uses_the_previous_run(mongo_db):
+    add_run(mongo_db.runs, "20211001T000000Z", [1, 2, 3])
+    assert ended_listing_candidates(mongo_db.runs, "20211001T000000Z") == []
+    add_run(mongo_db.runs, "20211002T000000Z", [2, 3, 4])
+    assert ended_listing_candidates(mongo_db.runs, "20211002T000000Z") == [1]
+
+def test_classify_listing():
+    checked = "2021-10-02T00:00:00Z"
+    assert classify_listing(404, None, checked) == {'status': WITHDRAWN, 'dateEnded': checked}
+    assert classify_listing(200, {'status': "live"}, checked) is None
+    assert classify_listing(429, None, checked) is None
+    sold = {'status': "sold", 'saleDetails': {'soldDetails': {'soldPrice': 1010000, 'soldDate': "2021-10-01"}}}
+    assert classify_listing(200, sold, checked) == {'status': SOLD, 'dateEnded': "2021-10-01", 'soldPrice': 1010000}
+    assert classify_listing(200, {'status': "archived"}, checked)['status'] == WITHDRAWN
+
+def test_detect_ended_listings_within_budget(mongo_db, tmp_path):
+    add_run(mongo_db.runs, "20211001T000000Z", [1, 2, 3, 4, 5])
+    add_run(mongo_db.runs, "20211002T000000Z", [5])
+    mongo_db.listings.insert_many([{"listing_id": x} for x in range(1, 6)])
+    client = FakeClient({1: FakeResponse(200, {'status': "sold"}), 2: FakeResponse(404),
+                         3: FakeResponse(200, {'status': "live"}), 4: FakeResponse(200, {'status': "sold"})})
+    budget = RequestBudget(str(tmp_path / "quota.db"), daily_limit=3, search_reserve=0)
+    summary = detect_ended_listings(mongo_db.listings, mongo_db.runs, client, "20211002T000000Z", budget)
+    assert summary == {'disappeared': 4, 'checked': 3, 'sold': 1, 'withdrawn': 1, 'unprobed': 1}
+    assert sorted(client.requested) == [1, 2, 3]
+    assert mongo_db.listings.find_one({"listing_id": 1})['status'] == SOLD
+    assert mongo_db.listings.find_one({"listing_id": 2})['status'] == WITHDRAWN
+    assert 'status' not in mongo_db.listings.find_one({"listing_id": 3})
+
+    # The listing there wasn't budget for is checked first in the next run
+    add_run(mongo_db.runs, "20211003T000000Z", [5])
+    summary = detect_ended_listings(mongo_db.listings, mongo_db.runs, client, "20211003T000000Z")
+    assert summary['sold'] == 1 and summary['unprobed'] == 0
+    assert client.requested[-1] == 4
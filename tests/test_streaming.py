@@ -0,0 +1,93 @@
+import json
+import pytest
+from DomainAnalysis import domain_api
+from DomainAnalysis.fetcher import QUOTA
+from DomainAnalysis.quota import RequestBudget, QuotaExceeded
+from DomainAnalysis.snapshots import get_run
+from DomainAnalysis.streaming import stream_listings
+
+class FakeResponse():
+    def __init__(self, status_code, body, headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+        self.headers = headers or {}
+
+    def json(self):
+        return self.body
+
+class FakeDomain():
+    """Searches return `listing_ids` a page at a time, and the details of every listing but 13 can be got"""
+    def __init__(self, raw_listing, listing_ids, budget=None):
+        self.raw_listing = raw_listing
+        self.listing_ids = listing_ids
+        self.budget = budget
+        self.requested = []
+
+    def search_page(self, client, data):
+        start = (data['pageNumber'] - 1) * data['pageSize']
+        ids = self.listing_ids[start:start + data['pageSize']]
+        body = [{"listing": {"id": x, "dateUpdated": "2021-10-01"}} for x in ids]
+        return FakeResponse(200, body, {"X-Total-Count": str(len(self.listing_ids)),
+                                        "X-Pagination-PageNumber": str(data['pageNumber'])})
+
+    def get_listing(self, listing_id):
+        if self.budget is not None and not self.budget.try_acquire("detail"):
+            raise QuotaExceeded("Daily Domain request budget exhausted for detail requests")
+        self.requested.append(listing_id)
+        if listing_id == 13:
+            return FakeResponse(500, {"message": "Internal error"})
+        return FakeResponse(200, dict(self.raw_listing, id=listing_id))
+
+@pytest.fixture
+def raw_listing():
+    with open('examples/raw_listing.json', 'r') as infile:
+        return json.load(infile)
+
+def test_stream_listings_stores_every_new_listing(raw_listing, mongo_db, monkeypatch):
+    # Page size is 200, so the listings come over two pages and 199 is on both
+    domain = FakeDomain(raw_listing, list(range(1, 200)) + list(range(199, 250)))
+    monkeypatch.setattr(domain_api, "search_page", domain.search_page)
+    mongo_db.listings.insert_one({"listing_id": 1, "dateUpdated": "2021-10-01"})
+
+    summary = stream_listings(mongo_db.client, domain, ["3228"], run_id="20211001T000000Z", concurrency=4,
+                              batch_size=20, max_pending=10)
+    assert summary['searched'] == 249 and summary['changed'] == 249
+    assert summary['fetched'] == summary['inserted'] == 247
+    assert summary['failed'] == 1
+    assert sorted(domain.requested) == list(range(2, 250))
+    assert sorted(mongo_db.listings.distinct("listing_id")) == [x for x in range(1, 250) if x != 13]
+    assert mongo_db.details.count_documents({}) == 247
+    assert get_run(mongo_db.runs, "20211001T000000Z")['listing_ids'] == list(range(1, 250))
+
+def test_stream_listings_defers_what_the_budget_cant_afford(raw_listing, mongo_db, monkeypatch, tmp_path):
+    budget = RequestBudget(str(tmp_path / "quota.db"), daily_limit=30, search_reserve=0)
+    domain = FakeDomain(raw_listing, list(range(100, 150)), budget)
+    monkeypatch.setattr(domain_api, "search_page", domain.search_page)
+
+    summary = stream_listings(mongo_db.client, domain, ["3228"], budget=budget, concurrency=2, batch_size=5)
+    assert summary['fetched'] == 30
+    assert len(budget.deferred()) == 20
+    assert sorted(budget.deferred() + domain.requested) == list(range(100, 150))
+    assert mongo_db.listings.count_documents({}) == 30
+
+def test_stream_listings_plans_the_deferred_listings_once(raw_listing, mongo_db, monkeypatch, tmp_path):
+    budget = RequestBudget(str(tmp_path / "quota.db"), daily_limit=250, search_reserve=0)
+    budget.defer(list(range(1000, 1050)))
+    # Two pages, the first of 200 listings and the second of 100
+    domain = FakeDomain(raw_listing, list(range(100, 400)), budget)
+    monkeypatch.setattr(domain_api, "search_page", domain.search_page)
+
+    summary = stream_listings(mongo_db.client, domain, ["3228"], budget=budget, concurrency=2, batch_size=20)
+    # The deferred listings and the first 200 fit, and none of the second page does
+    assert summary['fetched'] == 250
+    assert sorted(domain.requested) == list(range(100, 300)) + list(range(1000, 1050))
+    assert budget.deferred() == list(range(300, 400))
+
+def test_stream_listings_stops_when_the_search_fails(raw_listing, mongo_db, monkeypatch):
+    domain = FakeDomain(raw_listing, [])
+    monkeypatch.setattr(domain_api, "search_page",
+                        lambda client, data: FakeResponse(401, {"detail": "Unable to verify credentials"}))
+    with pytest.raises(Exception, match="Domain search failed"):
+        stream_listings(mongo_db.client, domain, ["3228"])
+    assert mongo_db.runs.count_documents({}) == 0
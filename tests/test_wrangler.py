@@ -166,4 +166,38 @@ def test_if_no_street_number_present(no_street_number):
 def test_only_one_price_in_display_price(no_street_number):
     l = Listing(no_street_number)
     assert l.minimumPrice == 600000
+
+@pytest.mark.parametrize("displayPrice, expected", [
+    ("$600,000 - 650,000", (600000, 650000)),
+    ("Offers 600K-650K", (600000, 650000)),
+    ("$1.1 - 1.2M", (1100000, 1200000)),
+    ("$600,000", (600000, 600000)),
+    ("Contact Agent", (None, None)),
+])
+def test_ranges_with_one_or_no_dollar_sign(raw_listing, displayPrice, expected):
+    raw_listing['priceDetails'] = {'displayPrice': displayPrice}
+    l = Listing(raw_listing)
+    assert (l.minimumPrice, l.maximumPrice) == expected
     
+
+def test_listing_has_no_instance_dict(listing):
+    assert not hasattr(listing, '__dict__')
+    assert not hasattr(listing.location, '__dict__')
+
+def test_as_no_nested_dicts_matches_asdict(listing):
+    from dataclasses import asdict
+    expected = {}
+    for k, v in asdict(listing).items():
+        if isinstance(v, dict):
+            expected.update({f"{k}_{nested_k}": nested_v for nested_k, nested_v in v.items()})
+        else:
+            expected[k] = v
+    row = listing.as_no_nested_dicts()
+    assert row == expected
+    assert list(row) == list(expected) == flat_field_names()
+
+def test_as_no_nested_dicts_missing_nested_classes():
+    row = Listing(listing_id=1).as_no_nested_dicts()
+    assert row['listing_id'] == 1
+    assert row['location'] is None and row['house'] is None and row['agent'] is None
+    assert 'location_state' not in row